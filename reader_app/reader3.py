@@ -11,12 +11,13 @@ from dataclasses import dataclass, field
 from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
 from urllib.parse import unquote
-from pathlib import Path
 
 import ebooklib
 from ebooklib import epub
 from bs4 import BeautifulSoup, Comment
 
+from src.integrations.kobo import get_kobo_db
+
 # --- Data structures ---
 
 @dataclass
@@ -184,69 +185,44 @@ def extract_metadata_robust(book_obj) -> BookMetadata:
 
 # --- Highlights Integration ---
 
-def get_kobo_db_path() -> Path:
-    """Returns the path to the Kobo database on macOS."""
-    # Try both possible filenames
-    base = Path(os.path.expanduser("~/Library/Application Support/Kobo/Kobo Desktop Edition"))
-    for name in ["Kobo.sqlite", "Book.sqlite", "KoboReader.sqlite"]:
-        p = base / name
-        if p.exists():
-            return p
-    return None
-
 def get_highlights_for_book(title_part: str) -> List[Highlight]:
     """
     Fetches highlights from Kobo DB matching the book title.
     Returns a list of Highlight objects.
     """
-    db_path = get_kobo_db_path()
-    if not db_path:
+    # Shared read-only handle: Kobo Desktop may be writing to its database
+    db = get_kobo_db()
+    if not db:
         print("Warning: Kobo database not found.")
         return []
 
-    print(f"Checking Kobo DB at {db_path} for highlights...")
+    print(f"Checking Kobo DB at {db.db_path} for highlights...")
     results = []
     
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
         # 1. Find the VolumeID
-        cursor.execute("""
+        book_rows = db.execute("""
             SELECT ContentID, Title 
             FROM content 
             WHERE Title LIKE ? AND ContentType = 6 
             LIMIT 1
         """, (f"%{title_part}%",))
         
-        book_row = cursor.fetchone()
-        
         # Fallback: loose search
-        if not book_row:
-            cursor.execute("SELECT ContentID, Title FROM content WHERE Title LIKE ? LIMIT 1", (f"%{title_part}%",))
-            book_row = cursor.fetchone()
+        if not book_rows:
+            book_rows = db.execute("SELECT ContentID, Title FROM content WHERE Title LIKE ? LIMIT 1", (f"%{title_part}%",))
             
-        if not book_row:
+        if not book_rows:
             print(f"No book found in Kobo DB for '{title_part}'")
-            conn.close()
             return []
             
+        book_row = book_rows[0]
         full_id = book_row[0]
         volume_id = full_id.split('!')[0]
         print(f"Found Kobo Book ID: {volume_id} ({book_row[1]})")
         
         # 2. Fetch Highlights
-        query = """
-            SELECT Text, Annotation, ContentID, DateCreated
-            FROM Bookmark 
-            WHERE VolumeID = ? 
-            AND Type = 'highlight'
-            ORDER BY DateCreated
-        """
-        cursor.execute(query, (volume_id,))
-        rows = cursor.fetchall()
-        
-        for row in rows:
+        for row in db.bookmarks(volume_id):
             results.append(Highlight(
                 text=row[0],
                 annotation=row[1],
@@ -255,7 +231,6 @@ def get_highlights_for_book(title_part: str) -> List[Highlight]:
             ))
             
         print(f"Found {len(results)} highlights.")
-        conn.close()
         
     except sqlite3.Error as e:
         print(f"SQLite Error: {e}")
@@ -10,9 +10,14 @@ from src.core.parser import parse_epub
 import uvicorn
 from server import app
 
-def start_server():
-    print("Starting server at http://127.0.0.1:8123")
-    uvicorn.run(app, host="127.0.0.1", port=8123)
+def start_server(workers: int = 1):
+    print(f"Starting server at http://127.0.0.1:8123 ({workers} worker{'s' if workers > 1 else ''})")
+    if workers > 1:
+        # Each worker process imports the app itself; tell them how many they are
+        os.environ["READER_WORKERS"] = str(workers)
+        uvicorn.run("server:app", host="127.0.0.1", port=8123, workers=workers)
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=8123)
 
 def main():
     parser = argparse.ArgumentParser(description="Reader 3")
@@ -21,8 +26,11 @@ def main():
     add_parser = subparsers.add_parser("add", help="Add EPUB")
     add_parser.add_argument("file")
     add_parser.add_argument("--no-highlights", action="store_true")
+    add_parser.add_argument("--workers", type=int, default=1, help="Number of processes used to parse chapters")
+    add_parser.add_argument("--no-extract-images", action="store_true", help="Serve images from the EPUB instead of copying them (the EPUB must then stay where it is)")
 
-    subparsers.add_parser("serve", help="Start Server")
+    serve_parser = subparsers.add_parser("serve", help="Start Server")
+    serve_parser.add_argument("--workers", type=int, default=1, help="Number of server processes (Kobo store import needs a single one)")
 
     args = parser.parse_args()
 
@@ -31,13 +39,16 @@ def main():
         safe_name = file_path.stem.replace(" ", "_")
         output_dir = Path("data/library") / f"{safe_name}_data"
         try:
-            book = parse_epub(str(file_path), str(output_dir), fetch_kobo_highlights=not args.no_highlights)
+            book = parse_epub(str(file_path), str(output_dir), fetch_kobo_highlights=not args.no_highlights, workers=args.workers,
+                              extract_images=not args.no_extract_images)
             print(f"Added: {book.metadata.title}")
+            if args.no_extract_images:
+                print(f"Images are read from {file_path.resolve()}: moving or deleting it breaks them (re-add the book to fix)")
         except Exception as e:
             print(f"Error: {e}")
 
     elif args.command == "serve":
-        start_server()
+        start_server(args.workers)
     else:
         parser.print_help()
 
@@ -1,13 +1,19 @@
 import os
+import re
+import sys
 import pickle
 import json
 import html
+import time
+import asyncio
+import threading
 from pathlib import Path
-from functools import lru_cache
+from dataclasses import replace
+from contextlib import asynccontextmanager, suppress
 from typing import Optional, List, Dict
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
@@ -18,23 +24,80 @@ from bs4 import BeautifulSoup
 env_path = Path(__file__).resolve().parent.parent / ".env"
 load_dotenv(env_path)
 
-from reader3 import Book, BookMetadata, ChapterContent, TOCEntry, Highlight
+from src.core.models import Book, BookMetadata, ChapterContent, TOCEntry, Highlight
 from src.core.chat import ChatService
 from src.core.obsidian import get_chapter_note_content, save_chapter_note_content
-from src.core.highlighter import inject_highlights
-from src.integrations.kobo import fetch_highlights
+from src.core.highlighter import (
+    render_highlights, locate_highlights, stored_range,
+    insert_highlight, find_highlight_at, upgrade_chapter, has_baked_highlights,
+    new_highlight_id, find_highlight_by_id
+)
+from src.core.book_store import (
+    load_manifest, load_chapter, save_chapter,
+    load_chapter_highlights, save_chapter_highlights, book_lock, book_version
+)
+from src.core.catalog import reconcile_catalog, list_books, update_book_stats
+from src.core.events import event_broker
+from src.core.cache import ByteBudgetCache
+from src.core.blocking import run_blocking, iterate_blocking, run_long, iterate_long
+from src.utils.file_lock import try_hold_lock
+from src.integrations.kobo_sync import sync_book_highlights, sync_library_highlights, SyncResult, KoboSyncError
+from src.integrations.kobo_watcher import KoboWatcher
+from src.integrations.kobo_service import KoboService
+from src.integrations.kobo_import import ImportPipeline, safe_book_name
+from src.integrations.kobo_covers import KoboCoverCache, cover_version
+from src.core.blob_store import find_blob, is_blob_name
+from src.core.epub_images import find_archived_image, image_cache, MAX_CACHED_IMAGE
+from src.core.image_variants import ImageVariants, width_bucket, variant_format
+from src.core.covers import find_cover, media_type_of, COVER_STEM, CACHE_CONTROL as COVER_CACHE_CONTROL
 from src.core.chat_storage import (
     load_chat_sessions, save_chat_sessions, create_new_session,
     get_session_by_id, add_message_to_session, get_sessions_for_chapter,
     delete_session
 )
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the Kobo watcher when KOBO_AUTO_SYNC is set.
+    With several workers, only the first one to take the watcher lock runs it.
+    """
+    watcher_task = None
+    watcher_lock = None
+    if os.getenv("KOBO_AUTO_SYNC", "").lower() in ("1", "true", "yes"):
+        os.makedirs(BOOKS_DIR, exist_ok=True)
+        watcher_lock = try_hold_lock(os.path.join(BOOKS_DIR, WATCHER_LOCK_NAME))
+        if watcher_lock:
+            watcher_task = asyncio.create_task(KoboWatcher(run_background_sync).run())
+            print("[Kobo] Auto-sync enabled: watching the Kobo database for changes")
+        else:
+            print("[Kobo] Auto-sync handled by another worker")
+    yield
+    if watcher_task:
+        watcher_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await watcher_task
+    if watcher_lock:
+        watcher_lock.close()
+
+app = FastAPI(lifespan=lifespan)
 # Templates are in src/web/templates relative to reader_app directory
-templates = Jinja2Templates(directory="src/web/templates")
+TEMPLATES_DIR = "src/web/templates"
+templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
 # Where are the book folders located?
 BOOKS_DIR = "data/library"
+# Downloads and decrypted EPUBs from the Kobo store
+KOBO_DIR = "data/kobo"
+# Held by the worker running the Kobo watcher
+WATCHER_LOCK_NAME = ".kobo_watcher.lock"
+# Number of server processes (run.py serve --workers)
+SERVER_WORKERS = int(os.getenv("READER_WORKERS", "1"))
+
+# Copies of book images resized on demand (?w=)
+image_variants = ImageVariants()
+# Image URLs name a content hash: like covers, they never change
+IMAGE_CACHE_CONTROL = COVER_CACHE_CONTROL
 
 # Initialize chat service (will raise error if GOOGLE_API_KEY not set)
 try:
@@ -43,113 +106,279 @@ except ValueError as e:
     print(f"Warning: Chat service not available: {e}")
     chat_service = None
 
-@lru_cache(maxsize=10)
+# Manifests, rendered chapters and reader pages kept in memory, within a byte budget.
+# Entries are versioned by their book's book.db, so a change to one book never evicts another,
+# and a write made by another server worker is seen on the next lookup.
+CACHE_BYTES = int(os.getenv("READER_CACHE_MB", "128")) * 1024 * 1024
+book_cache = ByteBudgetCache(CACHE_BYTES)
+
+def _book_db_version(folder_name: str) -> Optional[tuple]:
+    """Moves on every write to the book (highlights included), made by this worker or another one."""
+    return book_version(os.path.join(BOOKS_DIR, folder_name))
+
+def _manifest_version(folder_name: str) -> int:
+    """Only moves when the book is re-ingested: the generation save_book stamps on a new book.db."""
+    version = book_version(os.path.join(BOOKS_DIR, folder_name))
+    return version[0] if version else 0
+
+def _load_manifest(folder_name: str) -> Optional[Book]:
+    try:
+        return load_manifest(os.path.join(BOOKS_DIR, folder_name))
+    except Exception as e:
+        print(f"Error loading book {folder_name}: {e}")
+        return None
+
 def load_book_cached(folder_name: str) -> Optional[Book]:
     """
-    Loads the book from the pickle file.
+    Loads the book manifest (metadata, TOC and spine without chapter bodies).
     Cached so we don't re-read the disk on every click.
+    Chapter bodies are loaded one at a time with load_chapter_from_disk.
+    """
+    return book_cache.get_or_load(
+        ("manifest", folder_name), _manifest_version(folder_name),
+        lambda: _load_manifest(folder_name), lambda book: len(pickle.dumps(book, pickle.HIGHEST_PROTOCOL))
+    )
+
+def load_chapter_from_disk(folder_name: str, chapter_index: int) -> Optional[ChapterContent]:
+    """
+    Loads the content, text and highlights of a single chapter.
+    Chapters stored with highlights baked into their HTML are converted on the way.
+    """
+    book_dir = os.path.join(BOOKS_DIR, folder_name)
+    book = load_book_cached(folder_name)
+    baked = book is not None and has_baked_highlights(book)
+    chapter = load_chapter(book_dir, chapter_index)
+    if chapter and upgrade_chapter(chapter, baked):
+        # The row is rewritten: redo it from a copy read under the book lock, so a
+        # highlight just saved by another thread or worker is not overwritten
+        with book_lock(book_dir):
+            chapter = load_chapter(book_dir, chapter_index)
+            if chapter and upgrade_chapter(chapter, baked):
+                save_chapter(book_dir, chapter_index, chapter)
+    return chapter
+
+def invalidate_book(folder_name: str):
+    """
+    Drops the rendered chapters and pages of a book rewritten by this worker (others notice
+    through book_version). The write moved the whole book's version, so none of them could hit
+    again: freeing them now returns their bytes to the budget instead of waiting for eviction.
+    """
+    book_cache.invalidate_where(lambda key: key[0] in ("chapter", "page") and key[1] == folder_name)
+
+def _render_chapter(folder_name: str, chapter_index: int) -> Optional[tuple]:
+    chapter = load_chapter_from_disk(folder_name, chapter_index)
+    if not chapter:
+        return None
+    html_content, chapter_text = render_highlights(chapter.content, chapter.highlights)
+    return replace(chapter, content=html_content), chapter_text, chapter.content
+
+def _rendered_size(rendered: tuple) -> int:
+    chapter, chapter_text, clean_html = rendered
+    size = sys.getsizeof(chapter.content) + sys.getsizeof(chapter.text) + sys.getsizeof(chapter_text)
+    # Without highlights the displayed HTML is the clean one
+    return size if clean_html is chapter.content else size + sys.getsizeof(clean_html)
+
+def render_chapter(folder_name: str, chapter_index: int) -> Optional[tuple]:
+    """
+    The chapter as displayed (highlights applied to its clean HTML), the text their
+    offsets refer to and the clean HTML. Recently read chapters are kept rendered.
+    """
+    return book_cache.get_or_load(
+        ("chapter", folder_name, chapter_index), _book_db_version(folder_name),
+        lambda: _render_chapter(folder_name, chapter_index), _rendered_size
+    )
+
+def after_highlight_sync(book_id: str, result: SyncResult):
+    """
+    Follow-up of a sync that changed a book: refreshes its catalog row and tells open tabs
+    which chapters to reload. The manifest cache is untouched (highlights live in chapter rows).
+    """
+    if not result.touched_chapters:
+        return
+    invalidate_book(book_id)
+    update_book_stats(BOOKS_DIR, book_id, result.added)
+    event_broker.publish({
+        "type": "highlights",
+        "book_id": book_id,
+        "chapters": result.touched_chapters,
+        "added": result.added,
+        "updated": result.updated
+    })
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """True if the client already holds this version (If-None-Match)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+def _page_version(book_id: str) -> Optional[tuple]:
+    """
+    What a reader page is built from: the book's stored version (manifest, chapters and
+    highlights) and the page template. The chapter note is not part of it: the page fetches it.
     """
-    file_path = os.path.join(BOOKS_DIR, folder_name, "book.pkl")
-    if not os.path.exists(file_path):
+    version = book_version(os.path.join(BOOKS_DIR, book_id))
+    if version is None:
         return None
+    return version + (os.stat(os.path.join(TEMPLATES_DIR, "reader.html")).st_mtime_ns,)
 
-    try:
-        with open(file_path, "rb") as f:
-            book = pickle.load(f)
-        return book
-    except Exception as e:
-        print(f"Error loading book {folder_name}: {e}")
+def _render_reader_page(book_id: str, chapter_index: int, book: Book) -> Optional[bytes]:
+    rendered = render_chapter(book_id, chapter_index)
+    if not rendered:
         return None
+    return templates.get_template("reader.html").render(
+        book=book,
+        current_chapter=rendered[0],
+        chapter_index=chapter_index,
+        book_id=book_id,
+        prev_idx=chapter_index - 1 if chapter_index > 0 else None,
+        next_idx=chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
+    ).encode("utf-8")
 
-def save_book_to_disk(folder_name: str, book: Book):
-    """Helper pour sauvegarder le pickle."""
-    file_path = os.path.join(BOOKS_DIR, folder_name, "book.pkl")
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "wb") as f:
-        pickle.dump(book, f)
-    # Invalider le cache pour forcer le rechargement
-    load_book_cached.cache_clear()
+def reader_page(book_id: str, chapter_index: int, book: Book, version: Optional[tuple]) -> Optional[bytes]:
+    """The reader page of a chapter, as sent. Warm chapters skip templating altogether."""
+    if version is None:
+        return _render_reader_page(book_id, chapter_index, book)
+    return book_cache.get_or_load(
+        ("page", book_id, chapter_index), version,
+        lambda: _render_reader_page(book_id, chapter_index, book), len
+    )
+
+def _catalog_entry(row: Dict) -> Dict:
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "author": row["authors"],
+        "chapters": row["chapters"],
+        "highlights": row["highlights"],
+        "size": row["size"],
+        "mtime": row["mtime"],
+        "has_cover": bool(row["has_cover"]),
+        "cover_version": row["cover_version"]
+    }
 
 @app.get("/", response_class=HTMLResponse)
 async def library_view(request: Request):
-    """Lists all available processed books."""
-    books = []
-
-    # Scan directory for folders ending in '_data' that have a book.pkl
-    if os.path.exists(BOOKS_DIR):
-        for item in os.listdir(BOOKS_DIR):
-            item_path = os.path.join(BOOKS_DIR, item)
-            if item.endswith("_data") and os.path.isdir(item_path):
-                # Try to load it to get the title
-                book = load_book_cached(item)
-                if book:
-                    books.append({
-                        "id": item,
-                        "title": book.metadata.title,
-                        "author": ", ".join(book.metadata.authors),
-                        "chapters": len(book.spine)
-                    })
+    """Lists all available processed books from the catalog."""
+    await run_blocking(reconcile_catalog, BOOKS_DIR)
+    rows, _ = await run_blocking(list_books, BOOKS_DIR)
+    books = [_catalog_entry(row) for row in rows]
 
     return templates.TemplateResponse("library.html", {"request": request, "books": books})
 
+@app.get("/api/library")
+async def library_api(q: str = "", page: int = 1, page_size: int = 50):
+    """Paginated, searchable listing of the library catalog."""
+    if page < 1 or page_size < 1 or page_size > 500:
+        raise HTTPException(status_code=400, detail="Invalid page or page_size")
+    await run_blocking(reconcile_catalog, BOOKS_DIR)
+    rows, total = await run_blocking(list_books, BOOKS_DIR, query=q, offset=(page - 1) * page_size, limit=page_size)
+    return JSONResponse({
+        "books": [_catalog_entry(row) for row in rows],
+        "total": total,
+        "page": page,
+        "page_size": page_size
+    })
+
 @app.get("/read/{book_id}", response_class=HTMLResponse)
-async def redirect_to_first_chapter(book_id: str):
+async def redirect_to_first_chapter(request: Request, book_id: str):
     """Helper to just go to chapter 0."""
-    return await read_chapter(book_id=book_id, chapter_index=0)
+    return await read_chapter(request, book_id=book_id, chapter_index=0)
 
 @app.get("/read/{book_id}/{chapter_index}", response_class=HTMLResponse)
 async def read_chapter(request: Request, book_id: str, chapter_index: int):
     """The main reader interface."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
     if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
 
-    current_chapter = book.spine[chapter_index]
+    # Going back to a chapter the browser already has costs a few stats, no rendering
+    version = await run_blocking(_page_version, book_id)
+    headers = {}
+    if version:
+        etag = f'"{"-".join(f"{part:x}" for part in version)}-{chapter_index}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
 
-    # Calculate Prev/Next links
-    prev_idx = chapter_index - 1 if chapter_index > 0 else None
-    next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
+    # The chapter note is not in the page: the notes panel loads it from /api/notes
+    page = await run_blocking(reader_page, book_id, chapter_index, book, version)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    return HTMLResponse(page, headers=headers)
 
-    # Load note content for this chapter
-    note_content = get_chapter_note_content(book.metadata.title, current_chapter.title)
+def _find_image(book_dir: str, image_name: str) -> tuple:
+    """Extracted image file, or else the image inside the source EPUB; (None, None) if neither exists."""
+    # Images partagées par contenu (hash), ou dossier images/ des livres importés avant
+    img_path = find_blob(BOOKS_DIR, image_name) or os.path.join(book_dir, "images", image_name)
+    if os.path.exists(img_path):
+        return img_path, None
+    # Livre importé sans extraire les images : on les lit directement dans l'EPUB
+    return None, find_archived_image(book_dir, image_name)
 
-    return templates.TemplateResponse("reader.html", {
-        "request": request,
-        "book": book,
-        "current_chapter": current_chapter,
-        "chapter_index": chapter_index,
-        "book_id": book_id,
-        "prev_idx": prev_idx,
-        "next_idx": next_idx,
-        "note_content": note_content
-    })
+def _read_original(img_path: Optional[str], image) -> bytes:
+    if img_path:
+        with open(img_path, "rb") as f:
+            return f.read()
+    return image.read() if image.size <= MAX_CACHED_IMAGE else b"".join(image.chunks())
 
 @app.get("/read/{book_id}/images/{image_name}")
-async def serve_image(book_id: str, image_name: str):
+async def serve_image(book_id: str, image_name: str, request: Request, w: Optional[int] = None):
     """
     Serves images specifically for a book.
     The HTML contains <img src="images/pic.jpg">.
     The browser resolves this to /read/{book_id}/images/pic.jpg.
+    With ?w=, a copy resized to that width bucket is served (see srcset).
+    Images named by their content hash are cached for good by the browser.
     """
     # Security check: ensure book_id is clean
     safe_book_id = os.path.basename(book_id)
     safe_image_name = os.path.basename(image_name)
+    accepts_webp = "image/webp" in request.headers.get("accept", "")
 
-    img_path = os.path.join(BOOKS_DIR, safe_book_id, "images", safe_image_name)
+    headers = {"Vary": "Accept"} if w else {}
+    if is_blob_name(safe_image_name):
+        digest = os.path.splitext(safe_image_name)[0]
+        etag = f'"{digest}-{width_bucket(w)}-{variant_format(accepts_webp)}"' if w else f'"{digest}"'
+        headers.update({"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL})
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
 
-    if not os.path.exists(img_path):
+    book_dir = os.path.join(BOOKS_DIR, safe_book_id)
+    img_path, image = await run_blocking(_find_image, book_dir, safe_image_name)
+    if img_path is None and image is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return FileResponse(img_path)
+    if w:
+        variant = await run_blocking(image_variants.get, book_dir, safe_image_name, w, accepts_webp,
+                                     lambda: _read_original(img_path, image))
+        if variant:
+            path, media_type = variant
+            return FileResponse(path, media_type=media_type, headers=headers)
+
+    if img_path:
+        return FileResponse(img_path, headers=headers)
+    if image.size <= MAX_CACHED_IMAGE:
+        return Response(content=await run_blocking(image.read), media_type=image.media_type, headers=headers)
+    return StreamingResponse(iterate_blocking(image.chunks()), media_type=image.media_type,
+                             headers={**headers, "Content-Length": str(image.size)})
+
+@app.get("/covers/library/{book_id}")
+async def library_cover(book_id: str):
+    """Miniature de couverture extraite à l'ingestion. L'URL porte la version du fichier de couverture (?v=), d'où le cache immuable."""
+    path = await run_blocking(find_cover, os.path.join(BOOKS_DIR, os.path.basename(book_id)), COVER_STEM)
+    if not path:
+        raise HTTPException(status_code=404, detail="Cover not found")
+    return FileResponse(path, media_type=media_type_of(path), headers={"Cache-Control": COVER_CACHE_CONTROL})
 
 # Notes API endpoints
 @app.get("/api/notes/{book_id}/{chapter_index}")
 async def get_notes(book_id: str, chapter_index: int):
     """Get notes for a specific chapter."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
@@ -157,7 +386,7 @@ async def get_notes(book_id: str, chapter_index: int):
         raise HTTPException(status_code=404, detail="Chapter not found")
     
     current_chapter = book.spine[chapter_index]
-    note_content = get_chapter_note_content(book.metadata.title, current_chapter.title)
+    note_content = await run_blocking(get_chapter_note_content, book.metadata.title, current_chapter.title)
     
     return JSONResponse({"content": note_content})
 
@@ -167,7 +396,7 @@ class NoteUpdate(BaseModel):
 @app.post("/api/notes/{book_id}/{chapter_index}")
 async def save_notes(book_id: str, chapter_index: int, note_update: NoteUpdate):
     """Save notes for a specific chapter."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
@@ -175,7 +404,7 @@ async def save_notes(book_id: str, chapter_index: int, note_update: NoteUpdate):
         raise HTTPException(status_code=404, detail="Chapter not found")
     
     current_chapter = book.spine[chapter_index]
-    save_chapter_note_content(book.metadata.title, current_chapter.title, note_update.content)
+    await run_blocking(save_chapter_note_content, book.metadata.title, current_chapter.title, note_update.content)
     
     return JSONResponse({"status": "saved"})
 
@@ -195,14 +424,14 @@ async def create_chat_session(request: Request):
         raise HTTPException(status_code=400, detail="chapter_index must be an integer")
     
     # Verify book exists
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
     if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
     
-    new_session = create_new_session(book_id, chapter_index)
+    new_session = await run_blocking(create_new_session, book_id, chapter_index)
     
     return JSONResponse({
         "id": new_session.id,
@@ -214,14 +443,14 @@ async def create_chat_session(request: Request):
 @app.get("/api/chat/sessions/{book_id}/{chapter_index}")
 async def get_chat_history(book_id: str, chapter_index: int):
     """Get all chat sessions for a specific chapter."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
     if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
     
-    sessions = get_sessions_for_chapter(book_id, chapter_index)
+    sessions = await run_blocking(get_sessions_for_chapter, book_id, chapter_index)
     
     # Sort by date descending (most recent first)
     sessions.sort(key=lambda s: s.created_at, reverse=True)
@@ -248,11 +477,11 @@ async def get_chat_history(book_id: str, chapter_index: int):
 @app.get("/api/chat/session/{book_id}/{session_id}")
 async def get_session_content(book_id: str, session_id: str):
     """Get the full content of a specific chat session."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    session = get_session_by_id(book_id, session_id)
+    session = await run_blocking(get_session_by_id, book_id, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -268,15 +497,15 @@ async def get_session_content(book_id: str, session_id: str):
 @app.delete("/api/chat/session/{book_id}/{session_id}")
 async def delete_chat_session(book_id: str, session_id: str):
     """Delete a chat session."""
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    session = get_session_by_id(book_id, session_id)
+    session = await run_blocking(get_session_by_id, book_id, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    delete_session(book_id, session_id)
+    await run_blocking(delete_session, book_id, session_id)
     
     return JSONResponse({"status": "deleted"})
 
@@ -300,7 +529,7 @@ async def generate_chat_stream(chat_data: ChatMessage, book_id: str, chapter_ind
     yield f"data: {json.dumps({'type': 'user_message', 'content': escaped_user_message})}\n\n"
     
     # Load book and chapter
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         yield f"data: {json.dumps({'type': 'error', 'content': 'Book not found'})}\n\n"
         return
@@ -309,30 +538,33 @@ async def generate_chat_stream(chat_data: ChatMessage, book_id: str, chapter_ind
         yield f"data: {json.dumps({'type': 'error', 'content': 'Chapter not found'})}\n\n"
         return
     
-    current_chapter = book.spine[chapter_index]
+    current_chapter = await run_blocking(load_chapter_from_disk, book_id, chapter_index)
+    if not current_chapter:
+        yield f"data: {json.dumps({'type': 'error', 'content': 'Chapter not found'})}\n\n"
+        return
     
     # --- SESSION MANAGEMENT ---
     current_session = None
     if chat_data.session_id:
-        current_session = get_session_by_id(book_id, chat_data.session_id)
+        current_session = await run_blocking(get_session_by_id, book_id, chat_data.session_id)
     
     # If no session ID provided or session not found, create a new one
     if not current_session:
         # Use first 30 characters of message as title
         title = chat_data.message[:30] + ("..." if len(chat_data.message) > 30 else "")
-        current_session = create_new_session(book_id, chapter_index, title=title)
+        current_session = await run_blocking(create_new_session, book_id, chapter_index, title=title)
         # Send session_init event to frontend
         yield f"data: {json.dumps({'type': 'session_init', 'id': current_session.id})}\n\n"
     
     # Add user message to session
-    add_message_to_session(book_id, current_session.id, "user", chat_data.message)
+    await run_blocking(add_message_to_session, book_id, current_session.id, "user", chat_data.message)
     # ---------------------------
     
     # Determine notes content: use provided content from frontend if available, else load from disk
     if chat_data.current_notes is not None:
         current_notes = chat_data.current_notes
     else:
-        current_notes = get_chapter_note_content(book.metadata.title, current_chapter.title)
+        current_notes = await run_blocking(get_chapter_note_content, book.metadata.title, current_chapter.title)
     
     print(f"[Chat] Received message: {chat_data.message[:100]}...")
     print(f"[Chat] Chapter: {current_chapter.title}")
@@ -344,10 +576,10 @@ async def generate_chat_stream(chat_data: ChatMessage, book_id: str, chapter_ind
     # Signal start of assistant message
     yield f"data: {json.dumps({'type': 'assistant_start'})}\n\n"
     
-    # Stream LLM response
+    # Stream LLM response (each chunk is awaited from the pool: the LLM client blocks)
     full_response_text = ""
     try:
-        for chunk in chat_service.send_message_stream(
+        async for chunk in iterate_long(chat_service.send_message_stream(
             user_message=chat_data.message,
             chapter_title=current_chapter.title,
             chapter_text=current_chapter.text,
@@ -358,14 +590,14 @@ async def generate_chat_stream(chat_data: ChatMessage, book_id: str, chapter_ind
             include_chapter=chat_data.include_chapter,
             include_notes=chat_data.include_notes,
             snippets=chat_data.snippets
-        ):
+        )):
             # Escape HTML and send chunk
             escaped_chunk = html.escape(chunk)
             full_response_text += chunk  # Accumulate full response
             yield f"data: {json.dumps({'type': 'chunk', 'content': escaped_chunk})}\n\n"
         
         # Save assistant response to session
-        add_message_to_session(book_id, current_session.id, "assistant", full_response_text)
+        await run_blocking(add_message_to_session, book_id, current_session.id, "assistant", full_response_text)
         
         # Signal end of assistant message
         yield f"data: {json.dumps({'type': 'assistant_end'})}\n\n"
@@ -411,10 +643,46 @@ class HighlightPayload(BaseModel):
     chapter_index: int
     text: str
     annotation: Optional[str] = None
+    # Position dans le texte du chapitre, calculée par le navigateur
+    start: Optional[int] = None
+    end: Optional[int] = None
+    # Identifiant du highlight (data-hl-id), pour la suppression et la mise à jour
+    id: Optional[str] = None
+
+class HighlightUpdate(BaseModel):
+    book_id: str
+    chapter_index: int
+    id: str
+    annotation: str
+
+# Highlight edits run in the pool and possibly in several workers at the same time:
+# each one is a read-modify-write of a chapter's highlight list, so they hold the book's lock
+def _highlight_lock(book_id: str):
+    return book_lock(os.path.join(BOOKS_DIR, book_id))
+
+def _save_highlights(book_id: str, chapter_index: int, highlights: List[Highlight], added: int = 0):
+    """
+    Writes a chapter's highlights only (its HTML is untouched) and refreshes what depends on them.
+    added: change in the chapter's highlight count, applied to the catalog row.
+    """
+    save_chapter_highlights(os.path.join(BOOKS_DIR, book_id), chapter_index, highlights)
+    invalidate_book(book_id)
+    update_book_stats(BOOKS_DIR, book_id, added)
 
 @app.post("/api/highlights/add")
 async def add_highlight_endpoint(payload: HighlightPayload):
-    """Ajoute un highlight manuel sans casser le contenu existant."""
+    """
+    Ajoute un highlight manuel.
+    Seule la liste des highlights du chapitre est réécrite : le HTML reste propre
+    et les highlights sont appliqués à l'affichage.
+    """
+    return JSONResponse(await run_blocking(_add_highlight, payload))
+
+def _add_highlight(payload: HighlightPayload) -> Dict:
+    with _highlight_lock(payload.book_id):
+        return _add_highlight_locked(payload)
+
+def _add_highlight_locked(payload: HighlightPayload) -> Dict:
     book = load_book_cached(payload.book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -422,114 +690,396 @@ async def add_highlight_endpoint(payload: HighlightPayload):
     if payload.chapter_index < 0 or payload.chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
     
-    current_chapter = book.spine[payload.chapter_index]
+    rendered = render_chapter(payload.book_id, payload.chapter_index)
+    highlights = load_chapter_highlights(os.path.join(BOOKS_DIR, payload.book_id), payload.chapter_index)
+    if not rendered or highlights is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
     
-    # 1. Créer l'objet Highlight
+    # 1. Créer l'objet Highlight à la position envoyée par le navigateur
     new_hl = Highlight(
         text=payload.text,
         annotation=payload.annotation or "Manuel",
         date="",
-        chapter_id=""
+        chapter_id="",
+        start=payload.start if payload.start is not None else -1,
+        end=payload.end if payload.end is not None else -1
     )
+    new_hl.id = new_highlight_id(new_hl)
     
-    # 2. Vérifier si ce highlight n'existe pas déjà (éviter doublons)
-    existing_texts = {h.text.strip() for h in current_chapter.highlights}
-    if payload.text.strip() in existing_texts:
-        return JSONResponse({"status": "already_exists"})
-    
-    # 3. Mettre à jour la liste des highlights du chapitre
-    current_chapter.highlights.append(new_hl)
-    
-    # 4. Injecter dans le HTML (PERSISTANCE)
-    # On parse le contenu actuel (qui contient déjà des spans) pour ajouter le nouveau
-    soup = BeautifulSoup(current_chapter.content, 'html.parser')
+    # 2. Position absente ou décalée (le navigateur ne parse pas le HTML exactement comme nous) :
+    # on cherche le texte dans le chapitre. Introuvable, le highlight est quand même
+    # enregistré (sans position, il n'est pas affiché dans le chapitre)
+    if stored_range(rendered[1], new_hl) is None:
+        if not locate_highlights(BeautifulSoup(rendered[2], 'html.parser'), [new_hl]):
+            new_hl.start = new_hl.end = -1
     
-    # On utilise la fonction existante inject_highlights pour wrapper le texte
-    inject_highlights(soup, [new_hl])
+    # 3. Éviter les doublons : même plage, ou même texte pour un highlight sans position
+    # (une phrase répétée peut être surlignée à chacune de ses occurrences)
+    if new_hl.start >= 0:
+        if any(h.start == new_hl.start and h.end == new_hl.end for h in highlights):
+            return {"status": "already_exists"}
+    elif any(h.text.strip() == payload.text.strip() for h in highlights):
+        return {"status": "already_exists"}
     
-    current_chapter.content = str(soup)
+    # 4. Insérer (liste triée par position) et sauvegarder
+    insert_highlight(highlights, new_hl)
+    _save_highlights(payload.book_id, payload.chapter_index, highlights, added=1)
     
-    # 5. Sauvegarder sur le disque
-    save_book_to_disk(payload.book_id, book)
-    
-    return JSONResponse({"status": "added"})
+    return {"status": "added", "id": new_hl.id, "start": new_hl.start, "end": new_hl.end}
 
-@app.post("/api/highlights/remove")
-async def remove_highlight_endpoint(payload: HighlightPayload):
-    """Supprime un highlight manuel."""
-    book = load_book_cached(payload.book_id)
+def _load_highlights_for_edit(book_id: str, chapter_index: int) -> List[Highlight]:
+    book = load_book_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
-    
-    if payload.chapter_index < 0 or payload.chapter_index >= len(book.spine):
+    if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
-        
-    chapter = book.spine[payload.chapter_index]
-    
-    # 1. Retirer de la liste (filtrer par texte exact)
-    original_count = len(chapter.highlights)
-    chapter.highlights = [h for h in chapter.highlights if h.text.strip() != payload.text.strip()]
-    
-    # 2. Retirer du HTML (unwrap les spans manual-highlight qui contiennent ce texte)
-    soup = BeautifulSoup(chapter.content, 'html.parser')
-    for span in soup.find_all('span', class_='manual-highlight'):
-        if span.get_text().strip() == payload.text.strip():
-            span.unwrap()  # Enlève la balise <span> mais garde le texte
-    
-    chapter.content = str(soup)
-    
-    # Sauvegarder seulement si quelque chose a changé
-    if len(chapter.highlights) < original_count:
-        save_book_to_disk(payload.book_id, book)
-    
+    # Passe par le rendu : garantit que le chapitre est migré et que ses highlights ont un id
+    render_chapter(book_id, chapter_index)
+    highlights = load_chapter_highlights(os.path.join(BOOKS_DIR, book_id), chapter_index)
+    if highlights is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    return highlights
+
+@app.post("/api/highlights/remove")
+async def remove_highlight_endpoint(payload: HighlightPayload):
+    """Supprime un highlight manuel : par id, sinon par position, sinon par texte."""
+    await run_blocking(_remove_highlight, payload)
     return JSONResponse({"status": "removed"})
 
+def _remove_highlight(payload: HighlightPayload):
+    with _highlight_lock(payload.book_id):
+        highlights = _load_highlights_for_edit(payload.book_id, payload.chapter_index)
+
+        original_count = len(highlights)
+        found = find_highlight_by_id(highlights, payload.id) if payload.id else None
+        if found is None and payload.start is not None and payload.end is not None:
+            found = find_highlight_at(highlights, payload.start, payload.end)
+        if found is not None:
+            del highlights[found]
+        else:
+            # Filtrer par texte exact
+            highlights = [h for h in highlights if h.text.strip() != payload.text.strip()]
+
+        # Sauvegarder seulement si quelque chose a changé
+        if len(highlights) < original_count:
+            _save_highlights(payload.book_id, payload.chapter_index, highlights, added=len(highlights) - original_count)
+
+@app.post("/api/highlights/update")
+async def update_highlight_endpoint(payload: HighlightUpdate):
+    """Modifie l'annotation d'un highlight, retrouvé par son id."""
+    await run_blocking(_update_highlight, payload)
+    return JSONResponse({"status": "updated", "id": payload.id})
+
+def _update_highlight(payload: HighlightUpdate):
+    with _highlight_lock(payload.book_id):
+        highlights = _load_highlights_for_edit(payload.book_id, payload.chapter_index)
+        found = find_highlight_by_id(highlights, payload.id)
+        if found is None:
+            raise HTTPException(status_code=404, detail="Highlight not found")
+        highlights[found].annotation = payload.annotation
+        _save_highlights(payload.book_id, payload.chapter_index, highlights)
+
 @app.post("/api/books/{book_id}/sync-highlights")
 async def sync_kobo_highlights(book_id: str):
     """
-    Synchronise avec Kobo de manière ADDITIVE.
+    Synchronise avec Kobo de manière ADDITIVE et INCRÉMENTALE.
+    Seuls les bookmarks créés ou modifiés depuis la dernière synchro sont lus,
+    et seuls les chapitres qu'ils ciblent sont réécrits.
     Ne supprime pas les highlights manuels existants.
     """
-    book = load_book_cached(book_id)
+    book = await run_blocking(load_book_cached, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
-    # 1. Récupérer les highlights frais depuis la DB Kobo
-    kobo_highlights = fetch_highlights(book.metadata.title)
-    if not kobo_highlights:
-        return JSONResponse({"status": "no_new_highlights", "count": 0})
+    result = await run_long(_sync_book, book_id, book)
 
-    added_count = 0
-    
-    # 2. Pour chaque chapitre, on vérifie quels highlights Kobo manquent
-    for chapter in book.spine:
-        soup = BeautifulSoup(chapter.content, 'html.parser')
-        chapter_text = soup.get_text()  # Texte brut pour recherche rapide
-        
-        # Liste des textes déjà surlignés dans ce chapitre (pour éviter doublons)
-        existing_texts = {h.text.strip() for h in chapter.highlights}
-        
-        new_chapter_highlights = []
-        
-        for kh in kobo_highlights:
-            clean_text = kh.text.strip()
-            
-            # Si ce texte n'est pas déjà connu ET qu'il est présent dans ce chapitre
-            if clean_text not in existing_texts and clean_text in chapter_text:
-                new_chapter_highlights.append(kh)
-                chapter.highlights.append(kh)  # Ajout à la liste de données
-                added_count += 1
-        
-        # 3. Injection uniquement des NOUVEAUX highlights dans le HTML existant
-        if new_chapter_highlights:
-            inject_highlights(soup, new_chapter_highlights)
-            chapter.content = str(soup)
+    return JSONResponse({
+        "status": "synced",
+        "highlights_count": result.added,
+        "updated_count": result.updated,
+        "chapters": result.touched_chapters
+    })
+
+def _sync_book(book_id: str, book: Book) -> SyncResult:
+    result = sync_book_highlights(os.path.join(BOOKS_DIR, book_id), book)
+    after_highlight_sync(book_id, result)
+    return result
+
+def _library_books() -> List[tuple]:
+    reconcile_catalog(BOOKS_DIR)
+    rows, _ = list_books(BOOKS_DIR)
+    return [(row["id"], row["title"]) for row in rows]
+
+def generate_library_sync_stream(books: List[tuple]):
+    """Generator streaming library-wide sync progress as server-sent events."""
+    started = time.perf_counter()
+    yield f"data: {json.dumps({'type': 'start', 'total': len(books)})}\n\n"
+
+    items = []
+    try:
+        for item in sync_library_highlights(BOOKS_DIR, books):
+            items.append(item)
+            after_highlight_sync(item.book_id, item.result)
+            yield f"data: {json.dumps({'type': 'book', 'id': item.book_id, 'title': item.title, 'added': item.result.added, 'updated': item.result.updated, 'ms': round(item.seconds * 1000, 1), 'error': item.error, 'done': len(items), 'total': len(books)})}\n\n"
+    except KoboSyncError as e:
+        print(f"[Sync] Library sync failed: {e}")
+        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+        return
+
+    elapsed = time.perf_counter() - started
+    total_added = sum(item.result.added for item in items)
+    print(f"[Sync] Library sync: {len(items)} books, {total_added} new highlights in {elapsed:.2f}s")
+    for item in sorted(items, key=lambda i: i.seconds, reverse=True):
+        status = f"error: {item.error}" if item.error else f"+{item.result.added} ~{item.result.updated}"
+        print(f"[Sync]   {item.seconds * 1000:8.1f} ms  {status:<12} {item.title}")
+
+    yield f"data: {json.dumps({'type': 'done', 'added': total_added, 'ms': round(elapsed * 1000, 1)})}\n\n"
+
+@app.post("/api/library/sync-highlights")
+async def sync_library_highlights_endpoint():
+    """
+    Synchronise les highlights Kobo de toute la bibliothèque en une seule passe.
+    La progression est envoyée en SSE, livre par livre.
+    """
+    return StreamingResponse(
+        iterate_long(generate_library_sync_stream(await run_blocking(_library_books))),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+def run_background_sync():
+    """Called by the Kobo watcher (in a worker thread) once the Kobo database has settled."""
+    started = time.perf_counter()
+    changed = 0
+    try:
+        for item in sync_library_highlights(BOOKS_DIR, _library_books()):
+            if item.error:
+                print(f"[Kobo] Auto-sync error for {item.title}: {item.error}")
+            elif item.result.touched_chapters:
+                changed += 1
+                after_highlight_sync(item.book_id, item.result)
+                print(f"[Kobo] Auto-sync: +{item.result.added} ~{item.result.updated} in {item.title}")
+    except KoboSyncError as e:
+        print(f"[Kobo] Auto-sync failed: {e}")
+        return
+    print(f"[Kobo] Auto-sync done: {changed} books updated in {time.perf_counter() - started:.2f}s")
+
+async def generate_event_stream(request: Request, book_id: Optional[str] = None,
+                                event_type: Optional[tuple] = None, initial: Optional[List[Dict]] = None):
+    """Forwards broker events to one tab, optionally only those of a book or of one type."""
+    queue = event_broker.subscribe()
+    try:
+        yield ": connected\n\n"
+        for event in initial or []:
+            yield f"data: {json.dumps(event)}\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=15)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                # Keep-alive pour que les proxys ne coupent pas la connexion
+                yield ": ping\n\n"
+                continue
+            if book_id and event.get("book_id") not in (None, book_id):
+                continue
+            if event_type and event.get("type") not in event_type:
+                continue
+            yield f"data: {json.dumps(event)}\n\n"
+    finally:
+        event_broker.unsubscribe(queue)
+
+@app.get("/api/events")
+async def events_endpoint(request: Request, book_id: Optional[str] = None):
+    """
+    Flux SSE des événements serveur (nouveaux highlights Kobo, ...).
+    Le lecteur s'y abonne pour rafraîchir le chapitre affiché.
+    """
+    return StreamingResponse(
+        generate_event_stream(request, book_id),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Remplissage et taux de succès des caches mémoire (livres/chapitres, images d'archive)."""
+    return {"books": book_cache.stats(), "images": image_cache.stats()}
+
+# --- Import depuis la boutique Kobo ---
+
+_kobo_service: Optional[KoboService] = None
+_import_pipeline: Optional[ImportPipeline] = None
+# Titres vus lors du dernier listing, pour nommer les dossiers avant d'avoir ouvert l'EPUB
+_kobo_titles: Dict[str, str] = {}
+# URLs des couvertures du dernier listing, pour /covers/kobo
+_kobo_cover_urls: Dict[str, str] = {}
+_kobo_cover_cache: Optional[KoboCoverCache] = None
+
+def get_kobo_service() -> KoboService:
+    global _kobo_service
+    if _kobo_service is None:
+        _kobo_service = KoboService()
+    if not _kobo_service.is_authenticated():
+        raise HTTPException(status_code=401, detail="Not authenticated to Kobo")
+    return _kobo_service
+
+def _require_single_worker():
+    """
+    The import pipeline keeps its jobs, de-duplication and progress events in memory:
+    with several workers, the import and its progress stream could land on different processes.
+    """
+    if SERVER_WORKERS > 1:
+        raise HTTPException(status_code=409, detail="Kobo import needs a single server process: start the server without --workers")
+
+def get_import_pipeline() -> ImportPipeline:
+    global _import_pipeline
+    _require_single_worker()
+    if _import_pipeline is None:
+        _import_pipeline = ImportPipeline(get_kobo_service(), BOOKS_DIR, KOBO_DIR, event_broker.publish)
+    return _import_pipeline
+
+@app.get("/import", response_class=HTMLResponse)
+async def import_view(request: Request):
+    return templates.TemplateResponse("import.html", {"request": request})
+
+# Délai minimal entre deux rafraîchissements en arrière-plan du listing Kobo
+KOBO_LIBRARY_REFRESH_INTERVAL = 60
+_library_refresh_lock = threading.Lock()
+
+def _remember_books(books: List[Dict]):
+    for book in books:
+        if book.get("id"):
+            _kobo_titles[book["id"]] = book.get("title") or ""
+            if book.get("cover_image"):
+                _kobo_cover_urls[book["id"]] = book["cover_image"]
+
+def _refresh_kobo_library_in_background(service: KoboService, cache: Dict):
+    """Rafraîchit le cache du listing Kobo sans bloquer la requête ; prévient la page d'import si le listing a changé."""
+    if time.time() - cache.get("refreshed_at", 0) < KOBO_LIBRARY_REFRESH_INTERVAL:
+        return
+    if not _library_refresh_lock.acquire(blocking=False):
+        return
+    etag = cache["etag"]
+
+    def run():
+        try:
+            cache = service.refresh_library()
+            _remember_books(cache["books"])
+            if cache["etag"] != etag:
+                event_broker.publish({"type": "kobo_library", "etag": cache["etag"]})
+        except Exception as e:
+            print(f"[Kobo] Library refresh failed: {e}")
+        finally:
+            _library_refresh_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+def _kobo_library() -> Dict:
+    """Le listing en cache (rafraîchi en arrière-plan), ou un premier listing complet s'il n'y a pas encore de cache."""
+    service = get_kobo_service()
+    cache = service.load_library_cache()
+    if cache is None:
+        try:
+            cache = service.refresh_library()
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"Could not list Kobo books: {e}")
+    else:
+        _refresh_kobo_library_in_background(service, cache)
+    _remember_books(cache["books"])
+    return cache
+
+@app.get("/api/kobo/books")
+def kobo_books_endpoint(request: Request):
+    """
+    Liste les livres achetés sur Kobo depuis le cache local, avec ETag.
+    Le cache est mis à jour en arrière-plan à partir du dernier sync token.
+    """
+    cache = _kobo_library()
+    etag = f'"{cache["etag"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    books = [
+        dict(book, cover_thumbnail=f"/covers/kobo/{book['id']}?v={cover_version(book['cover_image'])}" if book.get("cover_image") else None)
+        for book in cache["books"]
+    ]
+    return JSONResponse(books, headers=headers)
+
+@app.get("/covers/kobo/{product_id}")
+def kobo_cover(product_id: str):
+    """Miniature de couverture d'un livre Kobo, téléchargée une seule fois puis servie depuis le disque."""
+    global _kobo_cover_cache
+    if not re.fullmatch(r"[\w-]+", product_id):
+        raise HTTPException(status_code=404, detail="Cover not found")
+    if product_id not in _kobo_cover_urls:
+        _kobo_library()
+    url = _kobo_cover_urls.get(product_id)
+    if not url:
+        raise HTTPException(status_code=404, detail="Cover not found")
+    if _kobo_cover_cache is None:
+        _kobo_cover_cache = KoboCoverCache(get_kobo_service().kobo.Session)
+    path = _kobo_cover_cache.get(product_id, url)
+    if not path:
+        raise HTTPException(status_code=404, detail="Cover not found")
+    return FileResponse(path, media_type=media_type_of(path), headers={"Cache-Control": COVER_CACHE_CONTROL})
+
+@app.post("/api/kobo/import/{product_id}")
+def kobo_import_endpoint(product_id: str):
+    """
+    Met un livre dans le pipeline téléchargement -> DRM -> ingestion.
+    Répond tout de suite ; la progression arrive sur /api/kobo/import-events.
+    """
+    job = get_import_pipeline().submit(product_id, _kobo_titles.get(product_id, ""))
+    return JSONResponse(job.to_dict(), status_code=202)
+
+class ImportAllRequest(BaseModel):
+    product_ids: Optional[List[str]] = None
 
-    # 4. Sauvegarde globale
-    if added_count > 0:
-        save_book_to_disk(book_id, book)
+@app.post("/api/kobo/import-all")
+def kobo_import_all_endpoint(payload: Optional[ImportAllRequest] = None):
+    """
+    Importe plusieurs livres d'un coup : ceux demandés, ou à défaut
+    tous les livres Kobo dont le titre n'est pas déjà dans la bibliothèque.
+    """
+    pipeline = get_import_pipeline()
+    product_ids = payload.product_ids if payload and payload.product_ids else None
+    if product_ids is None:
+        if not _kobo_titles:
+            _kobo_library()
+        reconcile_catalog(BOOKS_DIR)
+        rows, _ = list_books(BOOKS_DIR)
+        known_titles = {row["title"] for row in rows}
+        known_ids = {row["id"] for row in rows}
+        product_ids = [
+            pid for pid, title in _kobo_titles.items()
+            if title not in known_titles and f"{safe_book_name(title, pid)}_data" not in known_ids
+        ]
+    jobs = [pipeline.submit(pid, _kobo_titles.get(pid, "")) for pid in product_ids]
+    return JSONResponse({"jobs": [job.to_dict() for job in jobs]}, status_code=202)
 
-    return JSONResponse({"status": "synced", "highlights_count": added_count})
+@app.get("/api/kobo/import-events")
+async def kobo_import_events(request: Request):
+    """Flux SSE de la progression des imports, précédé de l'état de tous les jobs connus."""
+    _require_single_worker()
+    initial = [{"type": "import", **job} for job in _import_pipeline.snapshot()] if _import_pipeline else []
+    return StreamingResponse(
+        generate_event_stream(request, event_type=("import", "kobo_library"), initial=initial),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,51 @@
+"""
+Content-addressed image store shared by every book of the library.
+
+Images are named after the hash of their bytes, so two different pictures
+that happen to share a file name no longer overwrite each other, and the same
+picture (a re-import, another edition, a publisher logo) is stored only once.
+Blobs live under <library>/_blobs/<2 first hex chars>/<hash><ext>.
+"""
+import os
+import hashlib
+import threading
+from typing import Optional
+
+BLOBS_DIR_NAME = "_blobs"
+
+
+def blob_name(data: bytes, original_name: str) -> str:
+    """Hash of the content, keeping the original extension for media types."""
+    ext = os.path.splitext(original_name)[1].lower()
+    ext = "".join(c for c in ext if c.isalnum() or c == ".")
+    return hashlib.sha256(data).hexdigest() + ext
+
+
+def is_blob_name(name: str) -> bool:
+    digest = os.path.splitext(name)[0]
+    return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+def blob_path(library_dir: str, name: str) -> str:
+    return os.path.join(library_dir, BLOBS_DIR_NAME, name[:2], name)
+
+
+def store_blob(library_dir: str, data: bytes, original_name: str) -> str:
+    """Writes the blob unless it is already there; returns its name."""
+    name = blob_name(data, original_name)
+    path = blob_path(library_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Two imports may write the same blob at once: each uses its own temp file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return name
+
+
+def find_blob(library_dir: str, name: str) -> Optional[str]:
+    if not is_blob_name(name):
+        return None
+    path = blob_path(library_dir, name)
+    return path if os.path.exists(path) else None
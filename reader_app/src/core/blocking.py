@@ -0,0 +1,61 @@
+"""
+Bounded thread pool for the server's blocking work.
+
+Async routes hand every storage or parsing call (SQLite and pickled highlights,
+Obsidian notes, chats.json, BeautifulSoup) to run_blocking instead of running it
+on the event loop, so a slow disk or a long highlight sync never stalls the other
+requests and the chat streams in flight. The pool is bounded: a burst of requests
+queues up instead of spawning threads without limit.
+
+Work that holds a thread for seconds or minutes (LLM streams, Kobo syncs) runs on
+a second pool through run_long / iterate_long, so a few chats in flight can't take
+every thread that page loads and highlight edits wait for.
+"""
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator
+
+BLOCKING_THREADS = int(os.getenv("READER_BLOCKING_THREADS", "8"))
+LONG_THREADS = int(os.getenv("READER_LONG_THREADS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="reader-blocking")
+_long_executor = ThreadPoolExecutor(max_workers=LONG_THREADS, thread_name_prefix="reader-long")
+
+_DONE = object()
+
+
+async def _run(executor: ThreadPoolExecutor, func: Callable[..., Any], *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def _iterate(executor: ThreadPoolExecutor, iterator: Iterator) -> AsyncIterator:
+    while True:
+        item = await _run(executor, next, iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs func(*args, **kwargs) on the pool and waits for it without blocking the loop."""
+    return await _run(_executor, func, *args, **kwargs)
+
+
+async def iterate_blocking(iterator: Iterator) -> AsyncIterator:
+    """Consumes a blocking iterator (e.g. a large image read in chunks) one item per pool call."""
+    async for item in _iterate(_executor, iterator):
+        yield item
+
+
+async def run_long(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Like run_blocking, on the pool for long-running work (a Kobo sync)."""
+    return await _run(_long_executor, func, *args, **kwargs)
+
+
+async def iterate_long(iterator: Iterator) -> AsyncIterator:
+    """Consumes a slow iterator (a streamed LLM response, a library sync) on the long-running pool."""
+    async for item in _iterate(_long_executor, iterator):
+        yield item
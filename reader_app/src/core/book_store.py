@@ -0,0 +1,252 @@
+"""
+Per-chapter on-disk storage for processed books.
+
+Each book folder holds one SQLite file. The manifest (metadata, TOC and the
+spine without chapter bodies) is a single small row, and every chapter body
+lives in its own row so it can be read or rewritten without touching the rest
+of the book.
+
+Several server workers may use the same file. It stays in SQLite's default
+rollback-journal mode rather than WAL: save_book swaps in a whole new file, which
+a leftover -wal file of the old one would corrupt, and in this mode every commit
+bumps the file change counter in the header. save_book also stamps each new file
+with a generation in the header, since neither the counter of a freshly built
+file nor its (reused) inode tells two ingests apart. Together they make a cheap
+cross-process version, read by book_version.
+"""
+import os
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import replace
+from typing import Optional, Any, List, Tuple
+
+from src.core.models import Book, ChapterContent, Highlight
+from src.utils.file_lock import file_lock
+
+BOOK_DB_NAME = "book.db"
+LEGACY_PICKLE_NAME = "book.pkl"
+
+# Seconds a connection waits for another worker's write lock before failing
+BUSY_TIMEOUT = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    idx INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    href TEXT NOT NULL,
+    title TEXT NOT NULL,
+    ord INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    text TEXT NOT NULL,
+    highlights BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def get_book_db_path(book_dir: str) -> str:
+    """Returns the path to the SQLite store of a book folder."""
+    return os.path.join(book_dir, BOOK_DB_NAME)
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def book_lock(book_dir: str):
+    """
+    Serializes read-modify-writes of a book (highlight edits, Kobo sync, re-ingest)
+    across threads and server workers.
+    """
+    return file_lock(get_book_db_path(book_dir) + ".lock")
+
+
+def _set_generation(conn: sqlite3.Connection) -> None:
+    """
+    Stamps a new book file with the time it was built, in ns, across the two free
+    32-bit header fields (application_id holds the high half, user_version the low one).
+    """
+    generation = time.time_ns()
+    low = generation & 0xFFFFFFFF
+    conn.execute(f"PRAGMA application_id = {generation >> 32}")
+    # The pragma takes a signed value; the header keeps the same 4 bytes either way
+    conn.execute(f"PRAGMA user_version = {low - (1 << 32) if low >= 1 << 31 else low}")
+
+
+def book_version(book_dir: str) -> Optional[Tuple[int, int]]:
+    """
+    Changes on every committed write to the book, whichever process made it:
+    the generation save_book stamped on the file (a re-ingest builds a new one)
+    and SQLite's file change counter.
+    """
+    try:
+        with open(get_book_db_path(book_dir), "rb") as f:
+            header = f.read(72)
+    except OSError:
+        return None
+    generation = int.from_bytes(header[68:72], "big") << 32 | int.from_bytes(header[60:64], "big")
+    return generation, int.from_bytes(header[24:28], "big")
+
+
+def _manifest_of(book: Book) -> Book:
+    """Returns a copy of the book whose spine entries carry no bodies."""
+    light_spine = [replace(ch, content="", text="", highlights=[]) for ch in book.spine]
+    return replace(book, spine=light_spine)
+
+
+def _chapter_row(idx: int, chapter: ChapterContent) -> tuple:
+    return (
+        idx, chapter.id, chapter.href, chapter.title, chapter.order,
+        chapter.content, chapter.text, pickle.dumps(chapter.highlights)
+    )
+
+
+def save_book(book: Book, book_dir: str) -> None:
+    """
+    Writes a whole book (manifest and every chapter).
+    The file is built next to the final one and swapped in, so readers never see half a book.
+    """
+    os.makedirs(book_dir, exist_ok=True)
+    db_path = get_book_db_path(book_dir)
+    # Unique per writer: two threads or workers may save the same book at once
+    tmp_path = f"{db_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with closing(_connect(tmp_path)) as conn:
+        _set_generation(conn)
+        with conn:
+            conn.execute("INSERT INTO manifest (id, data) VALUES (0, ?)", (pickle.dumps(_manifest_of(book)),))
+            conn.executemany(
+                "INSERT INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [_chapter_row(i, ch) for i, ch in enumerate(book.spine)]
+            )
+    os.replace(tmp_path, db_path)
+
+
+def _migrate_legacy_pickle(book_dir: str) -> bool:
+    """Converts an old monolithic book.pkl into the per-chapter store."""
+    pkl_path = os.path.join(book_dir, LEGACY_PICKLE_NAME)
+    if not os.path.exists(pkl_path):
+        return False
+    # The first requests for a legacy book may all try to convert it, from several workers
+    with book_lock(book_dir):
+        if os.path.exists(get_book_db_path(book_dir)):
+            return True
+        with open(pkl_path, "rb") as f:
+            book = pickle.load(f)
+        save_book(book, book_dir)
+    return True
+
+
+def has_book(book_dir: str) -> bool:
+    """True if the folder contains a processed book (new store or legacy pickle)."""
+    return os.path.exists(get_book_db_path(book_dir)) or os.path.exists(os.path.join(book_dir, LEGACY_PICKLE_NAME))
+
+
+def load_manifest(book_dir: str) -> Optional[Book]:
+    """
+    Loads the book without chapter bodies.
+    Spine entries keep their id, href, title and order; content, text and highlights are empty.
+    """
+    db_path = get_book_db_path(book_dir)
+    if not os.path.exists(db_path) and not _migrate_legacy_pickle(book_dir):
+        return None
+    with closing(_connect(db_path)) as conn:
+        row = conn.execute("SELECT data FROM manifest WHERE id = 0").fetchone()
+    return pickle.loads(row[0]) if row else None
+
+
+def load_chapter(book_dir: str, idx: int) -> Optional[ChapterContent]:
+    """Loads a single spine item with its content, text and highlights."""
+    db_path = get_book_db_path(book_dir)
+    if not os.path.exists(db_path) and not _migrate_legacy_pickle(book_dir):
+        return None
+    with closing(_connect(db_path)) as conn:
+        row = conn.execute(
+            "SELECT id, href, title, ord, content, text, highlights FROM chapters WHERE idx = ?", (idx,)
+        ).fetchone()
+    if not row:
+        return None
+    return ChapterContent(
+        id=row[0], href=row[1], title=row[2], order=row[3],
+        content=row[4], text=row[5], highlights=pickle.loads(row[6])
+    )
+
+
+def load_chapters(book_dir: str) -> List[ChapterContent]:
+    """Loads every chapter with its body, in spine order."""
+    db_path = get_book_db_path(book_dir)
+    if not os.path.exists(db_path) and not _migrate_legacy_pickle(book_dir):
+        return []
+    with closing(_connect(db_path)) as conn:
+        rows = conn.execute(
+            "SELECT id, href, title, ord, content, text, highlights FROM chapters ORDER BY idx"
+        ).fetchall()
+    return [
+        ChapterContent(
+            id=row[0], href=row[1], title=row[2], order=row[3],
+            content=row[4], text=row[5], highlights=pickle.loads(row[6])
+        )
+        for row in rows
+    ]
+
+
+def save_chapter(book_dir: str, idx: int, chapter: ChapterContent) -> None:
+    """Rewrites one chapter row, leaving the manifest and the other chapters untouched."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?, ?)", _chapter_row(idx, chapter))
+
+
+def load_chapter_highlights(book_dir: str, idx: int) -> Optional[List[Highlight]]:
+    """Highlights of one chapter, without its body."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        row = conn.execute("SELECT highlights FROM chapters WHERE idx = ?", (idx,)).fetchone()
+    return pickle.loads(row[0]) if row else None
+
+
+def save_chapter_highlights(book_dir: str, idx: int, highlights: List[Highlight]) -> None:
+    """Rewrites only the highlights of a chapter; its body is left as is."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        with conn:
+            conn.execute("UPDATE chapters SET highlights = ? WHERE idx = ?", (pickle.dumps(highlights), idx))
+
+
+def count_highlights(book_dir: str) -> int:
+    """Counts the highlights stored across all chapters without loading their bodies."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        rows = conn.execute("SELECT highlights FROM chapters").fetchall()
+    return sum(len(pickle.loads(row[0])) for row in rows)
+
+
+def load_all_highlights(book_dir: str) -> List[List[Highlight]]:
+    """Highlights of every chapter, in spine order, without loading chapter bodies."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        rows = conn.execute("SELECT highlights FROM chapters ORDER BY idx").fetchall()
+    return [pickle.loads(row[0]) for row in rows]
+
+
+def get_state(book_dir: str, key: str, default: Any = None) -> Any:
+    """Reads a small JSON value stored alongside the book (e.g. Kobo sync state)."""
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+
+def set_state(book_dir: str, key: str, value: Any) -> None:
+    with closing(_connect(get_book_db_path(book_dir))) as conn:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
@@ -0,0 +1,78 @@
+"""
+In-memory LRU cache bounded by bytes rather than entry count.
+
+Entries are stored with a version (typically a file mtime): a lookup with a
+different version is a miss and drops the stale entry, so one book changing
+on disk only invalidates that book's entries. Hits, misses and evictions are
+counted for monitoring.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class ByteBudgetCache:
+    def __init__(self, max_bytes: int, max_item_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        # An entry bigger than this is returned but not kept (it would flush everything else)
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes // 4
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items: "OrderedDict[Hashable, Tuple[Any, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[Any]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[1] != version:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int, version: Any = None) -> None:
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = (value, version, size)
+            self.size += size
+            while self.size > self.max_bytes and self._items:
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, version: Any, load: Callable[[], Any], sizeof: Callable[[Any], int]) -> Any:
+        """Cached value for this key and version, loading it on a miss. None results are not cached."""
+        value = self.get(key, version)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.put(key, value, sizeof(value), version)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        """Drops every entry whose key matches, e.g. all the chapters of one book."""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self._drop(key)
+
+    def _drop(self, key: Hashable) -> None:
+        self.size -= self._items.pop(key)[2]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._items), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions
+            }
@@ -0,0 +1,152 @@
+"""
+Library catalog: one summary row per processed book.
+
+The library page and /api/library read this table instead of opening every
+book. Rows are written whenever a book is ingested or one of its chapters is
+saved.
+"""
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import List, Dict, Tuple, Optional
+
+from src.core.models import Book
+from src.core.book_store import get_book_db_path, has_book, load_manifest, count_highlights, BUSY_TIMEOUT
+from src.core.covers import find_cover, COVER_STEM
+
+CATALOG_DB_NAME = "catalog.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    language TEXT NOT NULL,
+    chapters INTEGER NOT NULL,
+    highlights INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    has_cover INTEGER NOT NULL DEFAULT 0,
+    cover_version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_COLUMNS = ["id", "title", "authors", "language", "chapters", "highlights", "mtime", "size", "updated_at", "has_cover",
+            "cover_version"]
+
+
+def get_catalog_path(library_dir: str) -> str:
+    """Returns the path to the catalog of a library folder."""
+    return os.path.join(library_dir, CATALOG_DB_NAME)
+
+
+def _connect(library_dir: str) -> sqlite3.Connection:
+    os.makedirs(library_dir, exist_ok=True)
+    conn = sqlite3.connect(get_catalog_path(library_dir), timeout=BUSY_TIMEOUT)
+    # Server workers read the catalog while another one updates a row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    # Catalogs created before covers existed, or before their URLs carried the cover's own version
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(books)")}
+    for column in ("has_cover", "cover_version"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE books ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    return conn
+
+
+def _file_stats(book_dir: str) -> Tuple[float, int]:
+    db_path = get_book_db_path(book_dir)
+    try:
+        st = os.stat(db_path)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return 0.0, 0
+
+
+def upsert_book(library_dir: str, book_id: str, book: Book, highlight_count: int) -> None:
+    """Writes (or replaces) the summary row of a book."""
+    book_dir = os.path.join(library_dir, book_id)
+    mtime, size = _file_stats(book_dir)
+    cover_path = find_cover(book_dir, COVER_STEM)
+    # Versions the cover URL: unlike mtime, it doesn't move when highlights are edited
+    cover_version = os.stat(cover_path).st_mtime_ns if cover_path else 0
+    with closing(_connect(library_dir)) as conn:
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO books ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                (book_id, book.metadata.title, ", ".join(book.metadata.authors), book.metadata.language,
+                 len(book.spine), highlight_count, mtime, size, time.time(), int(cover_path is not None), cover_version)
+            )
+
+
+def update_book_stats(library_dir: str, book_id: str, highlights_added: int) -> None:
+    """
+    Refreshes the fields that change when a chapter is rewritten.
+    The highlight count is adjusted by highlights_added (negative for removals)
+    rather than recounted, which would unpickle every chapter of the book.
+    """
+    mtime, size = _file_stats(os.path.join(library_dir, book_id))
+    with closing(_connect(library_dir)) as conn:
+        with conn:
+            conn.execute(
+                "UPDATE books SET highlights = MAX(highlights + ?, 0), mtime = ?, size = ?, updated_at = ? WHERE id = ?",
+                (highlights_added, mtime, size, time.time(), book_id)
+            )
+
+
+def remove_book(library_dir: str, book_id: str) -> None:
+    with closing(_connect(library_dir)) as conn:
+        with conn:
+            conn.execute("DELETE FROM books WHERE id = ?", (book_id,))
+
+
+def reconcile_catalog(library_dir: str) -> None:
+    """
+    Aligns the catalog with the book folders on disk.
+    Only lists the library directory; books are opened solely when a folder
+    has no row yet (new folder or first run), and rows of deleted folders are dropped.
+    """
+    if not os.path.isdir(library_dir):
+        return
+    folders = {
+        item for item in os.listdir(library_dir)
+        if item.endswith("_data") and os.path.isdir(os.path.join(library_dir, item))
+    }
+    with closing(_connect(library_dir)) as conn:
+        known = {row[0] for row in conn.execute("SELECT id FROM books")}
+    for book_id in known - folders:
+        remove_book(library_dir, book_id)
+    for book_id in folders - known:
+        book_dir = os.path.join(library_dir, book_id)
+        if not has_book(book_dir):
+            continue
+        try:
+            book = load_manifest(book_dir)
+            if book:
+                upsert_book(library_dir, book_id, book, count_highlights(book_dir))
+        except Exception as e:
+            print(f"Error indexing book {book_id}: {e}")
+
+
+def list_books(library_dir: str, query: str = "", offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict], int]:
+    """
+    Returns a page of catalog rows sorted by title, and the total number of matches.
+    The query matches title or authors, case-insensitively.
+    """
+    where = ""
+    params: list = []
+    if query:
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where = "WHERE title LIKE ? ESCAPE '\\' OR authors LIKE ? ESCAPE '\\'"
+        params = [pattern, pattern]
+    with closing(_connect(library_dir)) as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM books {where}", params).fetchone()[0]
+        sql = f"SELECT {', '.join(_COLUMNS)} FROM books {where} ORDER BY title COLLATE NOCASE, id"
+        page_params = list(params)
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            page_params += [limit, offset]
+        rows = conn.execute(sql, page_params).fetchall()
+    return [dict(zip(_COLUMNS, row)) for row in rows], total
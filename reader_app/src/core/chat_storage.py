@@ -1,10 +1,13 @@
 """Module for managing chat sessions storage."""
+import os
 import json
 import uuid
+import threading
 from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Optional
 from dataclasses import dataclass, asdict, field
+from src.utils.file_lock import file_lock
 
 
 @dataclass
@@ -31,6 +34,15 @@ def ensure_chats_dir_exists(book_id: str) -> None:
     chats_file.parent.mkdir(parents=True, exist_ok=True)
 
 
+def _sessions_lock(book_id: str):
+    """
+    Updates (load, modify, save) must not interleave: they run on the server's
+    thread pool and possibly in several workers at once.
+    """
+    ensure_chats_dir_exists(book_id)
+    return file_lock(f"{get_chats_file_path(book_id)}.lock")
+
+
 def load_chat_sessions(book_id: str) -> List[ChatSession]:
     """Load chat sessions from chats.json file."""
     chats_file = get_chats_file_path(book_id)
@@ -68,9 +80,12 @@ def save_chat_sessions(book_id: str, sessions: List[ChatSession]) -> None:
         'sessions': [asdict(session) for session in sessions]
     }
     
+    # Written aside then swapped in, so a concurrent reader never sees a partial file
+    tmp_file = chats_file.with_name(f"{chats_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
     try:
-        with open(chats_file, 'w', encoding='utf-8') as f:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, chats_file)
     except Exception as e:
         print(f"Error saving chat sessions for {book_id}: {e}")
         raise
@@ -78,8 +93,6 @@ def save_chat_sessions(book_id: str, sessions: List[ChatSession]) -> None:
 
 def create_new_session(book_id: str, chapter_index: int, title: Optional[str] = None) -> ChatSession:
     """Create a new empty chat session."""
-    sessions = load_chat_sessions(book_id)
-    
     new_session = ChatSession(
         id=str(uuid.uuid4()),
         chapter_index=chapter_index,
@@ -88,8 +101,10 @@ def create_new_session(book_id: str, chapter_index: int, title: Optional[str] =
         messages=[]
     )
     
-    sessions.append(new_session)
-    save_chat_sessions(book_id, sessions)
+    with _sessions_lock(book_id):
+        sessions = load_chat_sessions(book_id)
+        sessions.append(new_session)
+        save_chat_sessions(book_id, sessions)
     
     return new_session
 
@@ -102,22 +117,23 @@ def get_session_by_id(book_id: str, session_id: str) -> Optional[ChatSession]:
 
 def add_message_to_session(book_id: str, session_id: str, role: str, content: str) -> None:
     """Add a message to a session and save."""
-    sessions = load_chat_sessions(book_id)
-    session = next((s for s in sessions if s.id == session_id), None)
-    
-    if not session:
-        raise ValueError(f"Session {session_id} not found")
-    
-    session.messages.append({"role": role, "content": content})
-    
-    # Update title if it's still the default and we have messages
-    if len(session.messages) <= 2 and role == "user":
-        # Use first 30 characters of first user message as title
-        first_user_msg = next((m["content"] for m in session.messages if m["role"] == "user"), "")
-        if first_user_msg:
-            session.title = first_user_msg[:30] + ("..." if len(first_user_msg) > 30 else "")
-    
-    save_chat_sessions(book_id, sessions)
+    with _sessions_lock(book_id):
+        sessions = load_chat_sessions(book_id)
+        session = next((s for s in sessions if s.id == session_id), None)
+        
+        if not session:
+            raise ValueError(f"Session {session_id} not found")
+        
+        session.messages.append({"role": role, "content": content})
+        
+        # Update title if it's still the default and we have messages
+        if len(session.messages) <= 2 and role == "user":
+            # Use first 30 characters of first user message as title
+            first_user_msg = next((m["content"] for m in session.messages if m["role"] == "user"), "")
+            if first_user_msg:
+                session.title = first_user_msg[:30] + ("..." if len(first_user_msg) > 30 else "")
+        
+        save_chat_sessions(book_id, sessions)
 
 
 def get_sessions_for_chapter(book_id: str, chapter_index: int) -> List[ChatSession]:
@@ -128,7 +144,8 @@ def get_sessions_for_chapter(book_id: str, chapter_index: int) -> List[ChatSessi
 
 def delete_session(book_id: str, session_id: str) -> None:
     """Delete a session."""
-    sessions = load_chat_sessions(book_id)
-    sessions = [s for s in sessions if s.id != session_id]
-    save_chat_sessions(book_id, sessions)
+    with _sessions_lock(book_id):
+        sessions = load_chat_sessions(book_id)
+        sessions = [s for s in sessions if s.id != session_id]
+        save_chat_sessions(book_id, sessions)
 
@@ -0,0 +1,86 @@
+"""
+Cover thumbnails stored on disk.
+
+Covers are shrunk once to a fixed size and saved as JPEG, so pages never
+download full-size artwork. Images Pillow can't read (SVG covers) are stored
+as is, under their own extension.
+"""
+import io
+import os
+from typing import Optional
+
+import ebooklib
+
+from PIL import Image
+
+# File name (without extension) of the cover stored in a book folder
+COVER_STEM = "cover"
+
+# Twice the size covers are displayed at, for high-density screens
+THUMBNAIL_SIZE = (240, 360)
+
+COVER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg")
+
+MEDIA_TYPES = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+    ".gif": "image/gif", ".webp": "image/webp", ".svg": "image/svg+xml"
+}
+
+# Long-lived and immutable: cover URLs carry a version, so a new cover gets a new URL
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def make_thumbnail(data: bytes) -> Optional[bytes]:
+    """JPEG thumbnail of an image, or None if Pillow can't read it."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail(THUMBNAIL_SIZE)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=85, optimize=True)
+            return out.getvalue()
+    except Exception:
+        return None
+
+
+def save_cover(data: bytes, directory: str, stem: str, original_ext: str = ".jpg") -> str:
+    """Writes the thumbnail (or the original image if it can't be read) and returns its path."""
+    thumbnail = make_thumbnail(data)
+    ext = ".jpg" if thumbnail is not None else (original_ext.lower() if original_ext.lower() in COVER_EXTENSIONS else ".jpg")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, stem + ext)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(thumbnail if thumbnail is not None else data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def find_cover(directory: str, stem: str) -> Optional[str]:
+    for ext in COVER_EXTENSIONS:
+        path = os.path.join(directory, stem + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def media_type_of(path: str) -> str:
+    return MEDIA_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+
+def find_epub_cover(book) -> Optional["ebooklib.epub.EpubItem"]:
+    """
+    The cover image of an ebooklib book: the EPUB 3 cover-image item, then the
+    EPUB 2 <meta name="cover">, then the first image named like a cover.
+    """
+    for item in book.get_items_of_type(ebooklib.ITEM_COVER):
+        return item
+    for _, attrs in book.get_metadata('OPF', 'cover'):
+        item = book.get_item_with_id(attrs.get('content', ''))
+        if item is not None and item.get_type() in (ebooklib.ITEM_IMAGE, ebooklib.ITEM_COVER):
+            return item
+    for item in book.get_items_of_type(ebooklib.ITEM_IMAGE):
+        if 'cover' in item.get_name().lower() or 'cover' in (item.get_id() or '').lower():
+            return item
+    return None
@@ -0,0 +1,143 @@
+"""
+Book images served straight from the source EPUB.
+
+Instead of extracting every image at ingest, a book can record where each
+image lives inside its EPUB: the zip entry, the offset of its data, its sizes
+and its compression. Images are then read from the archive on request —
+stored entries are streamed as they are, deflated ones are inflated on the
+fly — and small, frequently requested images are kept in memory.
+"""
+import os
+import zlib
+import zipfile
+import posixpath
+import threading
+import mimetypes
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.core.cache import ByteBudgetCache
+from src.core.book_store import book_version, get_state, set_state
+from src.utils.zip_entries import entry_data_offset
+
+IMAGE_INDEX_KEY = "image_index"
+
+CHUNK_SIZE = 64 * 1024
+
+# Images up to this size are read whole and may be kept in the LRU; bigger ones are streamed
+MAX_CACHED_IMAGE = 1024 * 1024
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+_CONTAINER_NS = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
+
+
+def _opf_dir(archive: zipfile.ZipFile) -> str:
+    """Folder of the OPF file, which item hrefs are relative to."""
+    try:
+        root = ET.fromstring(archive.read("META-INF/container.xml"))
+        rootfile = root.find(".//c:rootfile", _CONTAINER_NS)
+        return posixpath.dirname(rootfile.get("full-path", ""))
+    except (KeyError, ET.ParseError, AttributeError):
+        return ""
+
+
+def build_image_index(epub_path: str, images: Dict[str, str]) -> Dict:
+    """
+    Locates images inside the EPUB.
+    `images` maps the served file name to the item href (relative to the OPF);
+    entries whose compression we can't stream are left out.
+    """
+    epub_path = os.path.abspath(epub_path)
+    st = os.stat(epub_path)
+    entries: Dict[str, List] = {}
+    with zipfile.ZipFile(epub_path) as archive, open(epub_path, "rb") as f:
+        opf_dir = _opf_dir(archive)
+        for name, href in images.items():
+            try:
+                info = archive.getinfo(posixpath.normpath(posixpath.join(opf_dir, href)))
+            except KeyError:
+                continue
+            if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                continue
+            entries[name] = [info.filename, entry_data_offset(f, info), info.compress_size, info.file_size, info.compress_type]
+    return {"source": epub_path, "size": st.st_size, "mtime": st.st_mtime, "images": images, "entries": entries}
+
+
+# Small, frequently requested images
+image_cache = ByteBudgetCache(IMAGE_CACHE_BYTES, MAX_CACHED_IMAGE)
+_index_cache: Dict[str, Tuple[int, Dict]] = {}
+# Books whose missing source EPUB was already reported
+_missing_sources = set()
+_index_lock = threading.Lock()
+
+
+def _load_index(book_dir: str) -> Optional[Dict]:
+    """
+    The book's image index, rebuilt if its EPUB changed since ingest.
+    Cached per book generation, which only moves on re-ingest (from any process):
+    highlight edits don't make it re-read.
+    """
+    version = book_version(book_dir)
+    if version is None:
+        return None
+    generation = version[0]
+    with _index_lock:
+        cached = _index_cache.get(book_dir)
+    if cached and cached[0] == generation:
+        index = cached[1]
+    else:
+        index = get_state(book_dir, IMAGE_INDEX_KEY)
+        if index is None:
+            return None
+    try:
+        st = os.stat(index["source"])
+    except OSError:
+        with _index_lock:
+            first = book_dir not in _missing_sources
+            _missing_sources.add(book_dir)
+        if first:
+            print(f"Warning: {index['source']} is gone; images of {book_dir} can't be served until it is re-added")
+        return None
+    if st.st_size != index["size"] or st.st_mtime != index["mtime"]:
+        # Offsets are only valid for the file they were read from
+        index = build_image_index(index["source"], index["images"])
+        set_state(book_dir, IMAGE_INDEX_KEY, index)
+    with _index_lock:
+        _missing_sources.discard(book_dir)
+        _index_cache[book_dir] = (generation, index)
+    return index
+
+
+class ArchivedImage:
+    def __init__(self, source: str, entry: List, version: float = 0):
+        self.source = source
+        # mtime of the EPUB the entry was read from
+        self.version = version
+        self.name, self.offset, self.compress_size, self.size, self.compress_type = entry
+        self.media_type = mimetypes.guess_type(self.name)[0] or "application/octet-stream"
+
+    def chunks(self) -> Iterator[bytes]:
+        """Streams the image bytes without reading the entry into memory."""
+        inflater = zlib.decompressobj(-15) if self.compress_type == zipfile.ZIP_DEFLATED else None
+        with open(self.source, "rb") as f:
+            f.seek(self.offset)
+            remaining = self.compress_size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield inflater.decompress(chunk) if inflater else chunk
+            if inflater:
+                yield inflater.flush()
+
+    def read(self) -> bytes:
+        """Whole image bytes, through the LRU. Meant for images up to MAX_CACHED_IMAGE."""
+        return image_cache.get_or_load((self.source, self.offset), self.version, lambda: b"".join(self.chunks()), len)
+
+
+def find_archived_image(book_dir: str, name: str) -> Optional[ArchivedImage]:
+    index = _load_index(book_dir)
+    if not index or name not in index["entries"]:
+        return None
+    return ArchivedImage(index["source"], index["entries"][name], index["mtime"])
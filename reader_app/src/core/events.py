@@ -0,0 +1,48 @@
+"""
+In-process event broker for pushing updates to open pages.
+
+Each server-sent-events connection subscribes a queue; publish() can be called
+from the event loop or from worker threads (sync jobs run in the threadpool)
+and fans the event out to every subscriber.
+"""
+import asyncio
+import threading
+from typing import Dict, Set, Tuple
+
+# A tab that stops reading loses events rather than growing the queue forever
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def _offer(queue: asyncio.Queue, event: Dict) -> None:
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        pass
+
+
+class EventBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        """Registers a new subscriber. Must be called from the event loop that will read the queue."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        with self._lock:
+            self._subscribers = {(loop, q) for loop, q in self._subscribers if q is not queue}
+
+    def publish(self, event: Dict) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            if loop.is_closed():
+                continue
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+
+event_broker = EventBroker()
@@ -1,89 +1,387 @@
-import re
+import bisect
 import logging
-from typing import List, Dict
-from bs4 import BeautifulSoup
+import re
+import uuid
+from typing import List, Dict, Tuple, Optional
+from bs4 import BeautifulSoup, NavigableString
 from src.core.models import Highlight
-from src.utils.text import tokenize_text, find_token_sequence
+from src.utils.text import normalize_text, tokenize_text, tokenize_with_offsets
 
 logger = logging.getLogger(__name__)
 
-def inject_highlights(soup: BeautifulSoup, highlights: List[Highlight]) -> BeautifulSoup:
+# Highlights are bucketed by their first tokens; longer keys mean fewer candidates to verify
+MAX_KEY_TOKENS = 4
+
+# Last '#id' of a Kobo container path such as 'span#kobo\.12\.3'
+_CONTAINER_ID_RE = re.compile(r'#((?:\\.|[^\s>#\\])+)')
+
+# Words never run across these: a new one starts with a block or after a line break
+_BLOCK_TAGS = {
+    'p', 'div', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'blockquote', 'pre', 'table', 'tr', 'td', 'th',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'aside', 'header', 'footer',
+    'figure', 'figcaption', 'body', 'br', 'hr'
+}
+_BREAK = object()
+
+class ChapterTextIndex:
+    """
+    Flat view of a chapter's text, built once per chapter.
+    Text nodes are laid end to end in document order: every token gets a global
+    (start, end) character range, and node_starts maps a global offset back to its text node.
+    Tokens are cut from the joined text of each block, not node by node, so a word split
+    by inline markup (a drop cap, <b>para</b>graph) is still one token.
+    Text already inside a highlight span is left out so highlights never nest.
+    """
+    def __init__(self, soup: BeautifulSoup):
+        root = soup.body or soup
+        self.nodes: List[NavigableString] = []
+        self.node_starts: List[int] = []
+        self.tokens: List[str] = []
+        self.token_starts: List[int] = []
+        self.token_ends: List[int] = []
+        parts = []
+        offset = 0
+        segment: List[str] = []
+        segment_start = 0
+        segment_block = _BREAK
+        for element in root.descendants:
+            if type(element) is not NavigableString:
+                if getattr(element, 'name', None) in _BLOCK_TAGS:
+                    segment_block = _BREAK
+                continue
+            if _is_highlighted(element):
+                segment_block = _BREAK
+                continue
+            block = _block_of(element)
+            if block is not segment_block:
+                self._tokenize("".join(segment), segment_start)
+                segment, segment_start, segment_block = [], offset, block
+            text = str(element)
+            self.nodes.append(element)
+            self.node_starts.append(offset)
+            parts.append(text)
+            segment.append(text)
+            offset += len(text)
+        self._tokenize("".join(segment), segment_start)
+        self.text = "".join(parts)
+        self._root = root
+        self._elements_by_id: Optional[Dict[str, object]] = None
+        self._node_index = {id(node): i for i, node in enumerate(self.nodes)}
+
+    def _tokenize(self, segment: str, offset: int) -> None:
+        for token, start, end in tokenize_with_offsets(segment):
+            self.tokens.append(token)
+            self.token_starts.append(offset + start)
+            self.token_ends.append(offset + end)
+
+    def element_start(self, element_id: str) -> Optional[int]:
+        """Global offset of the first indexed character inside the element with this id."""
+        if self._elements_by_id is None:
+            self._elements_by_id = {el['id']: el for el in self._root.find_all(id=True)}
+        element = self._elements_by_id.get(element_id)
+        if element is None:
+            return None
+        for node in element.find_all(string=True):
+            node_idx = self._node_index.get(id(node))
+            if node_idx is not None:
+                return self.node_starts[node_idx]
+        return None
+
+def locate_highlights(soup: BeautifulSoup, highlights: List[Highlight]) -> List[int]:
+    """
+    Finds every highlight in the chapter and records it as a character range over
+    the chapter text (hl.start, hl.end); the HTML itself is left untouched.
+    A stored range that still matches the highlight text is kept. Highlights carrying
+    Kobo container paths are then placed directly from their anchors. The others (and
+    any anchor that does not resolve) fall back to text search: the chapter is tokenized
+    once and all of them are located in a single pass, so the cost is linear in chapter
+    size plus highlight count.
+    Returns the indices of the highlights that were located.
+    """
     if not highlights:
-        return soup
+        return []
+    index = ChapterTextIndex(soup)
+    matches = _locate(index, highlights)
+    for i, (start, end) in matches.items():
+        highlights[i].start, highlights[i].end = start, end
+        if not highlights[i].id:
+            highlights[i].id = new_highlight_id(highlights[i])
+    return sorted(matches)
+
+def place_highlights(soup: BeautifulSoup, highlights: List[Highlight]) -> List[int]:
+    """Locates the highlights and wraps them in spans right away. Returns the indices placed."""
+    if not highlights:
+        return []
+    index = ChapterTextIndex(soup)
+    matches = _locate(index, highlights)
+    wrap_ranges(soup, index, [(start, end, highlights[i]) for i, (start, end) in matches.items()])
+    return sorted(matches)
+
+def _locate(index: ChapterTextIndex, highlights: List[Highlight]) -> Dict[int, Tuple[int, int]]:
+    matches: Dict[int, Tuple[int, int]] = {}
+    unanchored = []
+    for i, hl in enumerate(highlights):
+        located = stored_range(index.text, hl)
+        if located is None and hl.start_container_path:
+            located = resolve_anchor(index, hl)
+        if located:
+            matches[i] = located
+        else:
+            unanchored.append(i)
+    if unanchored:
+        found = find_highlight_ranges(index, [highlights[i] for i in unanchored])
+        for j, char_range in found.items():
+            matches[unanchored[j]] = char_range
+    return matches
+
+def stored_range(chapter_text: str, highlight: Highlight) -> Optional[Tuple[int, int]]:
+    """The highlight's recorded range, if it is valid and still covers the highlight text."""
+    start, end = highlight.start, highlight.end
+    if not (0 <= start < end <= len(chapter_text)):
+        return None
+    if highlight.text and tokenize_text(chapter_text[start:end]) != tokenize_text(highlight.text):
+        return None
+    return start, end
+
+def render_highlights(html: str, highlights: List[Highlight]) -> Tuple[str, str]:
+    """
+    Applies located highlights to clean chapter HTML.
+    Returns the HTML to display and the chapter text their ranges refer to.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    index = ChapterTextIndex(soup)
+    ranges = [(hl.start, hl.end, hl) for hl in highlights if 0 <= hl.start < hl.end <= len(index.text)]
+    if not ranges:
+        return html, index.text
+    wrap_ranges(soup, index, ranges)
+    return str(soup), index.text
+
+def insert_highlight(highlights: List[Highlight], highlight: Highlight) -> None:
+    """Inserts into a chapter's highlight list, which is kept sorted by start offset."""
+    highlights.insert(bisect.bisect_right(highlights, highlight.start, key=lambda hl: hl.start), highlight)
+
+def find_highlight_at(highlights: List[Highlight], start: int, end: int) -> Optional[int]:
+    """
+    Index of the highlight spanning [start, end) in a list sorted by start offset:
+    the exact range if there is one, else the closest highlight that covers it.
+    """
+    i = bisect.bisect_left(highlights, start, key=lambda hl: hl.start)
+    for j in range(i, len(highlights)):
+        if highlights[j].start != start:
+            break
+        if highlights[j].end == end:
+            return j
+    for j in range(bisect.bisect_right(highlights, start, key=lambda hl: hl.start) - 1, -1, -1):
+        if highlights[j].start <= start and highlights[j].end >= end:
+            return j
+    return None
+
+def new_highlight_id(highlight: Highlight) -> str:
+    return highlight.bookmark_id or uuid.uuid4().hex[:12]
+
+def ensure_highlight_ids(highlights: List[Highlight]) -> bool:
+    """Gives an id to highlights stored before ids existed. Returns True if any was added."""
+    changed = False
+    seen = set()
     for hl in highlights:
-        raw_text = hl.text.strip()
-        if not raw_text or len(raw_text) < 5:
+        if not hl.id or hl.id in seen:
+            hl.id = new_highlight_id(hl) if hl.bookmark_id not in seen else uuid.uuid4().hex[:12]
+            changed = True
+        seen.add(hl.id)
+    return changed
+
+def find_highlight_by_id(highlights: List[Highlight], highlight_id: str) -> Optional[int]:
+    """
+    Index of the highlight with that id, by linear scan. No id index is kept: an edit
+    already unpickles the chapter's whole highlight list and writes it back, so the
+    scan (and deleting from the list) is O(n) in the chapter's highlights like the rest.
+    """
+    for i, hl in enumerate(highlights):
+        if hl.id == highlight_id:
+            return i
+    return None
+
+def sort_highlights(highlights: List[Highlight]) -> None:
+    highlights.sort(key=lambda hl: hl.start)
+
+def has_baked_highlights(book) -> bool:
+    """
+    True for books stored before highlights became an overlay (Book.version below 5.0).
+    Newer books keep the publisher's own span.highlight markup, which must not be unwrapped.
+    """
+    return float(book.version) < 5.0
+
+def upgrade_chapter(chapter, baked: bool) -> bool:
+    """
+    Unbakes highlights stored in the HTML of a legacy book and gives ids to highlights
+    without one. True if it changed anything.
+    """
+    migrated = baked and migrate_baked_highlights(chapter)
+    return ensure_highlight_ids(chapter.highlights) or migrated
+
+def migrate_baked_highlights(chapter) -> bool:
+    """
+    Chapters stored before highlights became an overlay have them baked into their HTML.
+    Unwraps those spans and records each highlight's range instead.
+    Only for books where has_baked_highlights is True.
+    Returns True if the chapter changed and should be saved.
+    """
+    if 'class="highlight"' not in chapter.content and 'manual-highlight' not in chapter.content:
+        return False
+    soup = BeautifulSoup(chapter.content, 'html.parser')
+    spans = [span for span in soup.find_all('span') if _is_highlight_span(span)]
+    if not spans:
+        return False
+    for span in spans:
+        span.unwrap()
+    chapter.content = str(soup)
+    # Ranges must refer to the stored HTML as it will be parsed again at render time
+    locate_highlights(BeautifulSoup(chapter.content, 'html.parser'), chapter.highlights)
+    sort_highlights(chapter.highlights)
+    return True
+
+def resolve_anchor(index: ChapterTextIndex, highlight: Highlight) -> Optional[Tuple[int, int]]:
+    """
+    Resolves Kobo container paths (koboSpan ids) and offsets to a global character range.
+    The range is only trusted if its tokens match the highlight text, so a stale anchor
+    falls back to text search instead of highlighting the wrong passage.
+    """
+    start_id = _container_id(highlight.start_container_path)
+    end_id = _container_id(highlight.end_container_path or highlight.start_container_path)
+    if not start_id or not end_id:
+        return None
+    start_base = index.element_start(start_id)
+    end_base = index.element_start(end_id)
+    if start_base is None or end_base is None:
+        return None
+    start = start_base + highlight.start_offset
+    end = end_base + highlight.end_offset
+    if not (0 <= start < end <= len(index.text)):
+        return None
+    if highlight.text and tokenize_text(index.text[start:end]) != tokenize_text(highlight.text):
+        return None
+    return start, end
+
+def _container_id(container_path: str) -> Optional[str]:
+    matches = _CONTAINER_ID_RE.findall(container_path or "")
+    if not matches:
+        return None
+    return re.sub(r'\\(.)', r'\1', matches[-1])
+
+def find_highlight_ranges(index: ChapterTextIndex, highlights: List[Highlight]) -> Dict[int, Tuple[int, int]]:
+    """Maps highlight index -> (start, end) global character range of its first occurrence."""
+    buckets: Dict[int, Dict[tuple, List[Tuple[int, List[str]]]]] = {}
+    wanted = 0
+    for i, hl in enumerate(highlights):
+        raw_text = (hl.text or "").strip()
+        if len(raw_text) < 5:
             continue
         hl_tokens = tokenize_text(raw_text)
         if len(hl_tokens) < 2:
             continue
-        for block in soup.find_all(['p', 'div', 'li', 'blockquote', 'td', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-            block_text = block.get_text()
-            block_tokens = tokenize_text(block_text)
-            match = find_token_sequence(block_tokens, hl_tokens)
-            if match:
-                start_idx, end_idx = match
-                text_nodes = _get_text_nodes_with_tokens(block)
-                nodes_to_wrap = []
-                for node_info in text_nodes:
-                    if not (node_info['token_end'] < start_idx or node_info['token_start'] > end_idx):
-                        nodes_to_wrap.append(node_info)
-                if not nodes_to_wrap:
+        key_len = min(len(hl_tokens), MAX_KEY_TOKENS)
+        buckets.setdefault(key_len, {}).setdefault(tuple(hl_tokens[:key_len]), []).append((i, hl_tokens))
+        wanted += 1
+    if not buckets:
+        return {}
+
+    tokens = index.tokens
+    n_tokens = len(tokens)
+    found: Dict[int, Tuple[int, int]] = {}
+    for pos in range(n_tokens):
+        for key_len, table in buckets.items():
+            candidates = table.get(tuple(tokens[pos:pos + key_len]))
+            if not candidates:
+                continue
+            for hl_idx, hl_tokens in candidates:
+                if hl_idx in found:
                     continue
-                _wrap_nodes(soup, nodes_to_wrap, hl, raw_text)
-                break 
-    return soup
-
-def _get_text_nodes_with_tokens(block_element) -> List[Dict]:
-    text_nodes = []
-    current_token_idx = 0
-    for text_node in block_element.find_all(string=True):
-        # Ignorer les text nodes qui sont déjà dans un span de highlight
-        # pour éviter les spans imbriqués
-        parent = text_node.parent
-        if parent and parent.name == 'span':
-            parent_classes = parent.get('class', [])
-            if isinstance(parent_classes, list):
-                parent_classes = ' '.join(parent_classes)
-            if 'highlight' in str(parent_classes) or 'manual-highlight' in str(parent_classes):
-                continue  # Skip ce text node, il est déjà surligné
-        
-        text = str(text_node)
-        node_tokens = tokenize_text(text)
-        node_token_count = len(node_tokens)
-        if node_token_count > 0:
-            text_nodes.append({
-                'node': text_node,
-                'text': text,
-                'token_start': current_token_idx,
-                'token_end': current_token_idx + node_token_count - 1,
-                'tokens': node_tokens
-            })
-            current_token_idx += node_token_count
-    return text_nodes
-
-def _wrap_nodes(soup: BeautifulSoup, nodes_to_wrap: List[Dict], highlight: Highlight, raw_text: str):
-    if len(nodes_to_wrap) == 1:
-        node_info = nodes_to_wrap[0]
-        text_node = node_info['node']
-        escaped_text = re.escape(raw_text)
-        pattern_str = escaped_text.replace(r'\ ', r'\s+').replace("'", r"['\u2019]")
-        try:
-            pattern = re.compile(pattern_str, re.IGNORECASE)
-            if pattern.search(str(text_node)):
-                def replace_func(match):
-                    title_attr = f' title="{highlight.annotation}"' if highlight.annotation else ''
-                    return f'<span class="highlight"{title_attr}>{match.group(0)}</span>'
-                new_content = pattern.sub(replace_func, str(text_node))
-                new_tag = BeautifulSoup(new_content, 'html.parser')
-                text_node.replace_with(new_tag)
-        except re.error:
-            pass
-    else:
-        for node_info in nodes_to_wrap:
-            text_node = node_info['node']
-            attrs = {'class': 'highlight'}
-            if highlight.annotation:
-                attrs['title'] = highlight.annotation
-            wrapped = soup.new_tag('span', **attrs)
-            text_node.wrap(wrapped)
+                last = pos + len(hl_tokens) - 1
+                if last < n_tokens and tokens[pos:last + 1] == hl_tokens:
+                    found[hl_idx] = _extend_to_edges(
+                        index.text, highlights[hl_idx].text.strip(), index.token_starts[pos], index.token_ends[last]
+                    )
+        if len(found) == wanted:
+            break
+    return found
+
+def _extend_to_edges(chapter_text: str, raw_text: str, start: int, end: int) -> Tuple[int, int]:
+    """Grows a token range to the punctuation the highlight starts or ends with (quotes, final period)."""
+    raw_norm = normalize_text(raw_text)
+    raw_tokens = tokenize_with_offsets(raw_norm)
+    lead = raw_norm[:raw_tokens[0][1]]
+    trail = raw_norm[raw_tokens[-1][2]:]
+    if lead and start >= len(lead) and normalize_text(chapter_text[start - len(lead):start]) == lead:
+        start -= len(lead)
+    if trail and normalize_text(chapter_text[end:end + len(trail)]) == trail:
+        end += len(trail)
+    return start, end
+
+def wrap_ranges(soup: BeautifulSoup, index: ChapterTextIndex, ranges: List[Tuple[int, int, Highlight]]):
+    """
+    Wraps global character ranges in highlight spans, splitting text nodes at exact offsets.
+    Where ranges overlap, the one starting first keeps the overlapping characters.
+    """
+    per_node: Dict[int, List[Tuple[int, int, Highlight]]] = {}
+    for start, end, hl in ranges:
+        node_idx = max(bisect.bisect_right(index.node_starts, start) - 1, 0)
+        while node_idx < len(index.nodes) and index.node_starts[node_idx] < end:
+            node_start = index.node_starts[node_idx]
+            local_start = max(start, node_start) - node_start
+            local_end = min(end, node_start + len(index.nodes[node_idx])) - node_start
+            if local_start < local_end:
+                per_node.setdefault(node_idx, []).append((local_start, local_end, hl))
+            node_idx += 1
+
+    for node_idx, pieces in per_node.items():
+        node = index.nodes[node_idx]
+        text = str(node)
+        pieces.sort(key=lambda piece: piece[0])
+        parts = []
+        cursor = 0
+        for start, end, hl in pieces:
+            start = max(start, cursor)
+            # Whitespace between blocks stays plain text
+            if start >= end or not text[start:end].strip():
+                continue
+            if start > cursor:
+                parts.append(NavigableString(text[cursor:start]))
+            parts.append(_make_span(soup, text[start:end], hl))
+            cursor = end
+        if not parts:
+            continue
+        if cursor < len(text):
+            parts.append(NavigableString(text[cursor:]))
+        node.replace_with(*parts)
+
+def _make_span(soup: BeautifulSoup, text: str, highlight: Highlight):
+    # Highlights made in the reader also get 'manual-highlight', which the reader lets you remove
+    classes = 'highlight' if highlight.chapter_id else 'highlight manual-highlight'
+    span = soup.new_tag('span', attrs={'class': classes})
+    if highlight.id:
+        span['data-hl-id'] = highlight.id
+    if highlight.annotation:
+        span['title'] = highlight.annotation
+    span.string = text
+    return span
+
+def _block_of(text_node):
+    """Nearest block-level ancestor of a text node."""
+    for parent in text_node.parents:
+        if parent.name in _BLOCK_TAGS:
+            return parent
+    return None
+
+def _is_highlighted(text_node) -> bool:
+    # Ignorer les text nodes qui sont déjà dans un span de highlight
+    # pour éviter les spans imbriqués
+    parent = text_node.parent
+    return parent is not None and _is_highlight_span(parent)
+
+def _is_highlight_span(element) -> bool:
+    if element.name != 'span':
+        return False
+    classes = element.get('class', [])
+    if isinstance(classes, str):
+        classes = classes.split()
+    return 'highlight' in classes or 'manual-highlight' in classes
@@ -0,0 +1,155 @@
+"""
+Resized copies of book images, made on first request.
+
+The reader asks for an image at a width bucket (`?w=640`); the first request
+resizes and re-encodes it (WebP when the browser accepts it, JPEG or PNG
+otherwise) and stores the result on disk, later ones are served from there.
+Images named by content hash are the same bytes in every book that uses them,
+so their copies are shared by the whole library, next to the blob store;
+images of books imported before it keep their copies in the book folder.
+"""
+import io
+import os
+import threading
+from typing import Callable, Optional, Tuple
+
+from PIL import Image, features
+
+from src.core.blob_store import BLOBS_DIR_NAME, is_blob_name
+
+# Widths offered in srcset; requests are snapped up to the nearest one
+WIDTH_BUCKETS = (320, 640, 960, 1280)
+
+# Matches the reader column (700px minus padding)
+IMAGE_SIZES = "(max-width: 700px) 100vw, 620px"
+
+VARIANTS_DIR = "image_variants"
+
+# Resizes of different images run in parallel; the same one is only made once
+LOCK_STRIPES = 64
+
+# Vector and animated images are served as they are
+RESIZABLE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+QUALITY = {"webp": 80, "jpeg": 82}
+
+MEDIA_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+def is_resizable(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in RESIZABLE_EXTENSIONS
+
+
+def width_bucket(width: int) -> int:
+    for bucket in WIDTH_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return WIDTH_BUCKETS[-1]
+
+
+def srcset_for(src: str) -> str:
+    return ", ".join(f"{src}?w={w} {w}w" for w in WIDTH_BUCKETS)
+
+
+def variants_dir_for(book_dir: str, name: str) -> str:
+    """Where the resized copies of an image served for this book live."""
+    if is_blob_name(name):
+        library_dir = os.path.dirname(os.path.normpath(book_dir))
+        return os.path.join(library_dir, BLOBS_DIR_NAME, VARIANTS_DIR, name[:2])
+    return os.path.join(book_dir, VARIANTS_DIR)
+
+
+def webp_supported() -> bool:
+    return features.check("webp")
+
+
+def variant_format(accepts_webp: bool) -> str:
+    """Format of the resized copies served to a client (WebP when it accepts it)."""
+    return "webp" if accepts_webp and webp_supported() else "jpeg"
+
+
+def _encode(data: bytes, width: int, fmt: str) -> Optional[Tuple[bytes, str]]:
+    """
+    Resized image and its format, or None when there is nothing to gain
+    (image already narrow enough or unreadable).
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width <= width:
+                return None
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            if fmt == "jpeg" and has_alpha:
+                fmt = "png"
+            if fmt == "jpeg" and img.mode != "RGB":
+                img = img.convert("RGB")
+            elif fmt != "jpeg" and img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if has_alpha else "RGB")
+            out = io.BytesIO()
+            if fmt == "png":
+                img.save(out, "PNG", optimize=True)
+            else:
+                img.save(out, fmt.upper(), quality=QUALITY[fmt])
+            return out.getvalue(), fmt
+    except Exception:
+        return None
+
+
+class ImageVariants:
+    def __init__(self):
+        # A fixed set, so the locks don't grow with the number of variants ever made
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    @staticmethod
+    def _find(variants_dir: str, stem: str) -> Optional[str]:
+        for fmt in ("webp", "jpeg", "png", "orig"):
+            path = os.path.join(variants_dir, f"{stem}.{fmt}")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get(self, book_dir: str, name: str, width: int, accepts_webp: bool,
+            load: Callable[[], Optional[bytes]]) -> Optional[Tuple[str, str]]:
+        """
+        Path and media type of the image at the given width bucket, creating it
+        from `load()` (the original bytes) if needed.
+        None means the original should be served instead.
+        """
+        if not is_resizable(name):
+            return None
+        fmt = variant_format(accepts_webp)
+        variants_dir = variants_dir_for(book_dir, name)
+        stem = f"{name}.{width_bucket(width)}.{fmt}"
+        path = self._find(variants_dir, stem)
+        if path is None:
+            # A chapter asks for all its images at once; resize each one only once
+            with self._lock_for(os.path.join(variants_dir, stem)):
+                path = self._find(variants_dir, stem)
+                if path is None:
+                    path = self._create(variants_dir, stem, fmt, width_bucket(width), load)
+        if path is None or path.endswith(".orig"):
+            return None
+        return path, MEDIA_TYPES[os.path.splitext(path)[1][1:]]
+
+    def _create(self, variants_dir: str, stem: str, fmt: str, width: int,
+                load: Callable[[], Optional[bytes]]) -> Optional[str]:
+        data = load()
+        if data is None:
+            return None
+        encoded = _encode(data, width, fmt)
+        os.makedirs(variants_dir, exist_ok=True)
+        if encoded is None or len(encoded[0]) >= len(data):
+            # Remember that the original is as good as it gets for this width
+            path = os.path.join(variants_dir, f"{stem}.orig")
+            open(path, "wb").close()
+            return path
+        content, fmt = encoded
+        path = os.path.join(variants_dir, f"{stem}.{fmt}")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return path
@@ -7,6 +7,18 @@ class Highlight:
     annotation: str
     date: str
     chapter_id: str
+    # Kobo anchors: bookmark id and container path / character offset of both ends
+    bookmark_id: str = ""
+    start_container_path: str = ""
+    start_offset: int = 0
+    end_container_path: str = ""
+    end_offset: int = 0
+    date_modified: str = ""
+    # Character range in the chapter's clean text (ChapterTextIndex.text); -1 if not placed
+    start: int = -1
+    end: int = -1
+    # Stable id, emitted as data-hl-id (the Kobo bookmark id when there is one)
+    id: str = ""
 
 @dataclass
 class ChapterContent:
@@ -45,4 +57,5 @@ class Book:
     images: Dict[str, str]
     source_file: str
     processed_at: str
-    version: str = "4.0"
+    # 5.0: chapter HTML is stored clean, highlights are applied at render time
+    version: str = "5.0"
@@ -66,11 +66,13 @@ def add_chapter_link_to_main_note(book_title: str, chapter_title: str) -> None:
         with open(main_note_path, "w", encoding="utf-8") as f:
             f.write(content)
 
+def get_chapter_note_path(book_title: str, chapter_title: str) -> Path:
+    """Returns the path to a chapter note (which may not exist yet)."""
+    return get_book_note_dir(book_title) / get_chapter_filename(chapter_title)
+
 def get_chapter_note_content(book_title: str, chapter_title: str) -> str:
     """Gets the content of a chapter note, returns empty string if doesn't exist."""
-    book_dir = get_book_note_dir(book_title)
-    filename = get_chapter_filename(chapter_title)
-    path = book_dir / filename
+    path = get_chapter_note_path(book_title, chapter_title)
     
     if path.exists():
         with open(path, "r", encoding="utf-8") as f:
@@ -1,64 +1,241 @@
 import os
+import json
 import shutil
-import pickle
+import hashlib
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
 from datetime import datetime
 from urllib.parse import unquote
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import ebooklib
 from ebooklib import epub
 from bs4 import BeautifulSoup, Comment
 from src.core.models import Book, BookMetadata, ChapterContent, TOCEntry, Highlight
-from src.core.highlighter import inject_highlights
-from src.integrations.kobo import fetch_highlights
+from src.core.highlighter import locate_highlights, ensure_highlight_ids, insert_highlight
+from src.core.book_store import save_book, set_state, get_state, has_book, load_chapters, book_lock
+from src.core.blob_store import store_blob, blob_name
+from src.core.image_variants import is_resizable, srcset_for, IMAGE_SIZES
+from src.core.epub_images import build_image_index, IMAGE_INDEX_KEY
+from src.core.catalog import upsert_book
+from src.core.covers import find_epub_cover, save_cover, COVER_STEM, COVER_EXTENSIONS
+from src.integrations.kobo import find_volume_id, fetch_bookmarks, index_chapter_hrefs, resolve_chapter
+from src.integrations.kobo_sync import record_sync_state
 
-def parse_epub(epub_path: str, output_dir: str, fetch_kobo_highlights: bool = True) -> Book:
+# Bump when chapter rendering changes, so re-ingest rebuilds chapters made by older code
+RENDER_VERSION = "2"
+
+# Fingerprints of the chapters as last rendered, by href
+INGEST_STATE_KEY = "ingest"
+
+def parse_epub(epub_path: str, output_dir: str, fetch_kobo_highlights: bool = True, workers: int = 1,
+               extract_images: bool = True) -> Book:
+    """
+    With extract_images=False, images are left inside the EPUB and only their
+    location in the archive is recorded; they are then served from the source file.
+
+    Re-ingesting a book is incremental: a chapter whose raw document and targeted
+    highlights are unchanged since the last ingest is reused as is, and manual
+    highlights (no Kobo chapter id) are carried over to the new chapters.
+    """
     book = epub.read_epub(epub_path)
     metadata = _extract_metadata(book)
     highlights = []
+    volume_id = None
     if fetch_kobo_highlights:
-        highlights = fetch_highlights(metadata.title)
-    if os.path.exists(output_dir) and ("data" in output_dir or "library" in output_dir):
-        shutil.rmtree(output_dir)
-    images_dir = os.path.join(output_dir, 'images')
-    os.makedirs(images_dir, exist_ok=True)
-    image_map = _extract_images(book, images_dir)
-    toc_structure = _parse_toc_recursive(book.toc) or _get_fallback_toc(book)
-    # Create a map from file href to title for looking up chapter titles
-    toc_map = _create_toc_map(toc_structure)
+        volume_id = find_volume_id(metadata.title)
+        highlights = fetch_bookmarks(volume_id) if volume_id else []
+    os.makedirs(output_dir, exist_ok=True)
+    # A highlight added from the reader during re-ingest would be lost by the swap of book.db
+    with book_lock(output_dir):
+        previous, fingerprints = _previous_ingest(output_dir)
+        # Images used to be copied per book; they now live in the shared blob store
+        legacy_images_dir = os.path.join(output_dir, 'images')
+        if os.path.isdir(legacy_images_dir):
+            shutil.rmtree(legacy_images_dir)
+        library_dir = os.path.dirname(os.path.normpath(output_dir))
+        image_map, image_hrefs = _extract_images(book, library_dir, extract_images)
+        _extract_cover(book, output_dir)
+        toc_structure = _parse_toc_recursive(book.toc) or _get_fallback_toc(book)
+        # Create a map from file href to title for looking up chapter titles
+        toc_map = _create_toc_map(toc_structure)
     
-    spine_chapters = []
-    for i, spine_item in enumerate(book.spine):
-        item_id, _ = spine_item
-        item = book.get_item_with_id(item_id)
-        if not item or item.get_type() != ebooklib.ITEM_DOCUMENT:
-            continue
-        raw_content = item.get_content().decode('utf-8', errors='ignore')
-        soup = BeautifulSoup(raw_content, 'html.parser')
-        _fix_image_sources(soup, image_map)
-        _clean_html(soup)
-        inject_highlights(soup, highlights)
-        chapter_highlights = [hl for hl in highlights if hl.text[:20] in str(soup)]
-        body = soup.find('body')
-        final_html = "".join([str(x) for x in body.contents]) if body else str(soup)
-        
-        # Find the title from TOC map, fallback to "Section X" if not found
-        item_name = item.get_name()
-        chapter_title = toc_map.get(item_name, f"Section {i+1}")
-        
-        chapter = ChapterContent(
-            id=item_id, href=item_name, title=chapter_title,
-            content=final_html, text=soup.get_text(separator=' '), order=i,
-            highlights=chapter_highlights
+        # Collect the raw spine documents first so they can be processed in any order
+        jobs = []
+        for i, spine_item in enumerate(book.spine):
+            item_id, _ = spine_item
+            item = book.get_item_with_id(item_id)
+            if not item or item.get_type() != ebooklib.ITEM_DOCUMENT:
+                continue
+            # Find the title from TOC map, fallback to "Section X" if not found
+            item_name = item.get_name()
+            chapter_title = toc_map.get(item_name, f"Section {i+1}")
+            jobs.append((item_id, item_name, chapter_title, i, item.get_content()))
+
+        targets = _target_highlights(highlights, [job[1] for job in jobs])
+        kobo_count = len(highlights)
+        # Manual highlights stay with the chapter they were made in
+        highlights = list(highlights)
+        for job, target in zip(jobs, targets):
+            for hl in _manual_highlights(previous.get(job[1])):
+                target.append(len(highlights))
+                highlights.append(hl)
+
+        render_key = _render_key(image_map)
+        new_fingerprints = [_chapter_fingerprint(render_key, job[4], [highlights[j] for j in target]) for job, target in zip(jobs, targets)]
+        to_render = [k for k, job in enumerate(jobs) if job[1] not in previous or fingerprints.get(job[1]) != new_fingerprints[k]]
+        rendered = dict(zip(to_render, _render_chapters(
+            [(jobs[k][4], targets[k], jobs[k][1]) for k in to_render], image_map, highlights, workers
+        )))
+
+        spine_chapters = []
+        for k, (item_id, item_name, chapter_title, i, _) in enumerate(jobs):
+            if k in rendered:
+                final_html, text, located = rendered[k]
+                chapter = ChapterContent(
+                    id=item_id, href=item_name, title=chapter_title,
+                    content=final_html, text=text, order=i,
+                    highlights=sorted((replace(highlights[j], start=start, end=end) for j, start, end in located),
+                                      key=lambda hl: hl.start)
+                )
+                ensure_highlight_ids(chapter.highlights)
+            else:
+                chapter = replace(previous[item_name], id=item_id, title=chapter_title, order=i)
+            spine_chapters.append(chapter)
+        _place_in_other_chapters(spine_chapters, highlights[:kobo_count], targets)
+        final_book = Book(
+            metadata=metadata, spine=spine_chapters, toc=toc_structure,
+            images=image_map, source_file=os.path.basename(epub_path),
+            processed_at=datetime.now().isoformat()
         )
-        spine_chapters.append(chapter)
-    final_book = Book(
-        metadata=metadata, spine=spine_chapters, toc=toc_structure,
-        images=image_map, source_file=os.path.basename(epub_path),
-        processed_at=datetime.now().isoformat()
-    )
-    _save_pickle(final_book, output_dir)
+        save_book(final_book, output_dir)
+        set_state(output_dir, INGEST_STATE_KEY, {
+            "fingerprints": {job[1]: fp for job, fp in zip(jobs, new_fingerprints)},
+            "rendered": len(to_render), "reused": len(jobs) - len(to_render)
+        })
+        if not extract_images:
+            set_state(output_dir, IMAGE_INDEX_KEY, build_image_index(epub_path, image_hrefs))
+    if fetch_kobo_highlights:
+        record_sync_state(output_dir, volume_id, highlights, final_book)
+    upsert_book(library_dir, os.path.basename(os.path.normpath(output_dir)), final_book,
+                sum(len(ch.highlights) for ch in spine_chapters))
     return final_book
 
+def _previous_ingest(output_dir: str) -> Tuple[Dict[str, ChapterContent], Dict[str, str]]:
+    """Chapters of an earlier ingest of this book, by href, and their fingerprints."""
+    if not has_book(output_dir):
+        return {}, {}
+    try:
+        chapters = load_chapters(output_dir)
+        fingerprints = get_state(output_dir, INGEST_STATE_KEY, {}).get("fingerprints", {})
+    except Exception as e:
+        print(f"Warning: previous ingest of {output_dir} unreadable, rebuilding everything: {e}")
+        return {}, {}
+    return {ch.href: ch for ch in chapters}, fingerprints
+
+def _manual_highlights(chapter) -> List[Highlight]:
+    """Highlights made in the reader: they are not tied to a Kobo chapter."""
+    return [hl for hl in chapter.highlights if not hl.chapter_id] if chapter else []
+
+def _render_key(image_map: Dict[str, str]) -> str:
+    """What every chapter's rendering depends on besides its own document and highlights."""
+    return hashlib.sha256(f"{RENDER_VERSION}:{json.dumps(image_map, sort_keys=True)}".encode()).hexdigest()
+
+def _chapter_fingerprint(render_key: str, raw: bytes, highlights: List[Highlight]) -> str:
+    digest = hashlib.sha256(render_key.encode())
+    digest.update(raw)
+    digest.update(json.dumps([asdict(hl) for hl in highlights], sort_keys=True).encode())
+    return digest.hexdigest()
+
+def _target_highlights(highlights: List[Highlight], hrefs: List[str]) -> List[List[int]]:
+    """
+    For each spine document, the indices of the highlights to look for in it.
+    A highlight whose Kobo ContentID names a spine file only goes to that chapter;
+    the others are searched for everywhere.
+    """
+    href_index = index_chapter_hrefs(hrefs)
+    targets: List[List[int]] = [[] for _ in hrefs]
+    for j, hl in enumerate(highlights):
+        chapter_idx = resolve_chapter(hl.chapter_id, href_index)
+        if chapter_idx is None:
+            for target in targets:
+                target.append(j)
+        else:
+            targets[chapter_idx].append(j)
+    return targets
+
+def _place_in_other_chapters(chapters: List[ChapterContent], highlights: List[Highlight], targets: List[List[int]]) -> None:
+    """
+    Kobo highlights only looked for in the chapter their ContentID names, and not found
+    there, are searched for in the other chapters in spine order, as sync does. Otherwise
+    they would be recorded as unplaced and never tried again.
+    """
+    placed = {hl.bookmark_id for chapter in chapters for hl in chapter.highlights if hl.bookmark_id}
+    pinned_to = {}
+    for k, target in enumerate(targets):
+        for j in target:
+            pinned_to[j] = k if j not in pinned_to else None
+    missing = [(hl, pinned_to[j]) for j, hl in enumerate(highlights)
+               if hl.bookmark_id and hl.bookmark_id not in placed and pinned_to.get(j) is not None]
+    for k, chapter in enumerate(chapters):
+        candidates = [replace(hl) for hl, tried in missing if tried != k]
+        if not candidates:
+            continue
+        found = locate_highlights(BeautifulSoup(chapter.content, 'html.parser'), candidates)
+        for i in found:
+            insert_highlight(chapter.highlights, candidates[i])
+        ids = {candidates[i].bookmark_id for i in found}
+        missing = [(hl, tried) for hl, tried in missing if hl.bookmark_id not in ids]
+        if not missing:
+            break
+
+def _render_chapters(tasks: List[Tuple[bytes, List[int], str]], image_map: Dict[str, str], highlights: List[Highlight], workers: int) -> List[Tuple[str, str, List[Tuple[int, int, int]]]]:
+    """
+    Renders every spine document, serially or over a process pool.
+    Each task is the raw document, the indices of the highlights targeting it and its href.
+    Results come back in spine order either way, so both paths produce the same book.
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        return [_render_chapter(raw, image_map, highlights, target, href) for raw, target, href in tasks]
+    workers = min(workers, len(tasks))
+    # Ship the shared image map and highlights once per worker instead of once per chapter
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(image_map, highlights)) as executor:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        return list(executor.map(_render_chapter_in_worker, tasks, chunksize=chunksize))
+
+_worker_image_map: Dict[str, str] = {}
+_worker_highlights: List[Highlight] = []
+
+def _init_render_worker(image_map: Dict[str, str], highlights: List[Highlight]):
+    global _worker_image_map, _worker_highlights
+    _worker_image_map = image_map
+    _worker_highlights = highlights
+
+def _render_chapter_in_worker(task: Tuple[bytes, List[int], str]) -> Tuple[str, str, List[Tuple[int, int, int]]]:
+    raw, target, href = task
+    return _render_chapter(raw, _worker_image_map, _worker_highlights, target, href)
+
+def _render_chapter(raw: bytes, image_map: Dict[str, str], highlights: List[Highlight], target: List[int], href: str = "") -> Tuple[str, str, List[Tuple[int, int, int]]]:
+    """
+    Cleans one spine document and locates the targeted highlights in it.
+    Returns the body HTML (without highlights: they are applied at display time), the plain
+    text and, for each highlight found, its index and character range.
+    Highlights are returned by index so the caller can reuse its own objects.
+    """
+    raw_content = raw.decode('utf-8', errors='ignore')
+    soup = BeautifulSoup(raw_content, 'html.parser')
+    _fix_image_sources(soup, image_map, href)
+    _clean_html(soup)
+    body = soup.find('body')
+    final_html = "".join([str(x) for x in body.contents]) if body else str(soup)
+    located = []
+    if target:
+        # Ranges must refer to the stored HTML as it will be parsed again at display time
+        candidates = [replace(highlights[j]) for j in target]
+        for k in locate_highlights(BeautifulSoup(final_html, 'html.parser'), candidates):
+            located.append((target[k], candidates[k].start, candidates[k].end))
+    return final_html, soup.get_text(separator=' '), located
+
 def _extract_metadata(book_obj) -> BookMetadata:
     def get_list(key): return [x[0] for x in (book_obj.get_metadata('DC', key) or [])]
     def get_one(key): d = book_obj.get_metadata('DC', key); return d[0][0] if d else None
@@ -69,33 +246,56 @@ def _extract_metadata(book_obj) -> BookMetadata:
         identifiers=get_list('identifier'), subjects=get_list('subject')
     )
 
-def _extract_images(book, images_dir) -> Dict[str, str]:
-    image_map = {}
+def _extract_images(book, library_dir, extract: bool = True) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Returns the map used to rewrite <img> sources, and for each served file name
+    the item href in the EPUB. Images are named by content hash and, when `extract`
+    is set, written to the library's shared blob store (once per distinct image).
+    """
+    image_map, image_hrefs = {}, {}
     for item in book.get_items():
         if item.get_type() == ebooklib.ITEM_IMAGE:
-            fname = os.path.basename(item.get_name())
-            safe_fname = "".join([c for c in fname if c.isalpha() or c.isdigit() or c in '._-']).strip()
-            with open(os.path.join(images_dir, safe_fname), 'wb') as f: f.write(item.get_content())
-            image_map[item.get_name()] = f"images/{safe_fname}"
-            image_map[fname] = f"images/{safe_fname}"
-    return image_map
-
-def _fix_image_sources(soup, image_map):
+            data = item.get_content()
+            name = store_blob(library_dir, data, item.get_name()) if extract else blob_name(data, item.get_name())
+            image_map[item.get_name()] = f"images/{name}"
+            # Basename lookup is a fallback for sloppy hrefs; the first image keeps it
+            image_map.setdefault(os.path.basename(item.get_name()), f"images/{name}")
+            image_hrefs[name] = item.get_name()
+    return image_map, image_hrefs
+
+def _extract_cover(book, output_dir) -> None:
+    """Stores a cover thumbnail next to the book, for the library page."""
+    for ext in COVER_EXTENSIONS:
+        stale = os.path.join(output_dir, COVER_STEM + ext)
+        if os.path.exists(stale):
+            os.remove(stale)
+    item = find_epub_cover(book)
+    if item is not None:
+        save_cover(item.get_content(), output_dir, COVER_STEM, os.path.splitext(item.get_name())[1])
+
+def _fix_image_sources(soup, image_map, chapter_href=""):
     for img in soup.find_all('img'):
         src = img.get('src', '')
         if not src: continue
         src = unquote(src)
         fname = os.path.basename(src)
-        if src in image_map: img['src'] = image_map[src]
+        # Sources are relative to the chapter; image_map keys are relative to the OPF
+        resolved = posixpath.normpath(posixpath.join(posixpath.dirname(chapter_href), src))
+        if resolved in image_map: img['src'] = image_map[resolved]
+        elif src in image_map: img['src'] = image_map[src]
         elif fname in image_map: img['src'] = image_map[fname]
+        else: continue
+        # Let the browser pick a resized copy matching the reader column
+        if is_resizable(img['src']):
+            img['srcset'] = srcset_for(img['src'])
+            img['sizes'] = IMAGE_SIZES
+        img['loading'] = 'lazy'
+        img['decoding'] = 'async'
 
 def _clean_html(soup):
     for tag in soup(['script', 'style', 'iframe', 'video', 'nav', 'form', 'button']): tag.decompose()
     for comment in soup.find_all(string=lambda text: isinstance(text, Comment)): comment.extract()
 
-def _save_pickle(book: Book, output_dir: str):
-    with open(os.path.join(output_dir, 'book.pkl'), 'wb') as f: pickle.dump(book, f)
-
 def _create_toc_map(toc_entries: List[TOCEntry]) -> Dict[str, str]:
     """Creates a mapping from file_href to title from TOC entries."""
     toc_map = {}
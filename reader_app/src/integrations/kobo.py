@@ -1,8 +1,12 @@
 import sqlite3
 import os
+import threading
 from pathlib import Path
-from typing import List, Optional
+from urllib.parse import unquote
+from typing import List, Dict, Tuple, Optional
 from src.core.models import Highlight
+from src.integrations.kobo_db import KoboDatabase
+from src.utils.paths import get_project_root
 
 def get_kobo_db_path() -> Optional[Path]:
     base = Path(os.path.expanduser("~/Library/Application Support/Kobo/Kobo Desktop Edition"))
@@ -12,28 +16,120 @@ def get_kobo_db_path() -> Optional[Path]:
             return p
     return None
 
-def fetch_highlights(book_title: str) -> List[Highlight]:
+def highlight_from_row(row) -> Highlight:
+    """Builds a Highlight from a Bookmark row selected with BOOKMARK_COLUMNS."""
+    return Highlight(
+        text=row[0], annotation=row[1], chapter_id=row[2], date=row[3],
+        bookmark_id=row[4] or "",
+        start_container_path=row[5] or "", start_offset=int(row[6] or 0),
+        end_container_path=row[7] or "", end_offset=int(row[8] or 0),
+        date_modified=row[9] or ""
+    )
+
+def get_content_path(content_id: str) -> str:
+    """
+    Extracts the spine file path from a Kobo ContentID.
+    ContentIDs look like '<volume>!OEBPS!Text/ch01.xhtml' or '<volume>!!OEBPS/Text/ch01.xhtml'.
+    """
+    if not content_id or '!' not in content_id:
+        return ""
+    parts = [p for p in content_id.split('!')[1:] if p]
+    return unquote("/".join(parts).split('#')[0])
+
+def index_chapter_hrefs(hrefs: List[str]) -> Dict[str, List[Tuple[int, str]]]:
+    """Indexes spine hrefs by file name so bookmarks can be resolved without scanning the spine."""
+    href_index: Dict[str, List[Tuple[int, str]]] = {}
+    for idx, href in enumerate(hrefs):
+        href_index.setdefault(os.path.basename(href), []).append((idx, href))
+    return href_index
+
+def resolve_chapter(content_id: str, href_index: Dict[str, List[Tuple[int, str]]]) -> Optional[int]:
+    """Returns the spine position a bookmark ContentID points to, or None if it can't be matched."""
+    path = get_content_path(content_id)
+    if not path:
+        return None
+    for idx, href in href_index.get(os.path.basename(path), []):
+        if path == href or path.endswith('/' + href) or href.endswith('/' + path):
+            return idx
+    return None
+
+_shared_db: Optional[KoboDatabase] = None
+_shared_lock = threading.Lock()
+
+def get_kobo_db() -> Optional[KoboDatabase]:
+    """
+    Returns the shared read-only handle on the Kobo database, or None if it can't be found.
+    KOBO_DB_MODE=snapshot reads a copy under data/kobo instead of Kobo's own file.
+    """
+    global _shared_db
     db_path = get_kobo_db_path()
     if not db_path:
+        return None
+    mode = os.getenv("KOBO_DB_MODE", "readonly")
+    with _shared_lock:
+        if _shared_db is None or _shared_db.db_path != db_path or _shared_db.mode != mode:
+            if _shared_db is not None:
+                _shared_db.close()
+            _shared_db = KoboDatabase(db_path, mode=mode, snapshot_dir=get_project_root() / "data" / "kobo")
+        return _shared_db
+
+def find_volume_id(book_title: str) -> Optional[str]:
+    """Finds the Kobo VolumeID of a book by exact title, then by partial title."""
+    db = get_kobo_db()
+    if not db:
+        return None
+    try:
+        return db.find_volume_id(book_title)
+    except sqlite3.Error as e:
+        print(f"SQLite Error: {e}")
+        return None
+
+def fetch_bookmarks(volume_id: str, since: str = "") -> List[Highlight]:
+    """
+    Highlights of a volume, oldest first.
+    With `since`, only rows created or modified after that Kobo timestamp are returned.
+    """
+    db = get_kobo_db()
+    if not db or not volume_id:
         return []
-    results = []
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT ContentID, Title FROM content WHERE Title = ? AND ContentType = 6 LIMIT 1", (book_title,))
-        book_row = cursor.fetchone()
-        if not book_row:
-            cursor.execute("SELECT ContentID, Title FROM content WHERE Title LIKE ? AND ContentType = 6 LIMIT 1", (f"%{book_title}%",))
-            book_row = cursor.fetchone()
-        if not book_row:
-            conn.close()
-            return []
-        volume_id = book_row[0].split('!')[0]
-        cursor.execute("SELECT Text, Annotation, ContentID, DateCreated FROM Bookmark WHERE VolumeID = ? AND Type = 'highlight' ORDER BY DateCreated", (volume_id,))
-        rows = cursor.fetchall()
-        for row in rows:
-            results.append(Highlight(text=row[0], annotation=row[1], chapter_id=row[2], date=row[3]))
-        conn.close()
+        return [highlight_from_row(row) for row in db.bookmarks(volume_id, since)]
     except sqlite3.Error as e:
         print(f"SQLite Error: {e}")
-    return results
+        return []
+
+def find_volume_ids(db: KoboDatabase, titles: List[str]) -> Dict[str, str]:
+    """
+    Resolves many book titles to VolumeIDs with a single query.
+    Exact titles win; otherwise the first Kobo title containing ours (like LIKE '%title%').
+    """
+    if not titles:
+        return {}
+    by_title: Dict[str, str] = {}
+    for volume_id, title in db.list_volumes():
+        if title:
+            by_title.setdefault(title, volume_id)
+    resolved = {}
+    for title in titles:
+        if title in by_title:
+            resolved[title] = by_title[title]
+            continue
+        needle = title.lower()
+        for kobo_title, volume_id in by_title.items():
+            if needle in kobo_title.lower():
+                resolved[title] = volume_id
+                break
+    return resolved
+
+def fetch_bookmarks_grouped(db: KoboDatabase, volume_ids: List[str], since: str = "") -> Dict[str, List[Highlight]]:
+    """Highlights of several volumes, grouped by VolumeID (oldest first within a volume)."""
+    grouped: Dict[str, List[Highlight]] = {}
+    for row in db.bookmarks_for_volumes(volume_ids, since):
+        grouped.setdefault(row[0], []).append(highlight_from_row(row[1:]))
+    return grouped
+
+def fetch_highlights(book_title: str) -> List[Highlight]:
+    volume_id = find_volume_id(book_title)
+    if not volume_id:
+        return []
+    return fetch_bookmarks(volume_id)
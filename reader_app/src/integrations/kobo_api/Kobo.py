@@ -2,6 +2,7 @@ from .Globals import Globals
 from .KoboDrmRemover import KoboDrmRemover
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from typing import Dict, Tuple
 import base64
@@ -75,6 +76,13 @@ class Kobo:
 		self.Session = SessionWithTimeOut()
 		self.Session.headers.update( headers )
 
+	# Concurrent downloads share the session. Without a bigger pool urllib3 keeps only 10 connections per host and
+	# drops the extra ones after each request.
+	def SetConnectionPoolSize( self, size: int ) -> None:
+		adapter = HTTPAdapter( pool_connections = size, pool_maxsize = size )
+		self.Session.mount( "https://", adapter )
+		self.Session.mount( "http://", adapter )
+
 	# This could be added to the session but then we would need to add { "Authorization": None } headers to all other
 	# functions that doesn't need authorization.
 	@staticmethod
@@ -256,7 +264,9 @@ class Kobo:
 		jsonResponse = response.json()
 		return jsonResponse
 
-	def __GetMyBookListPage( self, syncToken: str ) -> Tuple[ list, str ]:
+	# Returns the page, the sync token to send next and whether more pages follow. The token is kept even when the
+	# sync is finished: sending it later returns only what changed since.
+	def __GetMyBookListPage( self, syncToken: str ) -> Tuple[ list, str, bool ]:
 		Globals.Logger.debug( "Kobo.__GetMyBookListPage" )
 
 		url = self.InitializationSettings[ "library_sync" ]
@@ -270,27 +280,31 @@ class Kobo:
 		response.raise_for_status()
 		bookList = response.json()
 
-		syncToken = ""
-		syncResult = response.headers.get( "x-kobo-sync" )
-		if syncResult == "continue":
-			syncToken = response.headers.get( "x-kobo-synctoken", "" )
-
-		return bookList, syncToken
+		nextSyncToken = response.headers.get( "x-kobo-synctoken", "" )
+		hasMore = response.headers.get( "x-kobo-sync" ) == "continue" and len( nextSyncToken ) > 0
+		return bookList, nextSyncToken, hasMore
 
 	def GetMyBookList( self ) -> list:
 		# The "library_sync" name and the synchronization tokens make it somewhat suspicious that we should use
 		# "library_items" instead to get the My Books list, but "library_items" gives back less info (even with the
 		# embed=ProductMetadata query parameter set).
 
+		fullBookList, _ = self.GetMyBookListChanges( "" )
+		return fullBookList
+
+	# Returns the library sync entries since syncToken (the whole library when it is empty) and the token to use for
+	# the next call.
+	def GetMyBookListChanges( self, syncToken: str ) -> Tuple[ list, str ]:
 		fullBookList = []
-		syncToken = ""
 		while True:
-			bookList, syncToken = self.__GetMyBookListPage( syncToken )
+			bookList, nextSyncToken, hasMore = self.__GetMyBookListPage( syncToken )
 			fullBookList += bookList
-			if len( syncToken ) == 0:
+			if len( nextSyncToken ) > 0:
+				syncToken = nextSyncToken
+			if not hasMore:
 				break
 
-		return fullBookList
+		return fullBookList, syncToken
 
 	def GetMyWishList( self ) -> list:
 		Globals.Logger.debug( "Kobo.GetMyWishList" )
@@ -373,6 +387,16 @@ class Kobo:
 
 		raise KoboException( message )
 
+	# Returns the download URL, whether the file has DRM and the content keys needed to remove it.
+	# The URL is signed and expires, so callers that retry for a long time should ask for a new one.
+	def GetDownloadDetails( self, productId: str, displayProfile: str ) -> Tuple[ str, bool, Dict[ str, str ] ]:
+		Globals.Logger.debug( "Kobo.GetDownloadDetails" )
+
+		jsonResponse = self.__GetContentAccessBook( productId, displayProfile )
+		contentKeys = Kobo.__GetContentKeys( jsonResponse )
+		downloadUrl, hasDrm = Kobo.__GetDownloadInfo( productId, jsonResponse )
+		return downloadUrl, hasDrm, contentKeys
+
 	def __DownloadToFile( self, url, outputPath: str ) -> None:
 		Globals.Logger.debug( "Kobo.__DownloadToFile" )
 
@@ -387,9 +411,7 @@ class Kobo:
 	def Download( self, productId: str, displayProfile: str, outputPath: str ) -> None:
 		Globals.Logger.debug( "Kobo.Download" )
 
-		jsonResponse = self.__GetContentAccessBook( productId, displayProfile )
-		contentKeys = Kobo.__GetContentKeys( jsonResponse )
-		downloadUrl, hasDrm = Kobo.__GetDownloadInfo( productId, jsonResponse )
+		downloadUrl, hasDrm, contentKeys = self.GetDownloadDetails( productId, displayProfile )
 
 		temporaryOutputPath = outputPath + ".downloading"
 
@@ -398,7 +420,7 @@ class Kobo:
 
 			if hasDrm:
 				drmRemover = KoboDrmRemover( Globals.Settings.DeviceId, Globals.Settings.UserId )
-				drmRemover.RemoveDrm( temporaryOutputPath, outputPath, contentKeys )
+				drmRemover.RemoveDrmStreaming( temporaryOutputPath, outputPath, contentKeys )
 				os.remove( temporaryOutputPath )
 			else:
 				os.rename( temporaryOutputPath, outputPath )
@@ -1,14 +1,24 @@
 from Crypto.Cipher import AES
 from Crypto.Util import Padding
 
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Tuple
 import base64
 import binascii
+import copy
 import hashlib
+import os
+import tempfile
 import zipfile
+import zlib
+
+from src.utils.zip_entries import entry_data_offset
 
 # Based on obok.py by Physisticated.
 class KoboDrmRemover:
+	# Must be a multiple of the AES block size.
+	ChunkSize = 1024 * 1024
+
 	def __init__( self, deviceId: str, userId: str ):
 		self.DeviceIdUserIdKey = KoboDrmRemover.__MakeDeviceIdUserIdKey( deviceId, userId )
 
@@ -18,15 +28,72 @@ class KoboDrmRemover:
 		key = hashlib.sha256( deviceIdUserId ).hexdigest()
 		return binascii.a2b_hex( key[ 32: ] )
 
-	def __DecryptContents( self, contents: bytes, contentKeyBase64: str ) -> bytes:
+	def __GetContentCipher( self, contentKeyBase64: str ):
 		contentKey = base64.b64decode( contentKeyBase64 )
 		keyAes = AES.new( self.DeviceIdUserIdKey, AES.MODE_ECB )
 		decryptedContentKey = keyAes.decrypt( contentKey )
+		return AES.new( decryptedContentKey, AES.MODE_ECB )
 
-		contentAes = AES.new( decryptedContentKey, AES.MODE_ECB )
+	def __DecryptContents( self, contents: bytes, contentKeyBase64: str ) -> bytes:
+		contentAes = self.__GetContentCipher( contentKeyBase64 )
 		decryptedContents = contentAes.decrypt( contents )
 		return Padding.unpad( decryptedContents, AES.block_size, "pkcs7" )
 
+	# Decrypts one entry chunk by chunk into a raw deflate stream. ECB blocks are independent, so only the last block
+	# has to be held back until the end to remove the padding.
+	# Returns the CRC, compressed size and uncompressed size of the decrypted contents.
+	def __DecryptEntryToFile( self, inputPath: str, zipInfo: zipfile.ZipInfo, contentKeyBase64: str, outputFile: BinaryIO ) -> Tuple[ int, int, int ]:
+		contentAes = self.__GetContentCipher( contentKeyBase64 )
+		compressor = zlib.compressobj( zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15 )
+		crc = 0
+		fileSize = 0
+		compressSize = 0
+		pending = b""
+
+		def Emit( decrypted: bytes ) -> None:
+			nonlocal crc, fileSize, compressSize
+			crc = zlib.crc32( decrypted, crc )
+			fileSize += len( decrypted )
+			compressed = compressor.compress( decrypted )
+			compressSize += len( compressed )
+			outputFile.write( compressed )
+
+		# Each call opens its own handle so entries can be decrypted in parallel.
+		with zipfile.ZipFile( inputPath, "r" ) as inputZip, inputZip.open( zipInfo ) as source:
+			while True:
+				chunk = source.read( KoboDrmRemover.ChunkSize )
+				if len( chunk ) == 0:
+					break
+				pending += chunk
+				usable = ( len( pending ) // AES.block_size - 1 ) * AES.block_size
+				if usable > 0:
+					Emit( contentAes.decrypt( pending[ :usable ] ) )
+					pending = pending[ usable: ]
+
+		Emit( Padding.unpad( contentAes.decrypt( pending ), AES.block_size, "pkcs7" ) )
+		compressed = compressor.flush()
+		compressSize += len( compressed )
+		outputFile.write( compressed )
+		return crc, compressSize, fileSize
+
+	# Writes an entry whose compressed bytes are already known, without going through a compressor.
+	@staticmethod
+	def __WriteRawEntry( outputZip: zipfile.ZipFile, zipInfo: zipfile.ZipInfo, source: BinaryIO, length: int ) -> None:
+		# The sizes are in the header, so there is no data descriptor after the data.
+		zipInfo.flag_bits &= ~0x08
+		zipInfo.header_offset = outputZip.fp.tell()
+		outputZip.fp.write( zipInfo.FileHeader() )
+		remaining = length
+		while remaining > 0:
+			chunk = source.read( min( KoboDrmRemover.ChunkSize, remaining ) )
+			if len( chunk ) == 0:
+				raise zipfile.BadZipFile( "Unexpected end of data for '%s'." % zipInfo.filename )
+			outputZip.fp.write( chunk )
+			remaining -= len( chunk )
+		outputZip.filelist.append( zipInfo )
+		outputZip.NameToInfo[ zipInfo.filename ] = zipInfo
+		outputZip.start_dir = outputZip.fp.tell()
+
 	def RemoveDrm( self, inputPath: str, outputPath: str, contentKeys: Dict[ str, str ] ) -> None:
 		with zipfile.ZipFile( inputPath, "r" ) as inputZip:
 			with zipfile.ZipFile( outputPath, "w", zipfile.ZIP_DEFLATED ) as outputZip:
@@ -36,3 +103,47 @@ class KoboDrmRemover:
 					if contentKeyBase64 is not None:
 						contents = self.__DecryptContents( contents, contentKeyBase64 )
 					outputZip.writestr( filename, contents )
+
+	# Same output as RemoveDrm, with memory use independent of the book size: entries without a content key are copied
+	# as they are, compressed bytes included, and encrypted entries are decrypted in chunks to temporary files, on
+	# several threads if workers > 1.
+	def RemoveDrmStreaming( self, inputPath: str, outputPath: str, contentKeys: Dict[ str, str ], workers: int = 1 ) -> None:
+		with zipfile.ZipFile( inputPath, "r" ) as inputZip:
+			zipInfos = inputZip.infolist()
+
+		encryptedInfos = [ zipInfo for zipInfo in zipInfos if zipInfo.filename in contentKeys ]
+
+		with tempfile.TemporaryDirectory( dir = os.path.dirname( os.path.abspath( outputPath ) ) ) as temporaryDirectory:
+			def Decrypt( index: int, zipInfo: zipfile.ZipInfo ) -> Tuple[ str, int, int, int ]:
+				temporaryPath = os.path.join( temporaryDirectory, "%d.deflate" % index )
+				with open( temporaryPath, "wb" ) as temporaryFile:
+					crc, compressSize, fileSize = self.__DecryptEntryToFile( inputPath, zipInfo, contentKeys[ zipInfo.filename ], temporaryFile )
+				return temporaryPath, crc, compressSize, fileSize
+
+			with ThreadPoolExecutor( max_workers = max( 1, workers ) ) as executor:
+				decrypted = {}
+				if workers > 1:
+					for index, zipInfo in enumerate( encryptedInfos ):
+						decrypted[ zipInfo.filename ] = executor.submit( Decrypt, index, zipInfo )
+
+				with open( inputPath, "rb" ) as inputFile, zipfile.ZipFile( outputPath, "w", zipfile.ZIP_DEFLATED ) as outputZip:
+					for index, zipInfo in enumerate( zipInfos ):
+						if zipInfo.filename not in contentKeys:
+							inputFile.seek( entry_data_offset( inputFile, zipInfo ) )
+							KoboDrmRemover.__WriteRawEntry( outputZip, copy.copy( zipInfo ), inputFile, zipInfo.compress_size )
+							continue
+
+						if zipInfo.filename in decrypted:
+							temporaryPath, crc, compressSize, fileSize = decrypted.pop( zipInfo.filename ).result()
+						else:
+							temporaryPath, crc, compressSize, fileSize = Decrypt( index, zipInfo )
+
+						outputInfo = zipfile.ZipInfo( zipInfo.filename, zipInfo.date_time )
+						outputInfo.compress_type = zipfile.ZIP_DEFLATED
+						outputInfo.external_attr = zipInfo.external_attr
+						outputInfo.CRC = crc
+						outputInfo.compress_size = compressSize
+						outputInfo.file_size = fileSize
+						with open( temporaryPath, "rb" ) as temporaryFile:
+							KoboDrmRemover.__WriteRawEntry( outputZip, outputInfo, temporaryFile, compressSize )
+						os.remove( temporaryPath )
@@ -0,0 +1,63 @@
+"""
+Local cache of Kobo store covers.
+
+Each cover is fetched once through the Kobo session and kept as a thumbnail
+under data/kobo/covers. File names carry a hash of the cover URL, so a cover
+that changes on Kobo's side is fetched again under a new name.
+"""
+import os
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from src.core.covers import save_cover, find_cover, THUMBNAIL_SIZE
+from src.utils.paths import get_project_root
+
+COVERS_DIR = get_project_root() / "data" / "kobo" / "covers"
+
+
+def cover_version(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()[:10]
+
+
+def sized_cover_url(url: str) -> str:
+    """Kobo image URLs may be templates; ask the CDN for the thumbnail size directly."""
+    width, height = THUMBNAIL_SIZE
+    return (url.replace("{Width}", str(width)).replace("{Height}", str(height))
+               .replace("{Quality}", "85").replace("{IsGreyscale}", "false"))
+
+
+class KoboCoverCache:
+    def __init__(self, session: requests.Session, covers_dir: Path = COVERS_DIR):
+        self.session = session
+        self.covers_dir = str(covers_dir)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, product_id: str, url: str) -> Optional[str]:
+        """Path of the cached thumbnail, fetching it first if needed. None if the cover can't be fetched."""
+        stem = f"{product_id}-{cover_version(url)}"
+        path = find_cover(self.covers_dir, stem)
+        if path:
+            return path
+        # Pages ask for many covers at once; fetch each one only once
+        with self._lock_for(stem):
+            path = find_cover(self.covers_dir, stem)
+            if path:
+                return path
+            try:
+                response = self.session.get(sized_cover_url(url), timeout=15)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print(f"[Kobo] Cover fetch failed for {product_id}: {e}")
+                return None
+            ext = os.path.splitext(urlparse(url).path)[1] or ".jpg"
+            return save_cover(response.content, self.covers_dir, stem, ext)
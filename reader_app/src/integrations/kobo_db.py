@@ -0,0 +1,151 @@
+"""
+Read-only access to the Kobo Desktop database.
+
+Kobo Desktop keeps Kobo.sqlite open and writes to it while it runs, so this
+layer never opens that file for writing. In "readonly" mode it is opened
+through a `mode=ro` URI; in "snapshot" mode a consistent copy is taken with
+the SQLite backup API whenever the file changes, and the copy is read as
+immutable (no locks at all on Kobo's file between snapshots).
+
+Either way one connection is kept per file version and shared by every caller,
+so the statements below stay prepared in sqlite3's statement cache from one
+sync to the next.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+BOOKMARK_COLUMNS = "Text, Annotation, ContentID, DateCreated, BookmarkID, StartContainerPath, StartOffset, EndContainerPath, EndOffset, DateModified"
+
+SNAPSHOT_NAME = "Kobo.snapshot.sqlite"
+MODES = ("readonly", "snapshot")
+
+# VolumeID lists are padded to this size so every chunk reuses the same prepared statement
+_IN_CHUNK = 500
+
+_SQL_VOLUME_BY_TITLE = "SELECT ContentID FROM content WHERE Title = ? AND ContentType = 6 LIMIT 1"
+_SQL_VOLUME_LIKE_TITLE = "SELECT ContentID FROM content WHERE Title LIKE ? AND ContentType = 6 LIMIT 1"
+_SQL_VOLUMES = "SELECT ContentID, Title FROM content WHERE ContentType = 6"
+_SQL_BOOKMARKS = (
+    f"SELECT {BOOKMARK_COLUMNS} FROM Bookmark WHERE VolumeID = ? AND Type = 'highlight' "
+    "AND (DateCreated >= ? OR DateModified >= ?) ORDER BY DateCreated"
+)
+_SQL_BOOKMARKS_IN = (
+    f"SELECT VolumeID, {BOOKMARK_COLUMNS} FROM Bookmark "
+    f"WHERE VolumeID IN ({', '.join('?' for _ in range(_IN_CHUNK))}) AND Type = 'highlight' "
+    "AND (DateCreated >= ? OR DateModified >= ?) ORDER BY VolumeID, DateCreated"
+)
+
+
+def _volume_of(content_id: str) -> str:
+    return content_id.split('!')[0]
+
+
+class KoboDatabase:
+    """
+    Shared, read-only handle on a Kobo database file.
+    Safe to use from several threads: queries are serialized on one connection.
+    """
+
+    def __init__(self, db_path: Path, mode: str = "readonly", snapshot_dir: Optional[Path] = None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown Kobo database mode: {mode}")
+        if mode == "snapshot" and snapshot_dir is None:
+            raise ValueError("Snapshot mode needs a snapshot directory")
+        self.db_path = Path(db_path)
+        self.mode = mode
+        self.snapshot_dir = Path(snapshot_dir) if snapshot_dir else None
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._opened_for: Optional[Tuple] = None
+
+    def version(self) -> Tuple:
+        """
+        Identifies the current state of the Kobo file: mtime and size of the database
+        and of its WAL, since committed writes may only reach the WAL for a while.
+        """
+        parts: list = []
+        for suffix in ("", "-wal"):
+            try:
+                st = os.stat(str(self.db_path) + suffix)
+                parts += [st.st_ino, st.st_mtime_ns, st.st_size]
+            except OSError:
+                parts += [0, 0, 0]
+        return tuple(parts)
+
+    def _open_readonly(self) -> sqlite3.Connection:
+        uri = self.db_path.resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def _open_snapshot(self) -> sqlite3.Connection:
+        """Copies the live database with the backup API and opens the copy."""
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        target = self.snapshot_dir / SNAPSHOT_NAME
+        tmp = target.with_name(target.name + ".tmp")
+        if tmp.exists():
+            tmp.unlink()
+        with closing(self._open_readonly()) as src, closing(sqlite3.connect(str(tmp))) as dst:
+            src.backup(dst)
+        os.replace(tmp, target)
+        return sqlite3.connect(target.resolve().as_uri() + "?immutable=1", uri=True, check_same_thread=False)
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the cached connection, reopening it only when needed.
+        A read-only connection already sees Kobo's new commits, so it is only reopened
+        if the file was replaced; a snapshot is retaken whenever the file changed.
+        """
+        with self._lock:
+            version = self.version()
+            key = version if self.mode == "snapshot" else (version[0],)
+            if self._conn is None or key != self._opened_for:
+                self.close()
+                self._conn = self._open_snapshot() if self.mode == "snapshot" else self._open_readonly()
+                self._opened_for = key
+            return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._opened_for = None
+
+    def execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Runs a query on the shared connection; a failed connection is dropped so the next call reopens it."""
+        with self._lock:
+            try:
+                return self.connection().execute(sql, params).fetchall()
+            except sqlite3.Error:
+                self.close()
+                raise
+
+    # --- Queries ---
+
+    def find_volume_id(self, title: str) -> Optional[str]:
+        """VolumeID of a book by exact title, then by partial title."""
+        rows = self.execute(_SQL_VOLUME_BY_TITLE, (title,)) or self.execute(_SQL_VOLUME_LIKE_TITLE, (f"%{title}%",))
+        return _volume_of(rows[0][0]) if rows else None
+
+    def list_volumes(self) -> List[Tuple[str, str]]:
+        """(VolumeID, title) of every book in the Kobo library."""
+        return [(_volume_of(content_id), title) for content_id, title in self.execute(_SQL_VOLUMES)]
+
+    def bookmarks(self, volume_id: str, since: str = "") -> List[tuple]:
+        """Highlight rows (BOOKMARK_COLUMNS) of a volume created or modified after `since`, oldest first."""
+        return self.execute(_SQL_BOOKMARKS, (volume_id, since, since))
+
+    def bookmarks_for_volumes(self, volume_ids: List[str], since: str = "") -> List[tuple]:
+        """Same as bookmarks() for several volumes; each row starts with its VolumeID."""
+        rows: List[tuple] = []
+        for i in range(0, len(volume_ids), _IN_CHUNK):
+            chunk = list(volume_ids[i:i + _IN_CHUNK])
+            # Kobo VolumeIDs are never empty, so the padding matches nothing
+            chunk += [""] * (_IN_CHUNK - len(chunk))
+            rows.extend(self.execute(_SQL_BOOKMARKS_IN, (*chunk, since, since)))
+        return rows
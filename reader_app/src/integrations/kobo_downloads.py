@@ -0,0 +1,181 @@
+"""
+Concurrent, resumable downloads of Kobo books.
+
+Downloads run on a thread pool over the Kobo session's connection pool. Each
+book is written to `<file>.downloading` first; after a dropped connection the
+next attempt asks only for the missing bytes with an HTTP Range request. A
+finished file is checked (size announced by the server, CRC of every zip
+entry) and its SHA-256 is reported.
+
+DRM is not touched here: the raw file is returned with its content keys so
+decryption can run as a separate stage.
+"""
+import os
+import time
+import random
+import hashlib
+import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional
+
+import requests
+
+from src.integrations.kobo_api.Kobo import Kobo
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 256
+
+# Called with (product_id, bytes_done, bytes_total); bytes_total is 0 while unknown
+ProgressCallback = Callable[[str, int, int], None]
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass
+class DownloadResult:
+    product_id: str
+    path: Optional[str] = None
+    has_drm: bool = False
+    content_keys: Dict[str, str] = field(default_factory=dict)
+    size: int = 0
+    sha256: str = ""
+    resumed_from: int = 0
+    attempts: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def raw_download_path(output_dir: str, product_id: str, has_drm: bool) -> str:
+    """Where the downloaded file lands; DRM-protected files keep a suffix until they are decrypted."""
+    return os.path.join(output_dir, f"{product_id}.drm.epub" if has_drm else f"{product_id}.epub")
+
+
+def _sha256_of(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _verify_archive(path: str) -> None:
+    """Raises DownloadError unless every entry of the zip matches its CRC."""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+    except (zipfile.BadZipFile, OSError) as e:
+        raise DownloadError(f"Downloaded file is not a valid EPUB: {e}")
+    if bad is not None:
+        raise DownloadError(f"Corrupted entry in downloaded file: {bad}")
+
+
+class DownloadManager:
+    def __init__(self, kobo: Kobo, workers: int = 3, retries: int = 4, backoff: float = 1.0,
+                 display_profile: str = Kobo.DisplayProfile):
+        self.kobo = kobo
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.display_profile = display_profile
+        kobo.SetConnectionPoolSize(max(10, self.workers * 2))
+
+    def _fetch(self, url: str, partial_path: str, product_id: str, progress: Optional[ProgressCallback]) -> int:
+        """
+        Downloads url into partial_path, continuing from its current size.
+        Returns the total size announced by the server (0 if it didn't say).
+        """
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.kobo.Session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 416 and offset:
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                if not total.isdigit() or int(total) == offset:
+                    # Nothing left to fetch: the previous attempt got every byte
+                    return int(total) if total.isdigit() else offset
+                # The partial file doesn't belong to this file (e.g. it is larger): start over
+                os.remove(partial_path)
+                raise DownloadError(f"Stale partial download: {offset} bytes, file has {total}")
+            response.raise_for_status()
+            if response.status_code == 206:
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                total = int(total) if total.isdigit() else 0
+                mode = "ab"
+            else:
+                # The server ignored the range: start over
+                offset = 0
+                total = int(response.headers.get("Content-Length") or 0)
+                mode = "wb"
+            done = offset
+            with open(partial_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(product_id, done, total)
+        return total
+
+    def download(self, product_id: str, output_dir: str, progress: Optional[ProgressCallback] = None) -> DownloadResult:
+        """Downloads one book, retrying with exponential backoff. Errors are reported in the result."""
+        started = time.perf_counter()
+        result = DownloadResult(product_id)
+        os.makedirs(output_dir, exist_ok=True)
+        url = None
+        partial_path = None
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            try:
+                if url is None:
+                    url, result.has_drm, result.content_keys = self.kobo.GetDownloadDetails(product_id, self.display_profile)
+                    result.path = raw_download_path(output_dir, product_id, result.has_drm)
+                    partial_path = result.path + ".downloading"
+                if result.attempts == 1 and os.path.exists(partial_path):
+                    result.resumed_from = os.path.getsize(partial_path)
+                total = self._fetch(url, partial_path, product_id, progress)
+                size = os.path.getsize(partial_path)
+                if total and size != total:
+                    if size > total:
+                        # More bytes than the file has: resuming can't fix it, start over
+                        os.remove(partial_path)
+                    raise DownloadError(f"Incomplete download: {size} of {total} bytes")
+                try:
+                    _verify_archive(partial_path)
+                except DownloadError:
+                    # A resumed file can't be repaired: the next attempt starts from zero
+                    os.remove(partial_path)
+                    raise
+                os.replace(partial_path, result.path)
+                result.size = size
+                result.sha256 = _sha256_of(result.path)
+                result.error = None
+                break
+            except (requests.RequestException, DownloadError, OSError) as e:
+                result.error = str(e)
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status in (401, 403, 410):
+                    # Signed content URLs expire; ask for a fresh one
+                    url = None
+                elif status is not None and 400 <= status < 500 and status != 429:
+                    break
+                if result.attempts > self.retries:
+                    break
+                delay = self.backoff * (2 ** (result.attempts - 1)) * (1 + random.random() / 2)
+                logger.warning(f"Download of {product_id} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception as e:
+                result.error = str(e)
+                break
+        result.seconds = time.perf_counter() - started
+        return result
+
+    def download_many(self, product_ids: List[str], output_dir: str,
+                      progress: Optional[ProgressCallback] = None) -> Iterator[DownloadResult]:
+        """Downloads several books concurrently and yields their results as they finish."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.download, product_id, output_dir, progress) for product_id in product_ids]
+            for future in as_completed(futures):
+                yield future.result()
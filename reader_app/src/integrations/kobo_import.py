@@ -0,0 +1,182 @@
+"""
+Kobo import pipeline: download -> DRM removal -> ingest.
+
+Each stage has its own queue and worker threads, so one book can be
+downloading while another is decrypted and a third is parsed: network, disk
+and CPU stay busy at the same time. Jobs move from queue to queue and every
+change of stage (and download progress, throttled) is reported through a
+publish callback.
+"""
+import os
+import re
+import time
+import queue
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+from src.core.parser import parse_epub
+from src.core.book_store import get_book_db_path, get_state, set_state
+from src.integrations.kobo_service import KoboService
+from src.integrations.kobo_downloads import DownloadManager
+
+# Minimum delay between two progress events of the same download
+PROGRESS_INTERVAL = 0.25
+
+FINISHED_STAGES = ("done", "error")
+
+# Book state naming the Kobo product a library book was imported from
+PRODUCT_STATE_KEY = "kobo_product_id"
+
+
+@dataclass
+class ImportJob:
+    product_id: str
+    title: str
+    stage: str = "queued"  # queued, downloading, decrypting, ingesting, done, error
+    bytes_done: int = 0
+    bytes_total: int = 0
+    book_id: Optional[str] = None
+    error: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def safe_book_name(title: str, fallback: str) -> str:
+    """File-system friendly name, in the spirit of `run.py add` (spaces become underscores)."""
+    name = re.sub(r'[^\w\-]+', '_', title or "").strip('_')
+    return name or fallback
+
+
+class ImportPipeline:
+    def __init__(self, service: KoboService, library_dir: str, work_dir: str, publish: Callable[[Dict], None],
+                 download_workers: int = 3, decrypt_workers: int = 1, ingest_workers: int = 1, parse_workers: int = 1):
+        self.service = service
+        self.library_dir = library_dir
+        self.downloads_dir = os.path.join(work_dir, "downloads")
+        self.books_dir = os.path.join(work_dir, "books")
+        self.publish = publish
+        self.parse_workers = parse_workers
+        self.downloads = DownloadManager(service.kobo, workers=download_workers)
+        self.jobs: Dict[str, ImportJob] = {}
+        self._lock = threading.Lock()
+        self._last_progress: Dict[str, float] = {}
+        # Book name -> product importing it, so two products with the same title never share files
+        self._owners: Dict[str, str] = {}
+        # stage name -> (queue, handler, next stage, worker count)
+        self._stages: Dict[str, Tuple[queue.Queue, Callable, Optional[str], int]] = {
+            "download": (queue.Queue(), self._download, "decrypt", download_workers),
+            "decrypt": (queue.Queue(), self._decrypt, "ingest", decrypt_workers),
+            "ingest": (queue.Queue(), self._ingest, None, ingest_workers),
+        }
+        self._started = False
+
+    def _start(self) -> None:
+        for name, (_, _, _, workers) in self._stages.items():
+            for i in range(max(1, workers)):
+                threading.Thread(target=self._worker, args=(name,), name=f"kobo-import-{name}-{i}", daemon=True).start()
+        self._started = True
+
+    def submit(self, product_id: str, title: str = "") -> ImportJob:
+        """Queues a book unless it is already being imported; returns its job."""
+        with self._lock:
+            job = self.jobs.get(product_id)
+            if job and job.stage not in FINISHED_STAGES:
+                return job
+            job = ImportJob(product_id, title or product_id)
+            self.jobs[product_id] = job
+            if not self._started:
+                self._start()
+        self._emit(job)
+        self._stages["download"][0].put((job, None))
+        return job
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def _emit(self, job: ImportJob) -> None:
+        self.publish({"type": "import", **job.to_dict()})
+
+    def _worker(self, stage: str) -> None:
+        tasks, handler, next_stage, _ = self._stages[stage]
+        while True:
+            job, payload = tasks.get()
+            started = time.perf_counter()
+            try:
+                payload = handler(job, payload)
+            except Exception as e:
+                job.stage = "error"
+                job.error = str(e)
+                print(f"[Import] {job.title}: {stage} failed: {e}")
+                self._emit(job)
+                continue
+            finally:
+                job.timings[stage] = round(time.perf_counter() - started, 2)
+            if next_stage:
+                self._stages[next_stage][0].put((job, payload))
+            else:
+                job.stage = "done"
+                print(f"[Import] {job.title}: done {job.timings}")
+                self._emit(job)
+
+    def _set_stage(self, job: ImportJob, stage: str) -> None:
+        job.stage = stage
+        self._emit(job)
+
+    def _download(self, job: ImportJob, _: Any):
+        self._set_stage(job, "downloading")
+
+        def progress(product_id: str, done: int, total: int) -> None:
+            job.bytes_done, job.bytes_total = done, total
+            now = time.monotonic()
+            if now - self._last_progress.get(product_id, 0) >= PROGRESS_INTERVAL:
+                self._last_progress[product_id] = now
+                self._emit(job)
+
+        result = self.downloads.download(job.product_id, self.downloads_dir, progress)
+        self._last_progress.pop(job.product_id, None)
+        if result.error:
+            raise RuntimeError(result.error)
+        job.bytes_done = job.bytes_total = result.size
+        return result
+
+    def _stored_owner(self, name: str) -> Optional[str]:
+        book_dir = os.path.join(self.library_dir, f"{name}_data")
+        if not os.path.exists(get_book_db_path(book_dir)):
+            return None
+        return get_state(book_dir, PRODUCT_STATE_KEY)
+
+    def _book_name(self, job: ImportJob) -> str:
+        """
+        Name of the EPUB and library folder of a job: the title, suffixed with the product id
+        when another product (another edition, a box set...) already uses it.
+        Re-importing a product, or importing a book first added with `run.py add`, reuses its folder.
+        """
+        base = safe_book_name(job.title, job.product_id)
+        with self._lock:
+            for name in (base, f"{base}_{job.product_id}"):
+                owner = self._owners.get(name) or self._stored_owner(name)
+                if owner in (None, job.product_id):
+                    break
+            self._owners[name] = job.product_id
+        return name
+
+    def _decrypt(self, job: ImportJob, result):
+        self._set_stage(job, "decrypting")
+        os.makedirs(self.books_dir, exist_ok=True)
+        epub_path = os.path.join(self.books_dir, f"{self._book_name(job)}.epub")
+        return str(self.service.remove_drm(result, epub_path))
+
+    def _ingest(self, job: ImportJob, epub_path: str):
+        self._set_stage(job, "ingesting")
+        name = os.path.splitext(os.path.basename(epub_path))[0]
+        book_id = f"{name}_data"
+        book_dir = os.path.join(self.library_dir, book_id)
+        book = parse_epub(epub_path, book_dir, fetch_kobo_highlights=True, workers=self.parse_workers)
+        set_state(book_dir, PRODUCT_STATE_KEY, job.product_id)
+        job.book_id = book_id
+        job.title = book.metadata.title
+        return book_id
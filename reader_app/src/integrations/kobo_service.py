@@ -1,17 +1,32 @@
 import os
+import json
+import time
+import hashlib
 import logging
 import tempfile
-from typing import List, Dict, Optional
+import threading
+from typing import List, Dict, Optional, Iterator
 from pathlib import Path
+
+import requests
+
 from src.integrations.kobo_api.Kobo import Kobo
+from src.integrations.kobo_api.KoboDrmRemover import KoboDrmRemover
 from src.integrations.kobo_api.Settings import Settings
 from src.integrations.kobo_api.Globals import Globals
+from src.integrations.kobo_downloads import DownloadManager, DownloadResult, ProgressCallback
+from src.utils.paths import get_project_root
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cleaned "My Books" list and the library_sync token it is current with
+LIBRARY_CACHE_PATH = get_project_root() / "data" / "kobo" / "library.json"
+
 class KoboService:
-    def __init__(self):
+    def __init__(self, library_cache_path: Optional[Path] = None):
+        self.library_cache_path = Path(library_cache_path or LIBRARY_CACHE_PATH)
+        self._library_lock = threading.Lock()
         Globals.Settings = Settings()
         Globals.Logger = logger
         if not Globals.Settings.Load():
@@ -27,85 +42,182 @@ class KoboService:
     def is_authenticated(self) -> bool:
         return Globals.Settings.IsLoggedIn()
 
-    def list_books(self, unread_only: bool = False) -> List[Dict]:
+    @staticmethod
+    def _clean_entitlement(entitlement: Dict) -> Dict:
+        """Reduces a library_sync entitlement to what the import page needs."""
+        book_metadata = entitlement.get('BookMetadata', {})
+        book_entitlement = entitlement.get('BookEntitlement', {})
+        reading_state = entitlement.get('ReadingState', {})
+        status_info = reading_state.get('StatusInfo', {})
+        
+        # Get basic info
+        book_id = book_entitlement.get('RevisionId') or book_entitlement.get('Id')
+        title = book_metadata.get('Title')
+        
+        # Get authors (Contributors is now a list of strings)
+        contributors = book_metadata.get('Contributors', [])
+        if isinstance(contributors, list):
+            author_str = ", ".join(contributors) if contributors else "Unknown"
+        else:
+            author_str = "Unknown"
+        
+        # Get cover image
+        cover_url = book_metadata.get('CoverImageUrl')
+        if cover_url and not cover_url.startswith('http'):
+            cover_url = 'https:' + cover_url
+        
+        # Get reading status
+        status = status_info.get('Status', 'Unread')
+        is_read = status == 'Finished'
+        
+        # Get download format
+        download_urls = book_metadata.get('DownloadUrls', [])
+        format_str = None
+        for url_info in download_urls:
+            if url_info.get('DrmType') == 'KDRM':
+                format_str = url_info.get('Format', 'EPUB')
+                break
+        if not format_str and download_urls:
+            format_str = download_urls[0].get('Format', 'EPUB')
+        
+        return {
+            "id": book_id,
+            "title": title,
+            "author": author_str,
+            "is_read": is_read,
+            "cover_image": cover_url,
+            "format": format_str,
+            "entitlement_id": book_entitlement.get('Id')
+        }
+
+    @staticmethod
+    def _merge_library_changes(books: Dict[str, Dict], changes: List[Dict]) -> None:
+        """Applies library_sync entries (new, changed or removed entitlements, reading states) to the cached books."""
+        for change in changes:
+            try:
+                entitlement = change.get('NewEntitlement') or change.get('ChangedEntitlement')
+                if entitlement:
+                    book = KoboService._clean_entitlement(entitlement)
+                    if entitlement.get('BookEntitlement', {}).get('IsRemoved'):
+                        books.pop(book["id"], None)
+                        continue
+                    previous = books.get(book["id"])
+                    if previous and 'ReadingState' not in entitlement:
+                        book["is_read"] = previous["is_read"]
+                    books[book["id"]] = book
+                    continue
+                reading_state = (change.get('ChangedReadingState') or {}).get('ReadingState')
+                if reading_state:
+                    is_read = reading_state.get('StatusInfo', {}).get('Status') == 'Finished'
+                    for book in books.values():
+                        if book.get("entitlement_id") == reading_state.get('EntitlementId'):
+                            book["is_read"] = is_read
+            except Exception as e:
+                logger.warning(f"Error parsing book: {e}")
+                continue
+
+    def load_library_cache(self) -> Optional[Dict]:
+        """The cached library: {"books", "sync_token", "etag", "refreshed_at"}, or None before the first refresh."""
+        try:
+            with open(self.library_cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_library_cache(self, cache: Dict) -> None:
+        self.library_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Per process and thread: several server workers may refresh the listing at once
+        tmp_path = self.library_cache_path.with_name(f"{self.library_cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.library_cache_path)
+
+    def refresh_library(self) -> Dict:
+        """
+        Brings the cached library up to date.
+        Only the changes since the stored sync token are fetched; an empty or rejected
+        token falls back to a full listing.
+        """
+        with self._library_lock:
+            cache = self.load_library_cache() or {"books": [], "sync_token": ""}
+            token = cache.get("sync_token", "")
+            books = {book["id"]: book for book in cache["books"]}
+            try:
+                changes, new_token = self.kobo.GetMyBookListChanges(token)
+            except requests.HTTPError as e:
+                if not token:
+                    raise
+                logger.warning(f"Kobo rejected the library sync token ({e}), fetching the whole library")
+                books = {}
+                changes, new_token = self.kobo.GetMyBookListChanges("")
+            self._merge_library_changes(books, changes)
+            book_list = [book for book in books.values() if book.get("id")]
+            cache = {
+                "books": book_list,
+                "sync_token": new_token,
+                "etag": hashlib.sha1(json.dumps(book_list, sort_keys=True).encode()).hexdigest(),
+                "refreshed_at": time.time()
+            }
+            self._save_library_cache(cache)
+            logger.info(f"Kobo library refreshed: {len(changes)} changes, {len(book_list)} books")
+            return cache
+
+    def list_books(self, unread_only: bool = False, use_cache: bool = False) -> List[Dict]:
         if not self.is_authenticated():
             logger.warning("Not authenticated to Kobo")
             return []
         try:
-            raw_books = self.kobo.GetMyBookList()
-            
-            cleaned_books = []
-            for book in raw_books:
-                try:
-                    # Extract nested data structure
-                    entitlement = book.get('NewEntitlement', {})
-                    book_metadata = entitlement.get('BookMetadata', {})
-                    book_entitlement = entitlement.get('BookEntitlement', {})
-                    reading_state = entitlement.get('ReadingState', {})
-                    status_info = reading_state.get('StatusInfo', {})
-                    
-                    # Get basic info
-                    book_id = book_entitlement.get('RevisionId') or book_entitlement.get('Id')
-                    title = book_metadata.get('Title')
-                    
-                    # Get authors (Contributors is now a list of strings)
-                    contributors = book_metadata.get('Contributors', [])
-                    if isinstance(contributors, list):
-                        author_str = ", ".join(contributors) if contributors else "Unknown"
-                    else:
-                        author_str = "Unknown"
-                    
-                    # Get cover image
-                    cover_url = book_metadata.get('CoverImageUrl')
-                    if cover_url and not cover_url.startswith('http'):
-                        cover_url = 'https:' + cover_url
-                    
-                    # Get reading status
-                    status = status_info.get('Status', 'Unread')
-                    is_read = status == 'Finished'
-                    
-                    if unread_only and is_read:
-                        continue
-                    
-                    # Get download format
-                    download_urls = book_metadata.get('DownloadUrls', [])
-                    format_str = None
-                    for url_info in download_urls:
-                        if url_info.get('DrmType') == 'KDRM':
-                            format_str = url_info.get('Format', 'EPUB')
-                            break
-                    if not format_str and download_urls:
-                        format_str = download_urls[0].get('Format', 'EPUB')
-                    
-                    cleaned_books.append({
-                        "id": book_id,
-                        "title": title,
-                        "author": author_str,
-                        "is_read": is_read,
-                        "cover_image": cover_url,
-                        "format": format_str
-                    })
-                except Exception as e:
-                    logger.warning(f"Error parsing book: {e}")
-                    continue
-            
-            logger.info(f"Successfully parsed {len(cleaned_books)} books")
-            return cleaned_books
+            cache = self.load_library_cache() if use_cache else None
+            if cache is None:
+                cache = self.refresh_library()
         except Exception as e:
             logger.error(f"Error fetching Kobo books: {e}", exc_info=True)
-            return []
+            cache = self.load_library_cache()
+            if cache is None:
+                return []
+        books = cache["books"]
+        if unread_only:
+            books = [book for book in books if not book["is_read"]]
+        return books
+
+    def download_manager(self, workers: int = 3) -> DownloadManager:
+        return DownloadManager(self.kobo, workers=workers)
+
+    def remove_drm(self, result: DownloadResult, output_path: str, workers: int = 1) -> Path:
+        """Writes the DRM-free EPUB of a finished download and drops the raw file."""
+        if not result.has_drm:
+            if result.path != output_path:
+                os.replace(result.path, output_path)
+            return Path(output_path)
+        remover = KoboDrmRemover(Globals.Settings.DeviceId, Globals.Settings.UserId)
+        try:
+            remover.RemoveDrmStreaming(result.path, output_path, result.content_keys, workers=workers)
+        except Exception:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        os.remove(result.path)
+        return Path(output_path)
 
     def download_book(self, book_id: str, output_dir: str) -> Optional[Path]:
         if not self.is_authenticated():
             raise RuntimeError("Not authenticated")
         try:
-            os.makedirs(output_dir, exist_ok=True)
-            display_profile = Kobo.DisplayProfile
-            temp_path = os.path.join(output_dir, f"{book_id}.epub")
-            self.kobo.Download(book_id, display_profile, temp_path)
-            if os.path.exists(temp_path):
-                return Path(temp_path)
-            return None
+            result = self.download_manager(workers=1).download(book_id, output_dir)
+            if result.error:
+                logger.error(f"Error downloading book {book_id}: {result.error}")
+                return None
+            return self.remove_drm(result, os.path.join(output_dir, f"{book_id}.epub"))
         except Exception as e:
             logger.error(f"Error downloading book {book_id}: {e}")
             return None
+
+    def download_books(self, book_ids: List[str], output_dir: str, workers: int = 3,
+                       progress: Optional[ProgressCallback] = None) -> Iterator[DownloadResult]:
+        """
+        Downloads several books at once, resuming partial files.
+        Yields raw results (DRM still in place) as they finish; see remove_drm.
+        """
+        if not self.is_authenticated():
+            raise RuntimeError("Not authenticated")
+        yield from self.download_manager(workers).download_many(book_ids, output_dir, progress)
@@ -0,0 +1,286 @@
+"""
+Incremental Kobo highlight sync.
+
+Every book keeps a small sync state next to its chapters: the Kobo VolumeID,
+the newest DateCreated/DateModified already seen (the watermark) and the
+chapter each known bookmark was placed in. A sync only asks Kobo for Bookmark
+rows from the watermark on and only loads the chapters those rows point to, so a
+sync with nothing new is a single indexed query. Rows dated exactly at the
+watermark are asked for again, since Kobo dates stop at the second; bookmarks
+already in the state are skipped unless they changed.
+"""
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Tuple, Iterator
+
+from bs4 import BeautifulSoup
+from src.core.models import Book, ChapterContent, Highlight
+from src.core.book_store import get_state, set_state, load_manifest, load_chapter, save_chapter, load_all_highlights, book_lock
+from src.core.highlighter import (
+    locate_highlights, insert_highlight, sort_highlights, migrate_baked_highlights, has_baked_highlights
+)
+from src.integrations.kobo import (
+    find_volume_id, fetch_bookmarks, index_chapter_hrefs, resolve_chapter,
+    get_kobo_db, find_volume_ids, fetch_bookmarks_grouped
+)
+
+SYNC_STATE_KEY = "kobo_sync"
+
+
+# The Kobo database can't be found or read: no book can be synced
+class KoboSyncError(Exception):
+    pass
+
+
+@dataclass
+class SyncResult:
+    added: int = 0
+    updated: int = 0
+    touched_chapters: List[int] = field(default_factory=list)
+
+
+@dataclass
+class LibrarySyncItem:
+    """Outcome of one book within a library-wide sync."""
+    book_id: str
+    title: str
+    result: SyncResult
+    seconds: float
+    error: Optional[str] = None
+
+
+def _watermark(highlights: List[Highlight], current: str = "") -> str:
+    dates = [current] + [hl.date or "" for hl in highlights] + [hl.date_modified or "" for hl in highlights]
+    return max(dates)
+
+
+def record_sync_state(book_dir: str, volume_id: Optional[str], fetched: List[Highlight], book: Book) -> None:
+    """Stores the sync state right after ingest, so the first sync is already incremental."""
+    bookmarks: Dict[str, Optional[int]] = {hl.bookmark_id: None for hl in fetched if hl.bookmark_id}
+    for idx, chapter in enumerate(book.spine):
+        for hl in chapter.highlights:
+            if hl.bookmark_id:
+                bookmarks[hl.bookmark_id] = idx
+    set_state(book_dir, SYNC_STATE_KEY, {
+        "volume_id": volume_id,
+        "watermark": _watermark(fetched),
+        "bookmarks": bookmarks
+    })
+
+
+def _bootstrap_state(book_dir: str) -> Dict:
+    """State for books ingested before incremental sync: bookmarks are read from the stored highlights."""
+    bookmarks: Dict[str, Optional[int]] = {}
+    for idx, highlights in enumerate(load_all_highlights(book_dir)):
+        for hl in highlights:
+            if hl.bookmark_id:
+                bookmarks[hl.bookmark_id] = idx
+    return {"volume_id": None, "watermark": "", "bookmarks": bookmarks}
+
+
+def _already_has(chapter: ChapterContent, hl: Highlight) -> bool:
+    """Older highlights carry no bookmark id, so fall back to comparing text."""
+    text = (hl.text or "").strip()
+    return any(
+        (h.bookmark_id and h.bookmark_id == hl.bookmark_id) or (not h.bookmark_id and h.text.strip() == text)
+        for h in chapter.highlights
+    )
+
+
+def _update_existing(chapter: ChapterContent, hl: Highlight) -> bool:
+    """Applies a modified Kobo bookmark (e.g. an edited annotation) to the stored highlight."""
+    for i, existing in enumerate(chapter.highlights):
+        if existing.bookmark_id == hl.bookmark_id:
+            if existing.annotation == hl.annotation and existing.text == hl.text:
+                return False
+            updated = replace(hl, start=existing.start, end=existing.end, id=existing.id)
+            if existing.text != hl.text:
+                locate_highlights(BeautifulSoup(chapter.content, 'html.parser'), [updated])
+            chapter.highlights[i] = updated
+            sort_highlights(chapter.highlights)
+            return True
+    return False
+
+
+def _inject(chapter: ChapterContent, highlights: List[Highlight]) -> List[int]:
+    """
+    Locates highlights in a chapter, records the ones found and returns their indices.
+    The chapter HTML is not modified: highlights are applied when the chapter is displayed.
+    """
+    candidates = [replace(hl) for hl in highlights]
+    placed = locate_highlights(BeautifulSoup(chapter.content, 'html.parser'), candidates)
+    for k in placed:
+        insert_highlight(chapter.highlights, candidates[k])
+    return placed
+
+
+def _load_state(book_dir: str) -> Tuple[Dict, bool]:
+    """Returns the book's sync state and whether it still has to be written."""
+    stored = get_state(book_dir, SYNC_STATE_KEY)
+    return (stored or _bootstrap_state(book_dir)), stored is None
+
+
+def sync_book_highlights(book_dir: str, book: Book) -> SyncResult:
+    """
+    Pulls new and changed Kobo highlights for one book.
+    Only the chapters targeted by those bookmarks are loaded and rewritten.
+    """
+    state, state_changed = _load_state(book_dir)
+    volume_id = state.get("volume_id") or find_volume_id(book.metadata.title)
+    if not volume_id:
+        return SyncResult()
+    state_changed = state_changed or state.get("volume_id") != volume_id
+    state["volume_id"] = volume_id
+    rows = fetch_bookmarks(volume_id, since=state.get("watermark", ""))
+    return apply_bookmarks(book_dir, book, state, rows, state_changed)
+
+
+def _is_newer(hl: Highlight, watermark: str) -> bool:
+    return (hl.date or "") >= watermark or (hl.date_modified or "") >= watermark
+
+
+def sync_library_highlights(library_dir: str, books: List[Tuple[str, str]], workers: int = 4) -> Iterator[LibrarySyncItem]:
+    """
+    Syncs many books at once from (book_id, title) pairs.
+    Kobo is queried through the shared read-only handle: missing VolumeIDs are resolved in
+    one query and the bookmarks of every book are pulled in one grouped query. Books are
+    then updated in parallel and yielded as they finish.
+    Raises KoboSyncError (on the first iteration) if the Kobo database can't be found or read.
+    """
+    states: Dict[str, Tuple[Dict, bool]] = {}
+    for book_id, _ in books:
+        states[book_id] = _load_state(os.path.join(library_dir, book_id))
+
+    db = get_kobo_db()
+    if db is None:
+        raise KoboSyncError("Kobo database not found")
+    try:
+        missing = [title for book_id, title in books if not states[book_id][0].get("volume_id")]
+        resolved = find_volume_ids(db, missing)
+        for book_id, title in books:
+            state, changed = states[book_id]
+            if not state.get("volume_id") and title in resolved:
+                state["volume_id"] = resolved[title]
+                states[book_id] = (state, True)
+        volume_ids = sorted({s.get("volume_id") for s, _ in states.values() if s.get("volume_id")})
+        since = min((s.get("watermark", "") for s, _ in states.values() if s.get("volume_id")), default="")
+        grouped = fetch_bookmarks_grouped(db, volume_ids, since)
+    except (sqlite3.Error, OSError) as e:
+        raise KoboSyncError(f"Could not read the Kobo database: {e}")
+
+    def run(book_id: str, title: str) -> LibrarySyncItem:
+        started = time.perf_counter()
+        state, changed = states[book_id]
+        try:
+            if not state.get("volume_id"):
+                return LibrarySyncItem(book_id, title, SyncResult(), time.perf_counter() - started)
+            watermark = state.get("watermark", "")
+            rows = [hl for hl in grouped.get(state["volume_id"], []) if _is_newer(hl, watermark)]
+            book_dir = os.path.join(library_dir, book_id)
+            result = SyncResult()
+            if rows or changed:
+                book = load_manifest(book_dir)
+                if book:
+                    result = apply_bookmarks(book_dir, book, state, rows, changed)
+            return LibrarySyncItem(book_id, title, result, time.perf_counter() - started)
+        except Exception as e:
+            return LibrarySyncItem(book_id, title, SyncResult(), time.perf_counter() - started, error=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(run, book_id, title) for book_id, title in books]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def apply_bookmarks(book_dir: str, book: Book, state: Dict, rows: List[Highlight], state_changed: bool = False) -> SyncResult:
+    """
+    Applies Bookmark rows fetched past the book's watermark.
+    New bookmarks are injected into the chapter their ContentID names, modified ones update
+    the stored highlight, and only the chapters touched are saved.
+    """
+    # Chapters are loaded, modified and saved back: no other thread or worker may write in between
+    with book_lock(book_dir):
+        return _apply_bookmarks(book_dir, book, state, rows, state_changed)
+
+
+def _apply_bookmarks(book_dir: str, book: Book, state: Dict, rows: List[Highlight], state_changed: bool) -> SyncResult:
+    result = SyncResult()
+    if not rows:
+        if state_changed:
+            set_state(book_dir, SYNC_STATE_KEY, state)
+        return result
+
+    bookmarks: Dict[str, Optional[int]] = state.setdefault("bookmarks", {})
+    href_index = index_chapter_hrefs([ch.href for ch in book.spine])
+    chapters: Dict[int, ChapterContent] = {}
+    dirty = set()
+    baked = has_baked_highlights(book)
+
+    def get_chapter(idx: int) -> Optional[ChapterContent]:
+        if idx not in chapters:
+            chapters[idx] = load_chapter(book_dir, idx)
+            if chapters[idx] and baked and migrate_baked_highlights(chapters[idx]):
+                dirty.add(idx)
+        return chapters[idx]
+
+    new_by_chapter: Dict[int, List[Highlight]] = {}
+    unresolved: List[Highlight] = []
+    for hl in rows:
+        if hl.bookmark_id in bookmarks:
+            idx = bookmarks[hl.bookmark_id]
+            chapter = get_chapter(idx) if idx is not None else None
+            if chapter and _update_existing(chapter, hl):
+                result.updated += 1
+                dirty.add(idx)
+            continue
+        idx = resolve_chapter(hl.chapter_id, href_index)
+        if idx is None:
+            unresolved.append(hl)
+        else:
+            new_by_chapter.setdefault(idx, []).append(hl)
+        bookmarks[hl.bookmark_id] = None
+
+    for idx, highlights in new_by_chapter.items():
+        chapter = get_chapter(idx)
+        if not chapter:
+            unresolved.extend(highlights)
+            continue
+        known = [hl for hl in highlights if _already_has(chapter, hl)]
+        fresh = [hl for hl in highlights if not _already_has(chapter, hl)]
+        placed = [fresh[k] for k in _inject(chapter, fresh)] if fresh else []
+        for hl in known + placed:
+            bookmarks[hl.bookmark_id] = idx
+        if placed:
+            result.added += len(placed)
+            dirty.add(idx)
+        # Text not found in the chapter the ContentID names: try the others
+        placed_ids = {id(hl) for hl in placed}
+        unresolved.extend(hl for hl in fresh if id(hl) not in placed_ids)
+
+    # Bookmarks whose ContentID matches no spine file: search the chapters one by one
+    for idx in range(len(book.spine)):
+        if not unresolved:
+            break
+        chapter = get_chapter(idx)
+        if not chapter:
+            continue
+        known = [hl for hl in unresolved if _already_has(chapter, hl)]
+        fresh = [hl for hl in unresolved if not _already_has(chapter, hl)]
+        placed = [fresh[k] for k in _inject(chapter, fresh)] if fresh else []
+        for hl in known + placed:
+            bookmarks[hl.bookmark_id] = idx
+        if placed:
+            result.added += len(placed)
+            dirty.add(idx)
+        placed_ids = {id(hl) for hl in placed}
+        unresolved = [hl for hl in fresh if id(hl) not in placed_ids]
+
+    for idx in sorted(dirty):
+        save_chapter(book_dir, idx, chapters[idx])
+    result.touched_chapters = sorted(dirty)
+    state["watermark"] = _watermark(rows, state.get("watermark", ""))
+    set_state(book_dir, SYNC_STATE_KEY, state)
+    return result
@@ -0,0 +1,45 @@
+"""
+Background watcher for the Kobo Desktop database.
+
+Polls the database (and WAL) mtime and size, and calls back once the file has
+stopped changing for a while: Kobo Desktop writes in bursts while it syncs
+with the device, and one import per burst is enough.
+"""
+import asyncio
+import time
+from typing import Callable, Optional, Tuple
+
+from src.integrations.kobo import get_kobo_db
+
+POLL_INTERVAL = 2.0
+DEBOUNCE_SECONDS = 5.0
+
+
+class KoboWatcher:
+    def __init__(self, on_change: Callable[[], None], interval: float = POLL_INTERVAL, debounce: float = DEBOUNCE_SECONDS):
+        self.on_change = on_change
+        self.interval = interval
+        self.debounce = debounce
+
+    def _current_version(self) -> Optional[Tuple]:
+        db = get_kobo_db()
+        return db.version() if db else None
+
+    async def run(self) -> None:
+        """Watches until cancelled. on_change runs in a worker thread, never concurrently with itself."""
+        last_seen = self._current_version()
+        changed_at: Optional[float] = None
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self._current_version()
+            if current != last_seen:
+                last_seen = current
+                changed_at = time.monotonic()
+                continue
+            if changed_at is None or current is None or time.monotonic() - changed_at < self.debounce:
+                continue
+            changed_at = None
+            try:
+                await asyncio.to_thread(self.on_change)
+            except Exception as e:
+                print(f"[Kobo] Auto-sync failed: {e}")
@@ -0,0 +1,71 @@
+"""
+Inter-process file locks, for state shared by several server workers.
+
+flock() locks belong to an open file, so they also exclude the threads of one
+process; a thread lock per path is still taken first so that waiting threads
+queue in-process instead of each holding a file open. Where fcntl is missing
+(Windows), locks only cover the current process.
+
+A thread already holding a lock may take it again (the inner block then does
+nothing): helpers that lock a book can be called from code that already holds it.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import IO, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+# Paths locked by the current thread
+_held = threading.local()
+
+
+def _thread_lock(key: str) -> threading.Lock:
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(key, threading.Lock())
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Holds an exclusive lock on path (created if missing) for the duration of the block."""
+    key = os.path.abspath(path)
+    held = getattr(_held, "paths", None)
+    if held is None:
+        held = _held.paths = set()
+    if key in held:
+        yield
+        return
+    with _thread_lock(key):
+        held.add(key)
+        try:
+            if fcntl is None:
+                yield
+                return
+            with open(path, "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            held.discard(key)
+
+
+def try_hold_lock(path: str) -> Optional[IO]:
+    """
+    Takes an exclusive lock without waiting, held until the returned file is closed
+    or the process exits. Returns None if another process already holds it.
+    """
+    f = open(path, "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+    return f
@@ -1,14 +1,26 @@
 import re
-from typing import List
+from typing import List, Tuple
+
+_TOKEN_RE = re.compile(r'\w+')
+
+def normalize_text(text: str) -> str:
+    # Every replacement is one character for one character, so offsets are preserved
+    text = text.replace('\u2019', "'").replace('\u201c', '"').replace('\u201d', '"')
+    text = text.replace('—', '-').replace('–', '-').replace('\u2014', '-').replace('\u2013', '-')
+    return text
 
 def tokenize_text(text: str) -> List[str]:
     if not text:
         return []
-    text = text.replace('\u2019', "'").replace('\u201c', '"').replace('\u201d', '"')
-    text = text.replace('—', '-').replace('–', '-').replace('\u2014', '-').replace('\u2013', '-')
-    tokens = re.findall(r'\w+', text.lower())
+    tokens = _TOKEN_RE.findall(normalize_text(text).lower())
     return tokens
 
+def tokenize_with_offsets(text: str) -> List[Tuple[str, int, int]]:
+    """Same tokens as tokenize_text, with their (start, end) character offsets in text."""
+    if not text:
+        return []
+    return [(m.group(0).lower(), m.start(), m.end()) for m in _TOKEN_RE.finditer(normalize_text(text))]
+
 def find_token_sequence(haystack_tokens: List[str], needle_tokens: List[str]):
     needle_len = len(needle_tokens)
     haystack_len = len(haystack_tokens)
@@ -0,0 +1,17 @@
+import struct
+import zipfile
+from typing import BinaryIO
+
+
+def entry_data_offset(f: BinaryIO, info: zipfile.ZipInfo) -> int:
+    """
+    Offset of an entry's (compressed) data in the archive, read from its local file header.
+    zipfile only parses that header when opening the entry, so this relies on its private
+    header field indices; they are used here and nowhere else.
+    """
+    f.seek(info.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    return info.header_offset + zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from src.core.book_store import (
+    save_book, load_manifest, load_chapter, load_chapters, save_chapter_highlights,
+    load_chapter_highlights, book_version, get_book_db_path, LEGACY_PICKLE_NAME
+)
+from src.core.models import Book, BookMetadata, ChapterContent, Highlight
+
+
+def _make_book(chapters: int = 3) -> Book:
+    spine = [
+        ChapterContent(id=f"c{i}", href=f"c{i}.xhtml", title=f"Chapter {i}",
+                       content=f"<p>Body {i}</p>", text=f"Body {i}", order=i)
+        for i in range(chapters)
+    ]
+    return Book(BookMetadata("Title", "en", authors=["Author"]), spine, [], {}, "book.epub", "now")
+
+
+def _load_title(book_dir: str) -> str:
+    return load_manifest(book_dir).metadata.title
+
+
+class BookStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.book_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.book_dir)
+
+    def test_save_and_load(self):
+        book = _make_book()
+        save_book(book, self.book_dir)
+        manifest = load_manifest(self.book_dir)
+        self.assertEqual(manifest.metadata, book.metadata)
+        self.assertEqual([ch.href for ch in manifest.spine], [ch.href for ch in book.spine])
+        # The manifest carries no chapter bodies
+        self.assertTrue(all(ch.content == "" for ch in manifest.spine))
+        self.assertEqual(load_chapter(self.book_dir, 1), book.spine[1])
+        self.assertIsNone(load_chapter(self.book_dir, 3))
+        self.assertEqual(load_chapters(self.book_dir), book.spine)
+
+    def test_save_chapter_highlights(self):
+        save_book(_make_book(), self.book_dir)
+        hl = Highlight(text="Body", annotation="", date="", chapter_id="", start=0, end=4, id="h1")
+        save_chapter_highlights(self.book_dir, 1, [hl])
+        self.assertEqual(load_chapter_highlights(self.book_dir, 1), [hl])
+        self.assertEqual(load_chapter(self.book_dir, 1).highlights, [hl])
+        self.assertEqual(load_chapter(self.book_dir, 1).content, "<p>Body 1</p>")
+        self.assertEqual(load_chapter_highlights(self.book_dir, 0), [])
+
+    def test_book_version_moves_on_commit_and_save(self):
+        self.assertIsNone(book_version(self.book_dir))
+        save_book(_make_book(), self.book_dir)
+        first = book_version(self.book_dir)
+        hl = Highlight(text="Body", annotation="", date="", chapter_id="", start=0, end=4)
+        save_chapter_highlights(self.book_dir, 0, [hl])
+        edited = book_version(self.book_dir)
+        self.assertNotEqual(edited, first)
+        # Same generation: only a re-ingest makes a new one
+        self.assertEqual(edited[0], first[0])
+        versions = {edited}
+        for _ in range(5):
+            save_book(_make_book(), self.book_dir)
+            versions.add(book_version(self.book_dir))
+        self.assertEqual(len(versions), 6)
+
+    def test_concurrent_legacy_migration(self):
+        with open(os.path.join(self.book_dir, LEGACY_PICKLE_NAME), "wb") as f:
+            pickle.dump(_make_book(), f)
+        with multiprocessing.get_context("spawn").Pool(3) as pool:
+            titles = pool.map(_load_title, [self.book_dir] * 3)
+        self.assertEqual(titles, ["Title"] * 3)
+        self.assertTrue(os.path.exists(get_book_db_path(self.book_dir)))
+        self.assertEqual(len(load_chapters(self.book_dir)), 3)
+        self.assertFalse([name for name in os.listdir(self.book_dir) if name.endswith(".tmp")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from src.core.cache import ByteBudgetCache
+
+
+class ByteBudgetCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used_within_budget(self):
+        cache = ByteBudgetCache(100, max_item_bytes=100)
+        cache.put("a", "A", 40)
+        cache.put("b", "B", 40)
+        cache.get("a")
+        cache.put("c", "C", 40)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.size, 80)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_oversized_item_is_returned_but_not_kept(self):
+        cache = ByteBudgetCache(100)
+        cache.put("small", "s", 10)
+        value = cache.get_or_load("big", None, lambda: "B", lambda v: 30)
+        self.assertEqual(value, "B")
+        self.assertIsNone(cache.get("big"))
+        # Nothing else was flushed to make room for it
+        self.assertEqual(cache.get("small"), "s")
+        self.assertEqual(cache.size, 10)
+
+    def test_version_mismatch_is_a_miss_and_drops_the_entry(self):
+        cache = ByteBudgetCache(100)
+        cache.put("k", "old", 10, version=1)
+        self.assertEqual(cache.get("k", 1), "old")
+        self.assertIsNone(cache.get("k", 2))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.get_or_load("k", 2, lambda: "new", lambda v: 10), "new")
+        self.assertEqual(cache.get("k", 2), "new")
+
+    def test_none_results_are_not_cached(self):
+        cache = ByteBudgetCache(100)
+        self.assertIsNone(cache.get_or_load("k", None, lambda: None, lambda v: 10))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_invalidate_where(self):
+        cache = ByteBudgetCache(100)
+        for key in [("chapter", "a", 0), ("page", "a", 0), ("chapter", "b", 0), ("manifest", "a")]:
+            cache.put(key, "v", 10)
+        cache.invalidate_where(lambda key: key[0] in ("chapter", "page") and key[1] == "a")
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.size, 20)
+        self.assertIsNone(cache.get(("page", "a", 0)))
+        self.assertEqual(cache.get(("manifest", "a")), "v")
+
+    def test_counters(self):
+        cache = ByteBudgetCache(20, max_item_bytes=20)
+        cache.get("missing")
+        cache.put("a", "A", 10)
+        cache.get("a")
+        cache.get("a")
+        cache.put("b", "B", 10)
+        cache.put("c", "C", 10)
+        self.assertEqual(cache.stats(), {
+            "entries": 2, "bytes": 20, "max_bytes": 20, "hits": 2, "misses": 1, "evictions": 1
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+import unittest
+
+from bs4 import BeautifulSoup
+
+from src.core.book_store import save_book, load_manifest, load_chapter
+from src.core.models import Book, BookMetadata, ChapterContent, Highlight
+from src.core.highlighter import locate_highlights, render_highlights, upgrade_chapter, has_baked_highlights
+
+
+def _highlight(text: str) -> Highlight:
+    return Highlight(text=text, annotation="", date="", chapter_id="")
+
+
+class LocateAcrossInlineMarkupTest(unittest.TestCase):
+    def _locate(self, html: str, text: str):
+        soup = BeautifulSoup(html, "html.parser")
+        hl = _highlight(text)
+        found = locate_highlights(soup, [hl])
+        return found, hl
+
+    def test_drop_cap(self):
+        html = '<p><span class="dropcap">I</span>t was a dark and stormy night; the rain fell.</p>'
+        found, hl = self._locate(html, "It was a dark and stormy night")
+        self.assertEqual(found, [0])
+        _, text = render_highlights(html, [])
+        self.assertEqual(text[hl.start:hl.end], "It was a dark and stormy night")
+
+    def test_word_split_by_bold(self):
+        html = "<p>A <b>para</b>graph with some words in it.</p>"
+        found, hl = self._locate(html, "paragraph with some")
+        self.assertEqual(found, [0])
+        rendered, text = render_highlights(html, [hl])
+        self.assertEqual(text[hl.start:hl.end], "paragraph with some")
+        self.assertIn("highlight", rendered)
+
+    def test_words_do_not_join_across_blocks(self):
+        html = "<p>first para</p><p>graph second</p>"
+        found, _ = self._locate(html, "paragraph second")
+        self.assertEqual(found, [])
+        found, _ = self._locate("<p>line one<br/>two lines</p>", "onetwo lines")
+        self.assertEqual(found, [])
+
+
+class UpgradeStoredChapterTest(unittest.TestCase):
+    def setUp(self):
+        self.book_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.book_dir)
+
+    def _read(self, html: str, version: str):
+        """Stores a one-chapter book and reads the chapter back as the server does."""
+        chapter = ChapterContent(id="c1", href="c1.xhtml", title="One", content=html, text="", order=0,
+                                 highlights=[_highlight("dark and stormy")])
+        book = Book(BookMetadata("Title", "en"), [chapter], [], {}, "book.epub", "now", version=version)
+        save_book(book, self.book_dir)
+        chapter = load_chapter(self.book_dir, 0)
+        changed = upgrade_chapter(chapter, has_baked_highlights(load_manifest(self.book_dir)))
+        return chapter, changed
+
+    def test_publisher_highlight_markup_survives(self):
+        html = '<p>It was a <span class="highlight">Key term</span>, dark and stormy.</p>'
+        chapter, _ = self._read(html, Book.version)
+        self.assertEqual(chapter.content, html)
+
+    def test_legacy_baked_highlights_are_unwrapped(self):
+        html = '<p>It was a <span class="highlight manual-highlight">dark and stormy</span> night.</p>'
+        chapter, changed = self._read(html, "4.0")
+        self.assertTrue(changed)
+        self.assertEqual(chapter.content, "<p>It was a dark and stormy night.</p>")
+        self.assertEqual((chapter.highlights[0].start, chapter.highlights[0].end), (9, 24))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from src.integrations.kobo_downloads import CHUNK_SIZE, DownloadManager
+
+
+def _make_epub(size: int = 3 * CHUNK_SIZE) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+        archive.writestr("OEBPS/book.xhtml", random.Random(0).randbytes(size))
+    return buffer.getvalue()
+
+
+class _FileServer(ThreadingHTTPServer):
+    """Serves one file, with Range support and optionally a connection dropped mid-body."""
+    daemon_threads = True
+
+    def __init__(self, data: bytes):
+        super().__init__(("127.0.0.1", 0), _RangeHandler)
+        self.data = data
+        self.honour_range = True
+        # Bytes sent before the connection is dropped, for the next response only
+        self.drop_after = None
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/book.epub"
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        range_header = self.headers.get("Range")
+        server.requests.append(range_header)
+        start = 0
+        if range_header and server.honour_range:
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if server.drop_after is not None:
+            body = body[:server.drop_after]
+            server.drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FakeKobo:
+    def __init__(self, url: str):
+        self.url = url
+        self.Session = requests.Session()
+
+    def SetConnectionPoolSize(self, size: int) -> None:
+        pass
+
+    def GetDownloadDetails(self, product_id: str, display_profile: str):
+        return self.url, False, {}
+
+
+class ResumableDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data = _make_epub()
+        self.server = _FileServer(self.data)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.output_dir = tempfile.mkdtemp()
+        self.manager = DownloadManager(_FakeKobo(self.server.url), retries=3, backoff=0)
+        self.partial_path = os.path.join(self.output_dir, "book1.epub.downloading")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+
+    def _write_partial(self, data: bytes):
+        with open(self.partial_path, "wb") as f:
+            f.write(data)
+
+    def _assert_downloaded(self, result):
+        self.assertIsNone(result.error)
+        with open(result.path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(self.partial_path))
+
+    def test_dropped_connection_resumes_with_206(self):
+        # Bytes past the last full chunk are lost with the connection
+        self.server.drop_after = CHUNK_SIZE + 1000
+        result = self.manager.download("book1", self.output_dir)
+        self._assert_downloaded(result)
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual(self.server.requests, [None, f"bytes={CHUNK_SIZE}-"])
+
+    def test_existing_partial_resumes_with_206(self):
+        self._write_partial(self.data[:70_000])
+        result = self.manager.download("book1", self.output_dir)
+        self._assert_downloaded(result)
+        self.assertEqual(result.resumed_from, 70_000)
+        self.assertEqual(self.server.requests, ["bytes=70000-"])
+
+    def test_complete_partial_answered_416(self):
+        self._write_partial(self.data)
+        result = self.manager.download("book1", self.output_dir)
+        self._assert_downloaded(result)
+        self.assertEqual(result.attempts, 1)
+
+    def test_stale_larger_partial_starts_over(self):
+        self._write_partial(self.data + b"left over from another file")
+        result = self.manager.download("book1", self.output_dir)
+        self._assert_downloaded(result)
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual(self.server.requests, [f"bytes={len(self.data) + 27}-", None])
+
+    def test_range_ignored_restarts_with_200(self):
+        self.server.honour_range = False
+        self._write_partial(b"x" * 30_000)
+        result = self.manager.download("book1", self.output_dir)
+        self._assert_downloaded(result)
+        self.assertEqual(result.attempts, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
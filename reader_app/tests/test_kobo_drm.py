@@ -0,0 +1,92 @@
+import base64
+import binascii
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+
+from src.integrations.kobo_api.KoboDrmRemover import KoboDrmRemover
+
+DEVICE_ID = "device"
+USER_ID = "user"
+
+
+def _content_key_base64(content_key: bytes) -> str:
+    """The content key as the Kobo API hands it out: encrypted with the device/user key."""
+    user_key = binascii.a2b_hex(hashlib.sha256((DEVICE_ID + USER_ID).encode()).hexdigest()[32:])
+    return base64.b64encode(AES.new(user_key, AES.MODE_ECB).encrypt(content_key)).decode()
+
+
+def _encrypt(data: bytes, content_key: bytes) -> bytes:
+    return AES.new(content_key, AES.MODE_ECB).encrypt(Padding.pad(data, AES.block_size, "pkcs7"))
+
+
+def _make_encrypted_epub(path: str):
+    """A small EPUB with stored, deflated and encrypted entries, and the content keys of the latter."""
+    rng = random.Random(0)
+    content_keys = {}
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        archive.writestr("META-INF/container.xml", "<container/>" * 50, zipfile.ZIP_DEFLATED)
+        archive.writestr("OEBPS/cover.jpg", rng.randbytes(5000), zipfile.ZIP_STORED)
+        # Lengths around the AES block size exercise the padding held back at the end
+        for i, size in enumerate((0, 15, 16, 17, 3000, 20000)):
+            name = f"OEBPS/ch{i}.xhtml"
+            content_key = rng.randbytes(16)
+            text = "".join(rng.choice("abc \n") for _ in range(size)).encode()
+            archive.writestr(name, _encrypt(text, content_key), zipfile.ZIP_DEFLATED)
+            content_keys[name] = _content_key_base64(content_key)
+    return content_keys
+
+
+def _entries(path: str):
+    with zipfile.ZipFile(path) as archive:
+        assert archive.testzip() is None
+        return [(info.filename, archive.read(info)) for info in archive.infolist()]
+
+
+class StreamingDrmRemovalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.dir, "book.kepub.epub")
+        self.content_keys = _make_encrypted_epub(self.input_path)
+        self.remover = KoboDrmRemover(DEVICE_ID, USER_ID)
+        self.expected_path = os.path.join(self.dir, "expected.epub")
+        self.remover.RemoveDrm(self.input_path, self.expected_path, self.content_keys)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _assert_same_as_remove_drm(self, workers: int):
+        output_path = os.path.join(self.dir, f"streamed{workers}.epub")
+        # Small chunks, so encrypted entries are decrypted over several reads
+        with mock.patch.object(KoboDrmRemover, "ChunkSize", 64):
+            self.remover.RemoveDrmStreaming(self.input_path, output_path, self.content_keys, workers=workers)
+        self.assertEqual(_entries(output_path), _entries(self.expected_path))
+        # The temporary files of the decrypted entries are gone
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted(["book.kepub.epub", "expected.epub", f"streamed{workers}.epub"]))
+
+    def test_single_worker_matches_remove_drm(self):
+        self._assert_same_as_remove_drm(1)
+
+    def test_several_workers_match_remove_drm(self):
+        self._assert_same_as_remove_drm(4)
+
+    def test_unencrypted_entries_copied_raw(self):
+        output_path = os.path.join(self.dir, "streamed.epub")
+        self.remover.RemoveDrmStreaming(self.input_path, output_path, self.content_keys)
+        with zipfile.ZipFile(self.input_path) as source, zipfile.ZipFile(output_path) as output:
+            for name in ("mimetype", "META-INF/container.xml", "OEBPS/cover.jpg"):
+                self.assertEqual(output.getinfo(name).compress_type, source.getinfo(name).compress_type)
+                self.assertEqual(output.getinfo(name).compress_size, source.getinfo(name).compress_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
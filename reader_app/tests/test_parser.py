@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+from src.core.book_store import get_state, load_chapter, save_chapter_highlights
+from src.core.highlighter import locate_highlights
+from src.core.models import Highlight
+from src.core import parser
+from src.core.parser import parse_epub, INGEST_STATE_KEY
+
+CHAPTERS = [
+    "<h1>One</h1><p>It was a dark and stormy night.</p>",
+    "<h1>Two</h1><p>The rain fell in torrents.</p>",
+    "<h1>Three</h1><p>Except at occasional intervals.</p>",
+]
+
+
+def _write_epub(path: str, chapters):
+    book = epub.EpubBook()
+    book.set_identifier("reingest-test")
+    book.set_title("Re-ingest")
+    book.set_language("en")
+    items = []
+    for i, body in enumerate(chapters):
+        item = epub.EpubHtml(title=f"Chapter {i + 1}", file_name=f"ch{i}.xhtml", lang="en")
+        item.content = f"<html><body>{body}</body></html>"
+        book.add_item(item)
+        items.append(item)
+    book.toc = items
+    book.spine = items
+    book.add_item(epub.EpubNcx())
+    epub.write_epub(path, book)
+
+
+class IncrementalReingestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.epub_path = os.path.join(self.dir, "book.epub")
+        self.book_dir = os.path.join(self.dir, "library", "book_data")
+        _write_epub(self.epub_path, CHAPTERS)
+        self.first = self._ingest()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _ingest(self):
+        return parse_epub(self.epub_path, self.book_dir, fetch_kobo_highlights=False)
+
+    def _ingest_counts(self):
+        state = get_state(self.book_dir, INGEST_STATE_KEY)
+        return state["rendered"], state["reused"]
+
+    def _highlight(self, chapter_index: int, text: str) -> Highlight:
+        """Highlights text as the reader does: located in the stored chapter and saved with its range."""
+        chapter = load_chapter(self.book_dir, chapter_index)
+        hl = Highlight(text=text, annotation="Manuel", date="", chapter_id="", id="manual1")
+        self.assertEqual(locate_highlights(BeautifulSoup(chapter.content, "html.parser"), [hl]), [0])
+        save_chapter_highlights(self.book_dir, chapter_index, chapter.highlights + [hl])
+        return hl
+
+    def test_first_ingest_renders_everything(self):
+        self.assertEqual(self._ingest_counts(), (3, 0))
+
+    def test_unchanged_epub_reuses_every_chapter(self):
+        book = self._ingest()
+        self.assertEqual(self._ingest_counts(), (0, 3))
+        self.assertEqual([load_chapter(self.book_dir, i).content for i in range(3)],
+                         [ch.content for ch in self.first.spine])
+        self.assertEqual([ch.title for ch in book.spine], [ch.title for ch in self.first.spine])
+
+    def test_changed_document_rerenders_only_its_chapter(self):
+        changed = list(CHAPTERS)
+        changed[1] = "<h1>Two</h1><p>The rain fell in torrents, all night.</p>"
+        _write_epub(self.epub_path, changed)
+        self._ingest()
+        self.assertEqual(self._ingest_counts(), (1, 2))
+        self.assertIn("all night", load_chapter(self.book_dir, 1).content)
+        self.assertEqual(load_chapter(self.book_dir, 0).content, self.first.spine[0].content)
+
+    def test_render_version_bump_rerenders_everything(self):
+        with mock.patch.object(parser, "RENDER_VERSION", parser.RENDER_VERSION + "-next"):
+            self._ingest()
+        self.assertEqual(self._ingest_counts(), (3, 0))
+
+    def test_manual_highlight_survives_reingest(self):
+        hl = self._highlight(0, "dark and stormy")
+        self._ingest()
+        self.assertEqual(load_chapter(self.book_dir, 0).highlights, [hl])
+
+    def test_manual_highlight_follows_a_changed_chapter(self):
+        self._highlight(0, "dark and stormy")
+        changed = list(CHAPTERS)
+        changed[0] = "<h1>One</h1><p>Once more, it was a dark and stormy night.</p>"
+        _write_epub(self.epub_path, changed)
+        self._ingest()
+        self.assertEqual(self._ingest_counts(), (1, 2))
+        chapter = load_chapter(self.book_dir, 0)
+        self.assertEqual(len(chapter.highlights), 1)
+        hl = chapter.highlights[0]
+        self.assertEqual(hl.id, "manual1")
+        self.assertEqual(BeautifulSoup(chapter.content, "html.parser").get_text()[hl.start:hl.end], "dark and stormy")
+
+
+if __name__ == "__main__":
+    unittest.main()